@@ -3,24 +3,52 @@
 # you may not use this file except in compliance with the Elastic License.
 
 import os
+from collections import namedtuple
+from contextlib import contextmanager
 from pathlib import Path
 
+from . import trace, packed
+
 assets_dir = Path(__file__).parent
 branches = ("production", "staging", "snapshot")
+raw_url = "https://raw.githubusercontent.com"
+retry_status = (429, 500, 502, 503, 504)
+chunk_size = 64 * 1024
+timeout = 60
+
+RemoteEntry = namedtuple("RemoteEntry", ["path", "sha", "size", "download_url"])
+
+
+class PackedBranchError(ValueError):
+    """
+    The package is in a packed branch, which the remote readers do not understand.
+
+    Packed branches are read remotely only through a `bot serve` server.
+    """
+
+    def __init__(self, package, branch):
+        super().__init__(f"Package in a packed branch, not readable remotely: {package} ({branch})")
+        self.package = package
+        self.branch = branch
 
 
 def walk():
     """
-    Traverse all the local assets.
+    Traverse all the local assets, packed branches included.
 
     :return: generator yielding (branch, package, version) of all the local assets
     """
 
     for branch in branches:
         for asset_branch, packages, _ in os.walk(assets_dir / branch):
+            is_packed = packed.objects_dir in packages
             for package in packages:
                 if package.startswith("."):
                     continue
+                if is_packed:
+                    for version in packed.iter_versions(asset_branch, package):
+                        yield branch, package, version
+                    continue
                 for _, versions, _ in os.walk(Path(asset_branch) / package):
                     for version in versions:
                         yield branch, package, version
@@ -28,24 +56,172 @@ def walk():
             break
 
 
-def get_meta(branch, package, version):
+def get_branch_dir(branch):
+    """
+    Get the local directory of an assets branch.
+
+    :param branch: one among 'production', 'staging', 'snapshot'
+    :return: path of the branch checkout, ex. 'assets/production'
+    """
+
+    return assets_dir / branch
+
+
+def get_meta(branch, package, version, index=None):
     """
     Get the meta-data of a local asset.
 
     :param branch: one among 'production', 'staging', 'snapshot'
     :param package: package name, ex. 'endpoint'
     :param version: package version, ex. '8.3.0'
+    :param index: optional :py:class:`.index.Index`, the file is not parsed if found there
     :return: dictionary containing the meta-data
     """
 
     import yaml
 
     meta_filename = assets_dir / branch / package / version / "meta.yml"
+    if packed.is_packed(assets_dir / branch):
+        try:
+            tree = packed.read_tree(assets_dir / branch, f"{package}/{version}")
+        except FileNotFoundError:
+            return None
+        sha = next((sha for sha, _, name in tree if name == "meta.yml"), None)
+        if sha is None:
+            return None
+        meta_filename = packed.blob_filename(assets_dir / branch, sha)
     if meta_filename.exists():
+        if index is not None:
+            return index.load_yaml(meta_filename)
         with open(meta_filename) as f:
             return yaml.safe_load(f)
 
 
+def _git(branch, *args):
+    import subprocess
+
+    return subprocess.run(["git", "-C", assets_dir / branch, *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def get_revision(branch):
+    """
+    Get the revision of a local assets branch.
+
+    :param branch: one among 'production', 'staging', 'snapshot'
+    :return: commit id or None if the branch is not available
+    """
+
+    if (assets_dir / branch).exists():
+        p = _git(branch, "rev-parse", "HEAD")
+        if not p.returncode:
+            return p.stdout.decode().strip()
+
+
+def get_changed_packages(branch, since):
+    """
+    Get the packages whose local assets changed since a given revision.
+
+    :param branch: one among 'production', 'staging', 'snapshot'
+    :param since: revision of the assets branch
+    :return: set of package names or None if the changes are unknown
+    """
+
+    if not (assets_dir / branch).exists():
+        return None
+    p = _git(branch, "diff", "--relative", "--name-only", "-z", since, "HEAD")
+    if p.returncode:
+        return None
+    return {path.split("/")[0] for path in p.stdout.decode().split("\0") if "/" in path and path[0] != "."}
+
+
+class LocalAsset(namedtuple("LocalAsset", ["path", "filename", "size"])):
+    """
+    Handle of a local asset, the content is read only on request.
+
+    `path` is relative to the searched directory, ex. 'endpoint/8.3.0/manifest.yml',
+    `filename` is the actual location on disk.
+    """
+
+    __slots__ = ()
+
+    def open(self):
+        return open(self.filename, "rb")
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    def chunks(self, size=chunk_size):
+        """
+        Stream the content.
+
+        :param size: size of the chunks
+        :return: generator yielding the content in chunks of `size` bytes at most
+        """
+
+        with self.open() as f:
+            yield from iter(lambda: f.read(size), b"")
+
+    @contextmanager
+    def mmap(self):
+        """
+        Map the content in memory, read-only.
+
+        :return: context manager yielding a `mmap.mmap` object, or `b""` if the asset is empty
+        """
+
+        import mmap
+
+        with self.open() as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield m
+
+
+def iter_local_assets(package, path):
+    """
+    Traverse a package's local assets without reading them.
+
+    The working directory is not changed, it's safe to use from multiple threads.
+    In a packed branch the handles point to the files of the blob store.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param path: path on disk searched for the assets
+    :return: generator yielding :py:class:`.LocalAsset` handles as they are traversed
+    """
+
+    path = Path(path)
+    if packed.is_packed(path):
+        try:
+            tree = packed.read_tree(path, package)
+        except FileNotFoundError:
+            raise ValueError(f"Package not found: {package}")
+        for sha, size, name in tree:
+            yield LocalAsset(f"{package}/{name}", packed.blob_filename(path, sha), size)
+        return
+    if not (path / package).exists():
+        raise ValueError(f"Package not found: {package}")
+    for root, _, files in os.walk(path / package):
+        for file in files:
+            filename = Path(root) / file
+            yield LocalAsset(str(filename.relative_to(path)), filename, os.stat(filename).st_size)
+
+
+def read_local_assets(package, path, workers=8):
+    """
+    Read all of a package's local assets, concurrently.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param path: path on disk searched for the assets
+    :param workers: maximum number of concurrent reads
+    :return: generator yielding (path, content) pairs as they get ready
+    """
+
+    yield from _map_bounded(lambda asset: (asset.path, asset.read()), iter_local_assets(package, path), workers)
+
+
 def get_local_assets(package, path):
     """
     Retrieve the list of a package's local assets.
@@ -55,69 +231,511 @@ def get_local_assets(package, path):
     :return: generator yielding (path, content) pairs as they are traversed
     """
 
-    saved_cwd = os.getcwd()
-    os.chdir(path)
+    for asset in iter_local_assets(package, path):
+        yield asset.path, asset.read()
+
+
+def _get_contents_assets(repo, branch, entries):
+    from collections import deque
+
+    entries = deque(entries)
+    while entries:
+        entry = entries.popleft()
+        if entry.type == "dir":
+            entries.extend(repo.get_contents(entry.path, ref=branch))
+        else:
+            yield entry
+
+
+def _get_tree(repo, branch, package=None):
+    from github import GithubException
+
+    # a `<branch>:<path>` tree-ish lists only that subtree
+    ref = f"{branch}:{package.strip('/')}" if package else branch
     try:
-        if not Path(package).exists():
-            raise ValueError(f"Package not found: {package}")
-        for root, _, files in os.walk(package):
-            for file in files:
-                with open(Path(root) / file, "rb") as f:
-                    yield f.name, f.read()
-    finally:
-        os.chdir(saved_cwd)
+        return repo.get_git_tree(ref, recursive=True)
+    except GithubException:
+        return None
+
 
+def _get_subtree_assets(package, repo, branch, subtree=None, raw_url=None):
+    from github import GithubException
+
+    if subtree is None:
+        subtree = _get_tree(repo, branch, package)
+        if subtree is None:
+            return
+
+    if subtree.truncated:
+        try:
+            entries = repo.get_contents(package, ref=branch)
+        except GithubException:
+            return
+        yield from _get_contents_assets(repo, branch, entries)
+        return
 
-def get_remote_assets(package, repo):
+    # paths in the subtree are relative to the package
+    prefix = package.strip("/") + "/"
+    for element in subtree.tree:
+        if element.type == "blob":
+            yield _tree_entry(repo, branch, element, prefix, raw_url)
+
+
+def _check_packed(package, repo):
+    from github import GithubException
+
+    # only the unpacked layout is listed, a packed version is a single `<version>.tree` file
+    for branch in branches:
+        try:
+            repo.get_contents(f"{package.strip('/')}{packed.tree_suffix}", ref=branch)
+        except GithubException:
+            continue
+        raise PackedBranchError(package, branch)
+
+
+def _get_raw_url(url=None):
+    # the module default is looked up at each call, library users may have changed it
+    return (url or raw_url).rstrip("/")
+
+
+def _tree_entry(repo, branch, element, prefix="", raw_url=None):
+    from urllib.parse import quote
+
+    path = prefix + element.path
+    download_url = f"{_get_raw_url(raw_url)}/{repo.full_name}/{quote(branch)}/{quote(path, safe='/@')}"
+    return RemoteEntry(path, element.sha, element.size, download_url)
+
+
+def get_remote_assets(package, repo, tree=False, raw_url=None):
     """
     Retrieve the list of a package's remote assets.
 
     :param package: name and version of the package, ex. 'endpoint/8.3.0'
     :param repo: repository object searched for the assets
+    :param tree: list the package subtree of each branch with a single recursive tree request, all the branches
+                 probed concurrently
+    :param raw_url: base url of the raw content in the tree listings, default the module `raw_url`
     :return: generator yielding the remote assets entries
+    :raise PackedBranchError: if the package is in a packed branch
     """
 
     from github import GithubException
 
+    if tree:
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=len(branches))
+        try:
+            futures = [executor.submit(_get_tree, repo, branch, package) for branch in branches]
+            for branch, future in zip(branches, futures):
+                subtree = future.result()
+                if subtree is None:
+                    continue
+                entries = _get_subtree_assets(package, repo, branch, subtree, raw_url)
+                entry = next(entries, None)
+                if entry is None:
+                    continue
+                yield entry
+                yield from entries
+                return
+        finally:
+            executor.shutdown(wait=False)
+
+        _check_packed(package, repo)
+        raise ValueError(f"Package not found: {package}")
+
     for branch in branches:
         try:
             entries = repo.get_contents(package, ref=branch)
         except GithubException:
             continue
 
-        while entries:
-            entry = entries.pop(0)
-            if entry.type == "dir":
-                entries += repo.get_contents(entry.path, ref=branch)
-            else:
-                yield entry
+        yield from _get_contents_assets(repo, branch, entries)
         return
 
+    _check_packed(package, repo)
     raise ValueError(f"Package not found: {package}")
 
 
-def download_assets(entries):
+def resolve_remote_assets(packages, repo, workers=8, raw_url=None):
+    """
+    Retrieve the lists of the remote assets of many packages.
+
+    Each package is listed as by :py:func:`.get_remote_assets` with `tree`
+    set, concurrently. With more than one package the branches are first
+    listed whole, with a recursive tree request each: if no listing is
+    truncated the packages are looked up there instead, with no further
+    requests.
+
+    :param packages: names and versions of the packages, ex. ['endpoint/8.3.0', 'endpoint/8.4.0']
+    :param repo: repository object searched for the assets
+    :param workers: maximum number of concurrent requests
+    :param raw_url: base url of the raw content in the tree listings, default the module `raw_url`
+    :return: generator yielding (package, entries) pairs in the given order, entries is an iterator of
+             the remote assets entries or None if the package is not found
+    :raise PackedBranchError: if a package is in a packed branch
+    """
+
+    from itertools import chain
+    from concurrent.futures import ThreadPoolExecutor
+
+    def index(tree):
+        # blobs by package and version, a packed version is indexed by its tree file
+        packages = {}
+        for element in tree.tree if tree is not None else []:
+            if element.type == "blob":
+                packages.setdefault("/".join(element.path.split("/")[:2]), []).append(element)
+        return packages
+
+    def lookup(package):
+        for branch, elements in zip(branches, indices):
+            if package.strip("/") in elements:
+                return package, (_tree_entry(repo, branch, element, raw_url=raw_url)
+                                 for element in elements[package.strip("/")])
+            if package.strip("/") + packed.tree_suffix in elements:
+                raise PackedBranchError(package, branch)
+        return package, None
+
+    def resolve(package):
+        if indices is not None and package.strip("/").count("/") == 1:
+            return lookup(package)
+
+        entries = get_remote_assets(package, repo, tree=True, raw_url=raw_url)
+        # only the first entry is needed to find the branch, the others are listed as they are consumed
+        try:
+            entry = next(entries)
+        except PackedBranchError:
+            raise
+        except ValueError:
+            return package, None
+        return package, chain([entry], entries)
+
+    packages = list(packages)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        indices = None
+        if len(packages) > 1:
+            trees = list(executor.map(lambda branch: _get_tree(repo, branch), branches))
+            # the real branches are too large to be listed whole, their listings are truncated
+            if not any(tree is not None and tree.truncated for tree in trees):
+                indices = [index(tree) for tree in trees]
+        yield from executor.map(resolve, packages)
+
+
+def select_assets(entries, package, include=(), exclude=()):
+    """
+    Select the assets by their path relative to the package.
+
+    :param entries: assets entries, ex. as generated by :py:func:`.get_remote_assets`
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param include: shell-style patterns, ex. 'index_templates/*', the assets must match at least one of them
+    :param exclude: shell-style patterns, the assets must match none of them
+    :return: generator yielding the selected entries
+    """
+
+    for entry in entries:
+        if _selected(os.path.relpath(entry.path, package), include, exclude):
+            yield entry
+
+
+def _selected(path, include, exclude):
+    from fnmatch import fnmatchcase
+
+    if include and not any(fnmatchcase(path, pattern) for pattern in include):
+        return False
+    return not any(fnmatchcase(path, pattern) for pattern in exclude)
+
+
+def _map_bounded(fn, iterable, workers):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for item in iterable:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(fn, item))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _make_session(workers, http_cache=None):
+    import requests
+
+    session = requests.Session()
+    if http_cache is not None:
+        from .httpcache import mount
+        return mount(session, http_cache, pool_connections=workers, pool_maxsize=workers)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch(session, url, sink, retries, backoff):
+    import time
+    import requests
+
+    with trace.span("http get", url=url, requests=0, retries=0, bytes=0) as span:
+        attempt = 0
+        while True:
+            span["requests"] += 1
+            try:
+                with session.get(url, stream=True, timeout=timeout) as res:
+                    res.raise_for_status()
+                    result = sink(res)
+                    span["bytes"] += res.raw.tell() if hasattr(res.raw, "tell") else len(res.content)
+                    return result
+            except requests.HTTPError as e:
+                if e.response.status_code not in retry_status:
+                    raise
+                error = e
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+
+            if attempt >= retries:
+                raise error
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+            span["retries"] = attempt
+
+
+def _write(res, filename):
+    partname = filename.with_name(filename.name + ".part")
+    try:
+        with open(partname, "wb") as f:
+            for chunk in res.iter_content(chunk_size):
+                f.write(chunk)
+    except BaseException:
+        partname.unlink(missing_ok=True)
+        raise
+    os.replace(partname, filename)
+
+
+def _download(entries, fetch, workers, http_cache):
+    session = _make_session(workers, http_cache)
+    try:
+        yield from _map_bounded(lambda entry: fetch(session, entry), entries, workers)
+    finally:
+        session.close()
+
+
+def download_assets(entries, workers=8, retries=3, backoff=0.5, cache=None, http_cache=None):
     """
     Download the assets of a package.
 
-    :param entries: assets entries as generated by :py:func:`.get_assets`
+    :param entries: assets entries as generated by :py:func:`.get_remote_assets`
+    :param workers: maximum number of concurrent downloads
+    :param retries: number of retries of each download on transient failures
+    :param backoff: delay before the first retry, doubled at each next one
+    :param cache: optional :py:class:`.cache.BlobCache`, assets found there are not downloaded
+    :param http_cache: optional :py:class:`.httpcache.HttpCache`, unchanged assets are revalidated, not downloaded
     :return: generator yielding (path, content) pairs as they get ready
     """
 
-    from requests_futures.sessions import FuturesSession
-    from concurrent.futures import as_completed
+    def fetch(session, entry):
+        sha = getattr(entry, "sha", None)
+        if cache is not None:
+            content = cache.read(sha)
+            if content is not None:
+                return entry.path, content
 
-    session = FuturesSession()
-    futures = []
+        content = _fetch(session, entry.download_url, lambda res: res.content, retries, backoff)
+        if cache is not None:
+            cache.put_data(sha, content)
+        return entry.path, content
 
-    for entry in entries:
-        future = session.get(entry.download_url)
-        future.entry = entry
-        futures.append(future)
+    yield from _download(entries, fetch, workers, http_cache)
+
+
+def save_assets(entries, package, output_dir, workers=8, retries=3, backoff=0.5, cache=None, http_cache=None):
+    """
+    Download the assets of a package straight to disk.
+
+    Each asset is streamed in chunks to its destination file, at most `workers`
+    assets are in flight at any time. Assets found in the cache are hard-linked
+    to their destination, if possible, otherwise copied.
+
+    :param entries: assets entries as generated by :py:func:`.get_remote_assets`
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param output_dir: directory where the assets are saved to
+    :param workers: maximum number of concurrent downloads
+    :param retries: number of retries of each download on transient failures
+    :param backoff: delay before the first retry, doubled at each next one
+    :param cache: optional :py:class:`.cache.BlobCache`, assets found there are not downloaded
+    :param http_cache: optional :py:class:`.httpcache.HttpCache`, unchanged assets are revalidated, not downloaded
+    :return: generator yielding (path, filename) pairs as they get saved
+    """
+
+    fetch = _saver(retries, backoff, cache)
+    for _, path, filename in _download(((package, entry, output_dir) for entry in entries), fetch, workers, http_cache):
+        yield path, filename
+
+
+def save_packages_assets(packages, workers=8, retries=3, backoff=0.5, cache=None, http_cache=None):
+    """
+    Download the assets of many packages straight to disk.
+
+    Same as :py:func:`.save_assets` but all the packages share the same connection
+    pool and at most `workers` assets are in flight at any time, in total.
+
+    :param packages: iterable of (package, entries, output_dir), ex. `entries` as
+                     generated by :py:func:`.resolve_remote_assets`
+    :param workers: maximum number of concurrent downloads
+    :param retries: number of retries of each download on transient failures
+    :param backoff: delay before the first retry, doubled at each next one
+    :param cache: optional :py:class:`.cache.BlobCache`, assets found there are not downloaded
+    :param http_cache: optional :py:class:`.httpcache.HttpCache`, unchanged assets are revalidated, not downloaded
+    :return: generator yielding (package, path, filename) as they get saved
+    """
+
+    items = ((package, entry, output_dir) for package, entries, output_dir in packages for entry in entries)
+    yield from _download(items, _saver(retries, backoff, cache), workers, http_cache)
+
+
+def _saver(retries, backoff, cache):
+    from .cache import link_or_copy
+
+    def fetch(session, item):
+        package, entry, output_dir = item
+        filename = Path(output_dir) / os.path.relpath(entry.path, package)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+
+        sha = getattr(entry, "sha", None)
+        if cache is not None:
+            blob = cache.get(sha)
+            if blob is not None:
+                try:
+                    link_or_copy(blob, filename)
+                    return package, entry.path, filename
+                except FileNotFoundError:
+                    pass
+
+        _fetch(session, entry.download_url, lambda res: _write(res, filename), retries, backoff)
+        if cache is not None:
+            cache.put(sha, filename)
+        return package, entry.path, filename
+
+    return fetch
+
+
+def get_archive_url(package, repo):
+    """
+    Get the url of the archive of the branch containing a package, all the branches are probed concurrently.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param repo: repository object searched for the assets
+    :return: url of the tarball of the branch
+    :raise PackedBranchError: if the package is in a packed branch
+    """
+
+    from github import GithubException
+    from concurrent.futures import ThreadPoolExecutor
+
+    def probe(branch):
+        try:
+            return bool(repo.get_contents(package, ref=branch))
+        except GithubException:
+            return False
+
+    with ThreadPoolExecutor(max_workers=len(branches)) as executor:
+        found = list(executor.map(probe, branches))
+
+    for branch, ok in zip(branches, found):
+        if ok:
+            return repo.get_archive_link("tarball", ref=branch)
+
+    _check_packed(package, repo)
+    raise ValueError(f"Package not found: {package}")
+
+
+def _archive_members(package, url, strip):
+    import tarfile
+    import posixpath
+    import requests
 
-    for future in as_completed(futures):
-        res = future.result()
+    prefix = package.strip("/") + "/"
+    with trace.span("http get archive", url=url, requests=1, bytes=0) as span, \
+            requests.get(url, stream=True, timeout=timeout) as res:
         res.raise_for_status()
-        yield future.entry.path, res.content
+        res.raw.decode_content = True
+        try:
+            with tarfile.open(fileobj=res.raw, mode="r|*") as tar:
+                found = False
+                for member in tar:
+                    path = "/".join(member.name.split("/")[strip:])
+                    if path == prefix[:-1] + packed.tree_suffix:
+                        raise PackedBranchError(package, url)
+                    if not path.startswith(prefix):
+                        if found:
+                            break
+                        continue
+                    found = True
+                    # only regular files, not escaping the package directory
+                    if member.isfile() and posixpath.normpath(path).startswith(prefix) and ".." not in path.split("/"):
+                        yield posixpath.normpath(path), tar.extractfile(member)
+        finally:
+            span["bytes"] = res.raw.tell()
+
+
+def download_archive_assets(package, url, strip=1):
+    """
+    Download the assets of a package from an archive.
 
-    session.close()
+    The tarball is extracted as it is streamed, only the members of the package
+    are read. Members are expected in git tree order, as in the archives produced
+    by GitHub and `git archive`, the download stops past the package members.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param url: url of the tarball, ex. as returned by :py:func:`.get_archive_url`
+    :param strip: number of leading components stripped from the members path
+    :return: generator yielding (path, content) pairs as they get ready
+    :raise PackedBranchError: if the package is in a packed branch
+    """
+
+    for path, f in _archive_members(package, url, strip):
+        yield path, f.read()
+
+
+def save_archive_assets(package, url, output_dir, strip=1, include=(), exclude=()):
+    """
+    Download the assets of a package from an archive straight to disk.
+
+    Same as :py:func:`.download_archive_assets` but each member is streamed in
+    chunks to its destination file.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param url: url of the tarball, ex. as returned by :py:func:`.get_archive_url`
+    :param output_dir: directory where the assets are saved to
+    :param strip: number of leading components stripped from the members path
+    :param include: shell-style patterns, only the members matching at least one of them are saved
+    :param exclude: shell-style patterns, the members matching any of them are not saved
+    :return: generator yielding (path, filename) pairs as they get saved
+    :raise PackedBranchError: if the package is in a packed branch
+    """
+
+    import shutil
+
+    for path, f in _archive_members(package, url, strip):
+        if not _selected(os.path.relpath(path, package), include, exclude):
+            continue
+        filename = Path(output_dir) / os.path.relpath(path, package)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        partname = filename.with_name(filename.name + ".part")
+        try:
+            with open(partname, "wb") as out:
+                shutil.copyfileobj(f, out, chunk_size)
+        except BaseException:
+            partname.unlink(missing_ok=True)
+            raise
+        os.replace(partname, filename)
+        yield path, filename
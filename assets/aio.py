@@ -0,0 +1,194 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import asyncio
+from urllib.parse import quote
+
+from . import packed, branches, raw_url, retry_status, timeout, RemoteEntry, PackedBranchError
+
+
+class AsyncClient:
+    """
+    Asyncio client listing and downloading the remote assets, requires `aiohttp`.
+
+    All the requests share one pool of keep-alive connections and at most `limit`
+    of them are in flight at any time. Use it as async context manager:
+
+        async with AsyncClient(token) as client:
+            async for path, content in client.download_assets(client.get_remote_assets(package)):
+                ...
+    """
+
+    def __init__(self, token=None, repo="elastic/package-assets", limit=16, retries=3, backoff=0.5,
+                 api_url="https://api.github.com", raw_url=raw_url):
+        self.token = token
+        self.repo = repo
+        self.limit = limit
+        self.retries = retries
+        self.backoff = backoff
+        self.api_url = api_url.rstrip("/")
+        self.raw_url = raw_url.rstrip("/")
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        headers = {"Accept": "application/vnd.github+json"}
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=headers,
+        )
+        self._semaphore = asyncio.Semaphore(self.limit)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, url, read):
+        import aiohttp
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore, self.session.get(url) as res:
+                    res.raise_for_status()
+                    return await read(res)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in retry_status:
+                    raise
+                error = e
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt >= self.retries:
+                raise error
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def _get_json(self, url):
+        import aiohttp
+
+        try:
+            return await self._request(url, lambda res: res.json(content_type=None))
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def _entry(self, branch, item):
+        download_url = item.get("download_url") or \
+            f"{self.raw_url}/{self.repo}/{quote(branch)}/{quote(item['path'], safe='/@')}"
+        return RemoteEntry(item["path"], item["sha"], item.get("size"), download_url)
+
+    async def _get_contents_assets(self, package, branch):
+        entries = []
+        paths = [package]
+        while paths:
+            urls = [f"{self.api_url}/repos/{self.repo}/contents/{quote(path)}?ref={quote(branch)}" for path in paths]
+            paths = []
+            for items in await asyncio.gather(*(self._get_json(url) for url in urls)):
+                for item in items or []:
+                    if item["type"] == "dir":
+                        paths.append(item["path"])
+                    else:
+                        entries.append(self._entry(branch, item))
+        return entries
+
+    async def _get_tree_assets(self, package, branch):
+        # only the package subtree is listed, paths are relative to it
+        package = package.strip("/")
+        ref = quote(f"{branch}:{package}", safe="")
+        tree = await self._get_json(f"{self.api_url}/repos/{self.repo}/git/trees/{ref}?recursive=1")
+        if tree is None:
+            return []
+        if tree.get("truncated"):
+            return await self._get_contents_assets(package, branch)
+
+        return [self._entry(branch, dict(item, path=f"{package}/{item['path']}")) for item in tree["tree"]
+                if item["type"] == "blob"]
+
+    async def get_remote_assets(self, package):
+        """
+        Retrieve the list of a package's remote assets, all the branches are probed concurrently.
+
+        :param package: name and version of the package, ex. 'endpoint/8.3.0'
+        :return: async generator yielding the remote assets entries
+        :raise PackedBranchError: if the package is in a packed branch
+        """
+
+        tasks = [asyncio.ensure_future(self._get_tree_assets(package, branch)) for branch in branches]
+        try:
+            for task in tasks:
+                entries = await task
+                if entries:
+                    for entry in entries:
+                        yield entry
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # only the unpacked layout is listed, a packed version is a single `<version>.tree` file
+        path = quote(f"{package.strip('/')}{packed.tree_suffix}")
+        for branch in branches:
+            if await self._get_json(f"{self.api_url}/repos/{self.repo}/contents/{path}?ref={quote(branch)}"):
+                raise PackedBranchError(package, branch)
+        raise ValueError(f"Package not found: {package}")
+
+    async def download_assets(self, entries, cache=None):
+        """
+        Download the assets of a package.
+
+        :param entries: assets entries, an iterable or async iterable as generated by :py:meth:`get_remote_assets`
+        :param cache: optional :py:class:`.cache.BlobCache`, assets found there are not downloaded
+        :return: async generator yielding (path, content) pairs as they get ready
+        """
+
+        async def fetch(entry):
+            sha = getattr(entry, "sha", None)
+            if cache is not None:
+                content = cache.read(sha)
+                if content is not None:
+                    return entry.path, content
+
+            content = await self._request(entry.download_url, lambda res: res.read())
+            if cache is not None:
+                cache.put_data(sha, content)
+            return entry.path, content
+
+        if not hasattr(entries, "__aiter__"):
+            entries = _aiter(entries)
+
+        pending = set()
+        try:
+            async for entry in entries:
+                if len(pending) >= 2 * self.limit:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(fetch(entry)))
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
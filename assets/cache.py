@@ -0,0 +1,249 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+
+
+def blob_sha(data):
+    """
+    Compute the git blob SHA of some content.
+
+    :param data: content of the blob
+    :return: hex digest, as found in the `sha` of the GitHub content entries
+    """
+
+    h = hashlib.sha1(b"blob %d\0" % len(data))
+    h.update(data)
+    return h.hexdigest()
+
+
+def file_blob_sha(filename, chunk_size=64 * 1024):
+    """
+    Compute the git blob SHA of the content of a file.
+
+    :param filename: path of the file
+    :param chunk_size: size of the chunks the file is read in
+    :return: hex digest, as found in the `sha` of the GitHub content entries
+    """
+
+    h = hashlib.sha1(b"blob %d\0" % os.stat(filename).st_size)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-link `src` to `dst`, copy it if linking is not possible. An existing `dst` is replaced.
+    """
+
+    import shutil
+
+    dst = Path(dst)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}-{threading.get_ident()}.part")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class BlobCache:
+    """
+    On-disk cache of blobs addressed by their git blob SHA.
+
+    Blobs are stored read-only in `<path>/<sha[:2]>/<sha[2:]>` and evicted in
+    least recently used order once their total size exceeds `max_size` bytes.
+    Stored files are copied, files served by hard link share the blob inode,
+    hence they are read-only as well. Blobs are checked against their SHA
+    before being served, corrupted ones are removed.
+    """
+
+    def __init__(self, path, max_size=1 << 30):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def filename(self, sha):
+        return self.path / sha[:2] / sha[2:]
+
+    def _blobs(self):
+        if not self.path.exists():
+            return
+        for subdir in os.scandir(self.path):
+            if subdir.is_dir() and len(subdir.name) == 2:
+                for blob in os.scandir(subdir.path):
+                    if blob.is_file() and not blob.name.endswith(".part"):
+                        yield blob
+
+    def _scan(self):
+        if self._size is None:
+            self._size = sum(blob.stat().st_size for blob in self._blobs())
+
+    def _scan_locked(self):
+        with self._lock:
+            self._scan()
+
+    @property
+    def size(self):
+        self._scan_locked()
+        return self._size
+
+    def _discard(self, filename):
+        try:
+            size = os.stat(filename).st_size
+            os.unlink(filename)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def get(self, sha):
+        """
+        Look up a blob, mark it as recently used.
+
+        :param sha: git blob SHA of the blob
+        :return: path of the cached blob or None if not cached
+        """
+
+        if not sha:
+            return None
+        filename = self.filename(sha)
+        try:
+            os.utime(filename)
+            valid = file_blob_sha(filename) == sha
+        except FileNotFoundError:
+            self._miss()
+            return None
+        if not valid:
+            self._discard(filename)
+            self._miss()
+            return None
+        self._hit()
+        return filename
+
+    def read(self, sha):
+        """
+        Get the content of a blob.
+
+        :param sha: git blob SHA of the blob
+        :return: content of the blob or None if not cached
+        """
+
+        if not sha:
+            return None
+        filename = self.filename(sha)
+        try:
+            os.utime(filename)
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._miss()
+            return None
+        if blob_sha(data) != sha:
+            self._discard(filename)
+            self._miss()
+            return None
+        self._hit()
+        return data
+
+    def put(self, sha, filename):
+        """
+        Store a copy of a file in the cache.
+
+        The file is stored only if its content matches `sha`.
+
+        :param sha: expected git blob SHA of the file content
+        :param filename: path of the file to store
+        :return: True if the file was stored, False otherwise
+        """
+
+        import shutil
+
+        if not sha:
+            return False
+        blob = self.filename(sha)
+        if blob.exists():
+            return file_blob_sha(filename) == sha
+        self._scan_locked()
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}-{threading.get_ident()}.part")
+        try:
+            shutil.copyfile(filename, tmp)
+            # the copy is checked, the original may change meanwhile
+            if file_blob_sha(tmp) != sha:
+                return False
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, blob)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self._add(blob.stat().st_size)
+        return True
+
+    def put_data(self, sha, data):
+        """
+        Store some content in the cache.
+
+        The content is stored only if it matches `sha`.
+
+        :param sha: expected git blob SHA of the content
+        :param data: content to store
+        :return: True if the content was stored, False otherwise
+        """
+
+        if not sha or blob_sha(data) != sha:
+            return False
+
+        blob = self.filename(sha)
+        if blob.exists():
+            return True
+        self._scan_locked()
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}-{threading.get_ident()}.part")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, blob)
+        self._add(len(data))
+        return True
+
+    def _add(self, size):
+        with self._lock:
+            self._size += size
+            if self._size <= self.max_size:
+                return
+
+            blobs = []
+            for blob in self._blobs():
+                try:
+                    st = blob.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((st.st_mtime_ns, st.st_size, blob.path))
+
+            for _, size, path in sorted(blobs):
+                if self._size <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                self._size -= size
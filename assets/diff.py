@@ -0,0 +1,157 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import threading
+from collections import namedtuple
+
+from . import iter_local_assets, _map_bounded
+from .cache import blob_sha
+
+Change = namedtuple("Change", ["op", "path", "old", "new"])
+FileDiff = namedtuple("FileDiff", ["op", "path", "changes"])
+
+
+def diff_documents(old, new, path=()):
+    """
+    Compare two parsed documents structurally.
+
+    Objects are compared key by key, lists of the same length item by item,
+    anything else as a whole.
+
+    :param old: old document
+    :param new: new document
+    :param path: path of the documents in their parents, prefixed to the change paths
+    :return: generator yielding a :py:class:`Change` for each difference, `op`
+             is one among 'added', 'removed', 'changed'
+    """
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                yield Change("removed", path + (key,), old[key], None)
+            elif old[key] != new[key]:
+                yield from diff_documents(old[key], new[key], path + (key,))
+        for key in new:
+            if key not in old:
+                yield Change("added", path + (key,), None, new[key])
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            if old_item != new_item:
+                yield from diff_documents(old_item, new_item, path + (i,))
+    elif old != new:
+        yield Change("changed", path, old, new)
+
+
+def _parse(filename, content):
+    import yaml
+
+    if filename.endswith(".json"):
+        return json.loads(content)
+    if filename.endswith((".yml", ".yaml")):
+        return yaml.load(content, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    return content.decode(errors="replace")
+
+
+class Documents:
+    """
+    Cache of the hashed and parsed asset files.
+
+    Files are hashed once and documents are parsed once per distinct content,
+    diffing a chain of versions parses each file only once.
+    """
+
+    def __init__(self):
+        self.parsed = 0
+        self._shas = {}
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def _read(self, asset):
+        content = asset.read()
+        sha = blob_sha(content)
+        with self._lock:
+            self._shas[asset.filename] = sha
+        return sha, content
+
+    def sha(self, asset):
+        """
+        :param asset: :py:class:`assets.LocalAsset` handle
+        :return: git blob SHA of the asset content
+        """
+
+        with self._lock:
+            sha = self._shas.get(asset.filename)
+        return sha or self._read(asset)[0]
+
+    def get(self, asset):
+        """
+        :param asset: :py:class:`assets.LocalAsset` handle
+        :return: parsed asset content
+        """
+
+        with self._lock:
+            sha = self._shas.get(asset.filename)
+            if sha in self._docs:
+                return self._docs[sha]
+        sha, content = self._read(asset)
+        doc = _parse(asset.path, content)
+        with self._lock:
+            self._docs.setdefault(sha, doc)
+            self.parsed += 1
+        return doc
+
+
+def _key(asset, package):
+    # object names may contain the package version, ex. 'logs-endpoint-8.3.0.json'
+    version = package.rsplit("/", 1)[-1]
+    return asset.path[len(package) + 1:].replace(version, "{version}")
+
+
+def diff_versions(old, new, path, workers=8, documents=None):
+    """
+    Compare the assets of two package versions.
+
+    Files with the same content are recognized by hash and not parsed, the
+    changed ones are parsed and compared in parallel.
+
+    :param old: name and version of the old package, ex. 'endpoint/8.3.0'
+    :param new: name and version of the new package, ex. 'endpoint/8.4.0'
+    :param path: path on disk searched for the assets
+    :param workers: maximum number of files compared concurrently
+    :param documents: optional :py:class:`Documents` cache, shared across calls
+    :return: list of :py:class:`FileDiff`, sorted by path, `op` is one among
+             'added', 'removed', 'changed'
+    """
+
+    if documents is None:
+        documents = Documents()
+    old_assets = {_key(asset, old): asset for asset in iter_local_assets(old, path)}
+    new_assets = {_key(asset, new): asset for asset in iter_local_assets(new, path)}
+
+    diffs = [FileDiff("removed", key, None) for key in old_assets.keys() - new_assets.keys()]
+    diffs += [FileDiff("added", key, None) for key in new_assets.keys() - old_assets.keys()]
+
+    def compare(key):
+        old_asset, new_asset = old_assets[key], new_assets[key]
+        if old_asset.size == new_asset.size and documents.sha(old_asset) == documents.sha(new_asset):
+            return None
+        changes = list(diff_documents(documents.get(old_asset), documents.get(new_asset)))
+        return FileDiff("changed", key, changes) if changes else None
+
+    common = sorted(old_assets.keys() & new_assets.keys())
+    diffs += [diff for diff in _map_bounded(compare, common, workers) if diff]
+    return sorted(diffs, key=lambda diff: diff.path)
+
+
+def format_path(path):
+    """
+    :param path: tuple of keys and list indices
+    :return: dotted path, ex. 'mappings.properties.process' or 'processors[2].set'
+    """
+
+    out = ""
+    for part in path:
+        out += f"[{part}]" if isinstance(part, int) else f".{part}" if out else str(part)
+    return out
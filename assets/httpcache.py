@@ -0,0 +1,314 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import hashlib
+import threading
+
+import requests
+
+from .cache import BlobCache
+
+# response headers worth replaying on a revalidated response
+cached_headers = ("Content-Type", "ETag", "Last-Modified", "Link")
+
+
+class HttpCache:
+    """
+    On-disk cache of HTTP responses, revalidated with conditional requests.
+
+    Responses carrying an `ETag` or `Last-Modified` header are stored and sent
+    again as `If-None-Match` and `If-Modified-Since`: a `304 Not Modified` reply
+    transfers no body and, on GitHub, costs no rate limit quota. Storage and
+    least recently used eviction are delegated to a :py:class:`.cache.BlobCache`,
+    entries are addressed by the SHA-256 of the request URL and `Accept` header,
+    not by their content: they are never accessed with the blob methods, which
+    check the content against the address.
+
+    `hits` counts the revalidated responses, `misses` the full ones.
+    """
+
+    def __init__(self, path, max_size=256 << 20):
+        self.blobs = BlobCache(path, max_size)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.blobs.path
+
+    @property
+    def size(self):
+        return self.blobs.size
+
+    def filename(self, key):
+        return self.blobs.filename(key)
+
+    @staticmethod
+    def key(request):
+        return hashlib.sha256(f"{request.headers.get('Accept', '')} {request.url}".encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Look up a response, mark it as recently used.
+
+        :param key: key of the response, see :py:meth:`key`
+        :return: (headers, body) of the response or None if not cached, `body` is
+                 a file object positioned at the start of the content
+        """
+
+        filename = self.filename(key)
+        try:
+            f = open(filename, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            headers = json.loads(f.readline())
+            os.utime(filename)
+        except (FileNotFoundError, ValueError):
+            f.close()
+            return None
+        return headers, _Body(f)
+
+    def writer(self, key, headers):
+        """
+        Start storing a response, its body is written as it's received.
+
+        :param key: key of the response, see :py:meth:`key`
+        :param headers: response headers to replay on revalidation
+        :return: :py:class:`_Writer` object, the response is stored once it's committed
+        """
+
+        return _Writer(self, key, headers)
+
+    def store(self, key, headers, content):
+        """
+        Store a response.
+
+        :param key: key of the response, see :py:meth:`key`
+        :param headers: response headers to replay on revalidation
+        :param content: body of the response
+        """
+
+        writer = self.writer(key, headers)
+        writer.write(content)
+        writer.commit()
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class _Body:
+    # body of a cached response, read in place of the connection
+    def __init__(self, f):
+        self._f = f
+        self._start = f.tell()
+        self.size = os.fstat(f.fileno()).st_size - self._start
+
+    def read(self, amt=None, **kwargs):
+        return self._f.read(-1 if amt is None else amt)
+
+    def tell(self):
+        return self._f.tell() - self._start
+
+    def close(self):
+        self._f.close()
+
+    # invoked by requests also when the body was read till the end
+    release_conn = close
+
+
+class _Writer:
+    # a response being stored, written to a part file until committed
+    def __init__(self, cache, key, headers):
+        self.blobs = cache.blobs
+        self.filename = cache.filename(key)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.filename.with_name(f"{self.filename.name}.{os.getpid()}-{threading.get_ident()}.part")
+        self.f = open(self.tmp, "wb")
+        self.f.write(json.dumps(headers).encode() + b"\n")
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self):
+        self.f.close()
+        self.blobs._scan_locked()
+        size = os.stat(self.tmp).st_size
+        try:
+            size -= os.stat(self.filename).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(self.tmp, self.filename)
+        self.blobs._add(size)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.unlink(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class _TeeBody:
+    # connection of a response, the decoded body is copied to the cache as the caller reads it
+    def __init__(self, raw, writer):
+        self._raw = raw
+        self._writer = writer
+        self._encoded = "Content-Encoding" in raw.headers
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _received(self, data, decoded):
+        if self._writer is None:
+            return
+        if self._encoded and not decoded:
+            # encoded bytes can't be replayed without their encoding
+            self._writer.abort()
+            self._writer = None
+        elif data:
+            self._writer.write(data)
+        else:
+            self._writer.commit()
+            self._writer = None
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        decoded = self._raw.decode_content if decode_content is None else decode_content
+        for data in self._raw.stream(amt, decode_content=decode_content):
+            self._received(data, decoded)
+            yield data
+        self._received(b"", decoded)
+
+    def read(self, amt=None, decode_content=None, **kwargs):
+        decoded = self._raw.decode_content if decode_content is None else decode_content
+        data = self._raw.read(amt, decode_content=decode_content, **kwargs)
+        self._received(data, decoded)
+        return data
+
+    def close(self):
+        # a body not read till the end is not stored
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        self._raw.close()
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter serving the GET requests through a :py:class:`HttpCache`.
+
+    Revalidated responses are returned as `200 OK` with the cached body, callers
+    do not need to know about the cache. Bodies are streamed from and to the
+    cache, they are never held in memory as a whole.
+    """
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.load(key)
+        if entry is not None:
+            headers, _ = entry
+            request = request.copy()
+            if "ETag" in headers:
+                request.headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers:
+                request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        try:
+            res = super().send(request, **kwargs)
+        except BaseException:
+            if entry is not None:
+                entry[1].close()
+            raise
+
+        if res.status_code == 304 and entry is not None:
+            headers, body = entry
+            res.raw.close()
+            res.status_code = 200
+            res.reason = "OK"
+            res.headers.pop("Content-Encoding", None)
+            res.headers.update(headers)
+            res.headers["Content-Length"] = str(body.size)
+            res.raw = body
+            self.cache.count(hit=True)
+            return res
+
+        if entry is not None:
+            entry[1].close()
+        self.cache.count(hit=False)
+        if res.status_code == 200 and ("ETag" in res.headers or "Last-Modified" in res.headers):
+            headers = {name: res.headers[name] for name in cached_headers if name in res.headers}
+            res.raw = _TeeBody(res.raw, self.cache.writer(key, headers))
+        return res
+
+
+def mount(session, cache, **kwargs):
+    """
+    Serve the requests of a session through a cache.
+
+    :param session: `requests.Session` object
+    :param cache: :py:class:`HttpCache` object
+    :param kwargs: arguments of the `requests.adapters.HTTPAdapter` constructor
+    :return: the session
+    """
+
+    adapter = CachingAdapter(cache, **kwargs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def install_github_cache(cache):
+    """
+    Serve the requests of PyGithub through a cache.
+
+    PyGithub allows replacing its connection classes only globally, all the
+    `Github` objects created afterwards share one session of the cache.
+
+    :param cache: :py:class:`HttpCache` object
+    """
+
+    from github.Requester import Requester, HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass
+
+    lock = threading.Lock()
+    sessions = {}
+
+    def get_session(retry, pool_size):
+        with lock:
+            if "session" not in sessions:
+                session = requests.Session()
+                session.auth = Requester.noopAuth
+                sessions["session"] = mount(session, cache, max_retries=retry, pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+            return sessions["session"]
+
+    class CachingConnectionMixin:
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session.close()
+            retry = getattr(self, "retry", requests.adapters.DEFAULT_RETRIES)
+            pool_size = getattr(self, "pool_size", requests.adapters.DEFAULT_POOLSIZE)
+            self.session = get_session(retry, pool_size)
+
+        def close(self):
+            # the session is shared and stays open
+            pass
+
+    Requester.injectConnectionClasses(
+        type("CachingHTTPConnection", (CachingConnectionMixin, HTTPRequestsConnectionClass), {}),
+        type("CachingHTTPSConnection", (CachingConnectionMixin, HTTPSRequestsConnectionClass), {}),
+    )
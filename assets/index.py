@@ -0,0 +1,198 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .cache import blob_sha
+
+
+class Index:
+    """
+    Persistent index of the parsed YAML files, ex. `meta.yml` and `manifest.yml`.
+
+    Files are looked up by path, modification time and size first, then by
+    their git blob SHA: a file is parsed only if its content was never seen
+    before, also when it's found in a fresh checkout. Documents are stored as
+    JSON, values without a JSON representation (ex. dates) become strings.
+    """
+
+    # bumped when the format of the stored documents changes
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript(f"""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS documents;
+                PRAGMA user_version = {self.version};
+            """)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                sha TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+        """)
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def extend_schema(self, script):
+        """
+        Create the tables of a user of the index, ex. `CREATE TABLE IF NOT EXISTS ...` statements.
+
+        :param script: SQL script, run at once
+        """
+
+        with self._lock:
+            self.db.executescript(script)
+
+    def execute(self, sql, params=()):
+        """
+        Run a single SQL statement.
+
+        :param sql: SQL statement
+        :param params: values of the statement placeholders
+        :return: list of the result rows
+        """
+
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def executemany(self, sql, seq_of_params):
+        """
+        Run a SQL statement for each set of values and commit.
+
+        :param sql: SQL statement
+        :param seq_of_params: iterable of values of the statement placeholders
+        """
+
+        with self._lock:
+            self.db.executemany(sql, seq_of_params)
+            self.db.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run many statements as one transaction, committed at the end or rolled back on error.
+
+        :return: context manager yielding the database connection, for the exclusive use of the caller
+        """
+
+        with self._lock:
+            try:
+                yield self.db
+            except BaseException:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def rebuild(self):
+        """
+        Drop all the indexed content, files are parsed again at the next access.
+        """
+
+        with self._lock:
+            tables = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+            for table, in tables:
+                self.db.execute(f"DELETE FROM {table}")
+            self.db.commit()
+
+    def prune(self):
+        """
+        Forget the files that no longer exist.
+
+        :return: number of forgotten files
+        """
+
+        with self._lock:
+            paths = [path for path, in self.db.execute("SELECT path FROM files")]
+        removed = [(path,) for path in paths if not os.path.exists(path)]
+        with self._lock:
+            self.db.executemany("DELETE FROM files WHERE path = ?", removed)
+            self.db.commit()
+        return len(removed)
+
+    def _parse(self, sha, content, path=None, st=None):
+        import yaml
+
+        with self._lock:
+            row = self.db.execute("SELECT data FROM documents WHERE sha = ?", (sha,)).fetchone()
+        if row:
+            data = row[0]
+            doc = json.loads(data)
+        else:
+            if callable(content):
+                content = content()
+            doc = yaml.load(content, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+            # the same document is returned whether it was parsed or found in the index
+            data = json.dumps(doc, default=str)
+            doc = json.loads(data)
+
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?)", (sha, data))
+            if path is not None:
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                (path, st.st_mtime_ns, st.st_size, sha))
+        return doc
+
+    def load_yaml(self, filename):
+        """
+        Get the parsed content of a YAML file.
+
+        :param filename: path of the YAML file
+        :return: same as `yaml.safe_load` of the file content
+        """
+
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+
+        with self._lock:
+            row = self.db.execute(
+                "SELECT data FROM files JOIN documents USING (sha) WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (path, st.st_mtime_ns, st.st_size)).fetchone()
+            if row:
+                self.hits += 1
+                return json.loads(row[0])
+
+        with open(path, "rb") as f:
+            content = f.read()
+        return self._parse(blob_sha(content), content, path, st)
+
+    def load_yaml_blob(self, sha, read):
+        """
+        Get the parsed content of a YAML git blob.
+
+        :param sha: git blob SHA of the blob
+        :param read: function returning the blob content, invoked only if the blob is not indexed
+        :return: same as `yaml.safe_load` of the blob content
+        """
+
+        return self._parse(sha, read)
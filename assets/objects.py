@@ -0,0 +1,218 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from collections import namedtuple
+
+from . import packed, walk, iter_local_assets, get_branch_dir
+
+Object = namedtuple("Object", ["branch", "package", "version", "type", "name"])
+
+
+def get_fields(mappings, prefix=""):
+    """
+    Traverse the field paths of a mappings definition, multi-fields included.
+
+    :param mappings: content of a `mappings` object
+    :return: generator yielding the dotted field paths, ex. 'process.pid'
+    """
+
+    for name, field in (mappings.get("properties") or {}).items():
+        if not isinstance(field, dict):
+            continue
+        path = prefix + name
+        yield path
+        yield from get_fields(field, path + ".")
+        for subname in field.get("fields") or {}:
+            yield f"{path}.{subname}"
+
+
+def _find_mappings(doc):
+    if isinstance(doc, dict):
+        for key, value in doc.items():
+            if key == "mappings" and isinstance(value, dict):
+                yield value
+            else:
+                yield from _find_mappings(value)
+    elif isinstance(doc, list):
+        for value in doc:
+            yield from _find_mappings(value)
+
+
+def get_objects(package, path):
+    """
+    Parse the objects dumped in an asset directory.
+
+    Objects are the JSON files in the subdirectories, their type is the name of
+    the subdirectory, ex. 'index_templates'.
+
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param path: path of the assets branch, ex. 'assets/production'
+    :return: generator yielding (type, name, fields) of each object
+    """
+
+    for asset in sorted(iter_local_assets(package, path)):
+        parts = asset.path.split("/")
+        if len(parts) < 4 or not asset.path.endswith(".json"):
+            continue
+        try:
+            doc = json.loads(asset.read())
+        except ValueError:
+            continue
+        name = (doc.get("name") or doc.get("id")) if isinstance(doc, dict) else None
+        fields = set()
+        for mappings in _find_mappings(doc):
+            fields.update(get_fields(mappings))
+        yield parts[2], name or Path(parts[-1]).stem, fields
+
+
+def _signature(branch, package, version):
+    # directories change when files are added, removed or replaced, meta.yml is written by every update
+    branch_dir = get_branch_dir(branch)
+    if packed.is_packed(branch_dir):
+        st = os.stat(packed.tree_filename(branch_dir, f"{package}/{version}"))
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+    asset_dir = branch_dir / package / version
+    h = hashlib.sha1()
+    for root, dirs, _ in os.walk(asset_dir):
+        dirs.sort()
+        st = os.stat(root)
+        h.update(f"{os.path.relpath(root, asset_dir)}\0{st.st_mtime_ns}\0".encode())
+    meta = asset_dir / "meta.yml"
+    if meta.exists():
+        st = os.stat(meta)
+        h.update(f"meta.yml\0{st.st_mtime_ns}\0{st.st_size}".encode())
+    return h.hexdigest()
+
+
+class ObjectIndex:
+    """
+    Inverted index of the dumped objects: type, name and mapped fields to package versions.
+
+    The index is kept in the database of an :py:class:`.index.Index` and updated
+    incrementally: only the asset directories added or changed since the last
+    update are parsed again.
+
+    :param index: :py:class:`.index.Index` object
+    """
+
+    def __init__(self, index):
+        self.index = index
+        index.extend_schema("""
+            CREATE TABLE IF NOT EXISTS asset_versions (
+                branch TEXT NOT NULL,
+                package TEXT NOT NULL,
+                version TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                PRIMARY KEY (branch, package, version)
+            );
+            CREATE TABLE IF NOT EXISTS asset_objects (
+                id INTEGER PRIMARY KEY,
+                branch TEXT NOT NULL,
+                package TEXT NOT NULL,
+                version TEXT NOT NULL,
+                type TEXT NOT NULL,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS asset_objects_version ON asset_objects (branch, package, version);
+            CREATE INDEX IF NOT EXISTS asset_objects_name ON asset_objects (name);
+            CREATE TABLE IF NOT EXISTS asset_fields (
+                object_id INTEGER NOT NULL,
+                field TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS asset_fields_field ON asset_fields (field);
+            CREATE INDEX IF NOT EXISTS asset_fields_object ON asset_fields (object_id);
+        """)
+
+    def _delete(self, db, branch, package, version):
+        db.execute("""DELETE FROM asset_fields WHERE object_id IN (
+                          SELECT id FROM asset_objects WHERE branch = ? AND package = ? AND version = ?)""",
+                   (branch, package, version))
+        db.execute("DELETE FROM asset_objects WHERE branch = ? AND package = ? AND version = ?",
+                   (branch, package, version))
+        db.execute("DELETE FROM asset_versions WHERE branch = ? AND package = ? AND version = ?",
+                   (branch, package, version))
+
+    def update_version(self, branch, package, version, signature=None):
+        """
+        Index the objects of one asset directory, replacing the previous ones.
+
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param package: package name, ex. 'endpoint'
+        :param version: package version, ex. '8.3.0'
+        """
+
+        if signature is None:
+            signature = _signature(branch, package, version)
+        objects = list(get_objects(f"{package}/{version}", get_branch_dir(branch)))
+
+        with self.index.transaction() as db:
+            self._delete(db, branch, package, version)
+            for type, name, fields in objects:
+                cursor = db.execute("INSERT INTO asset_objects (branch, package, version, type, name) "
+                                    "VALUES (?, ?, ?, ?, ?)", (branch, package, version, type, name))
+                db.executemany("INSERT INTO asset_fields VALUES (?, ?)",
+                               ((cursor.lastrowid, field) for field in sorted(fields)))
+            db.execute("INSERT INTO asset_versions VALUES (?, ?, ?, ?)", (branch, package, version, signature))
+
+    def update(self):
+        """
+        Bring the index up to date with the local assets.
+
+        :return: (updated, removed) number of asset directories
+        """
+
+        indexed = {(b, p, v): s for b, p, v, s in self.index.execute("SELECT * FROM asset_versions")}
+
+        updated = 0
+        for branch, package, version in walk():
+            signature = _signature(branch, package, version)
+            if indexed.pop((branch, package, version), None) != signature:
+                self.update_version(branch, package, version, signature)
+                updated += 1
+
+        with self.index.transaction() as db:
+            for branch, package, version in indexed:
+                self._delete(db, branch, package, version)
+        return updated, len(indexed)
+
+    def query(self, type=None, name=None, field=None, branch=None, package=None):
+        """
+        Look up the objects, all the given criteria must match.
+
+        :param type: object type, ex. 'index_templates'
+        :param name: object name, shell-style wildcards allowed
+        :param field: mapped field path, shell-style wildcards allowed
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param package: package name, ex. 'endpoint'
+        :return: list of :py:class:`Object`
+        """
+
+        sql = "SELECT DISTINCT o.branch, o.package, o.version, o.type, o.name FROM asset_objects o"
+        where = []
+        params = []
+        if field is not None:
+            sql += " JOIN asset_fields f ON f.object_id = o.id"
+            where.append("f.field GLOB ?" if _is_glob(field) else "f.field = ?")
+            params.append(field)
+        if name is not None:
+            where.append("o.name GLOB ?" if _is_glob(name) else "o.name = ?")
+            params.append(name)
+        for column, value in (("type", type), ("branch", branch), ("package", package)):
+            if value is not None:
+                where.append(f"o.{column} = ?")
+                params.append(value)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY o.branch, o.package, o.version, o.type, o.name"
+
+        return [Object(*row) for row in self.index.execute(sql, params)]
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
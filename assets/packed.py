@@ -0,0 +1,187 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+# Packed storage of the asset branches: each distinct file content is stored
+# once in a content-addressed blob store, each version as a tree file listing
+# its files, one `<sha> <size> <path>` line each.
+#
+#   <branch>/.objects/<sha[:2]>/<sha[2:]>
+#   <branch>/<package>/<version>.tree
+
+import os
+import shutil
+from pathlib import Path
+
+from .cache import file_blob_sha, link_or_copy
+
+objects_dir = ".objects"
+tree_suffix = ".tree"
+
+
+def is_packed(path):
+    """
+    :param path: path of an assets branch, ex. 'assets/production'
+    :return: True if the branch is in packed format
+    """
+
+    return os.path.isdir(os.path.join(path, objects_dir))
+
+
+def blob_filename(path, sha):
+    return Path(path) / objects_dir / sha[:2] / sha[2:]
+
+
+def tree_filename(path, package):
+    """
+    :param path: path of a packed assets branch
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    """
+
+    return Path(path) / f"{package}{tree_suffix}"
+
+
+def read_tree(path, package):
+    """
+    Read the tree file of a packed version.
+
+    :param path: path of a packed assets branch
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :return: list of (sha, size, path) of the files of the version
+    :raise FileNotFoundError: if the version is not found
+    """
+
+    entries = []
+    with open(tree_filename(path, package)) as f:
+        for line in f:
+            sha, size, name = line.rstrip("\n").split(" ", 2)
+            entries.append((sha, int(size), name))
+    return entries
+
+
+def iter_versions(path, package):
+    """
+    :param path: path of a packed assets branch
+    :param package: package name, ex. 'endpoint'
+    :return: generator yielding the versions of the package
+    """
+
+    for entry in os.scandir(Path(path) / package):
+        if entry.name.endswith(tree_suffix):
+            yield entry.name[:-len(tree_suffix)]
+
+
+def pack_version(path, package):
+    """
+    Move the files of a version directory to the blob store and replace the directory with its tree file.
+
+    :param path: path of a packed assets branch
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    """
+
+    asset_dir = Path(path) / package
+    entries = []
+    for root, _, files in os.walk(asset_dir):
+        for file in files:
+            filename = Path(root) / file
+            sha = file_blob_sha(filename)
+            blob = blob_filename(path, sha)
+            if not blob.exists():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(filename, blob)
+                os.chmod(blob, 0o444)
+            entries.append((sha, os.stat(blob).st_size, filename.relative_to(asset_dir).as_posix()))
+
+    tree = tree_filename(path, package)
+    tmp = tree.with_name(f"{tree.name}.{os.getpid()}.part")
+    with open(tmp, "w") as f:
+        for sha, size, name in sorted(entries, key=lambda entry: entry[2]):
+            f.write(f"{sha} {size} {name}\n")
+    os.replace(tmp, tree)
+    shutil.rmtree(asset_dir)
+
+
+def unpack_version(path, package, dest=None, ignore=()):
+    """
+    Write the files of a packed version to a directory.
+
+    :param path: path of a packed assets branch
+    :param package: name and version of the package, ex. 'endpoint/8.3.0'
+    :param dest: destination directory, if not given the version directory
+                 is restored in place and its tree file removed
+    :param ignore: paths of the files not to write, ex. 'meta.yml'
+    """
+
+    asset_dir = Path(dest) if dest is not None else Path(path) / package
+    for sha, _, name in read_tree(path, package):
+        if name in ignore:
+            continue
+        filename = asset_dir / name
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # files are copied, blobs are read-only and shared by all the versions
+        shutil.copyfile(blob_filename(path, sha), filename)
+    if dest is None:
+        tree_filename(path, package).unlink()
+
+
+def _packages(path):
+    for entry in os.scandir(path):
+        if entry.is_dir() and not entry.name.startswith("."):
+            yield entry.name
+
+
+def prune(path):
+    """
+    Remove the blobs not referenced by any tree file.
+
+    :param path: path of a packed assets branch
+    :return: number of removed blobs
+    """
+
+    used = set()
+    for package in _packages(path):
+        for version in iter_versions(path, package):
+            used.update(sha for sha, _, _ in read_tree(path, f"{package}/{version}"))
+
+    removed = 0
+    for subdir in os.scandir(Path(path) / objects_dir):
+        for blob in os.scandir(subdir.path):
+            if subdir.name + blob.name not in used:
+                os.unlink(blob.path)
+                removed += 1
+    return removed
+
+
+def pack_branch(path):
+    """
+    Convert an assets branch to the packed format, already packed versions are left alone.
+
+    :param path: path of the assets branch, ex. 'assets/production'
+    :return: number of packed versions
+    """
+
+    (Path(path) / objects_dir).mkdir(exist_ok=True)
+    count = 0
+    for package in _packages(path):
+        for entry in list(os.scandir(Path(path) / package)):
+            if entry.is_dir():
+                pack_version(path, f"{package}/{entry.name}")
+                count += 1
+    return count
+
+
+def unpack_branch(path):
+    """
+    Convert a packed assets branch back to one directory per version.
+
+    :param path: path of the packed assets branch, ex. 'assets/production'
+    :return: number of unpacked versions
+    """
+
+    count = 0
+    for package in _packages(path):
+        for version in list(iter_versions(path, package)):
+            unpack_version(path, f"{package}/{version}")
+            count += 1
+    shutil.rmtree(Path(path) / objects_dir)
+    return count
@@ -0,0 +1,591 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import time
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import packed, branches, walk, iter_local_assets, get_branch_dir, _get_subtree_assets, _make_session, _fetch
+from .cache import blob_sha, file_blob_sha
+
+# responses smaller than this are not compressed
+gzip_min_size = 1024
+
+# packages of a branch by name, with the SHA of their trees
+Listing = namedtuple("Listing", ["generation", "sha", "packages"])
+# entries of a package by path, in git tree order, also grouped by version
+Package = namedtuple("Package", ["sha", "entries", "versions"])
+
+
+def _index_package(sha, entries):
+    entries = dict(sorted(entries.items()))
+    versions = {}
+    for path, entry in entries.items():
+        versions.setdefault(path.split("/")[1], []).append((path, entry))
+    return Package(sha, entries, versions)
+
+
+def _git_order(names):
+    # trees sort as if their names ended with a slash
+    return sorted(names, key=lambda name: name + "/")
+
+
+class Response:
+    """
+    Response kept in the memory cache, compressed once if worth it.
+    """
+
+    def __init__(self, body, content_type, etag=None, compress=True):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag or hashlib.sha1(body).hexdigest()
+        self.gzip_body = gzip.compress(body, 6) if compress and len(body) >= gzip_min_size else None
+        if self.gzip_body is not None and len(self.gzip_body) >= len(body):
+            self.gzip_body = None
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzip_body or b"")
+
+
+class LRUCache:
+    """
+    In-memory cache evicting the least recently used items once their total size exceeds `max_size` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, item):
+        with self._lock:
+            if item.size > self.max_size:
+                return
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._items[key] = item
+            self.size += item.size
+            while self.size > self.max_size:
+                _, old = self._items.popitem(last=False)
+                self.size -= old.size
+
+
+class LocalBackend:
+    """
+    Assets of the local branches, packed or not.
+
+    The SHA of a package changes whenever one of its files is added, removed or modified.
+
+    :param ttl: seconds the listing of a branch is reused before looking at the disk again
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._listings = {}
+        self._packages = {}
+        self._shas = {}
+        self._lock = threading.Lock()
+
+    def listing(self, branch):
+        """
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :return: :py:class:`Listing` of the packages of the branch
+        """
+
+        with self._lock:
+            listing = self._listings.get(branch)
+        if listing is not None and time.monotonic() - listing.generation < self.ttl:
+            return listing
+
+        entries = {}
+        if branch in branches:
+            branch_dir = get_branch_dir(branch)
+            for asset_branch, package, version in walk():
+                if asset_branch == branch:
+                    for asset in iter_local_assets(f"{package}/{version}", branch_dir):
+                        entries.setdefault(package, {})[asset.path] = asset
+
+        packages = {}
+        for name, package_entries in entries.items():
+            h = hashlib.sha1()
+            for path, asset in sorted(package_entries.items()):
+                # blobs of packed branches are named by content, files are checked by modification time
+                h.update(f"{path}\0{asset.filename}\0{asset.size}\0{os.stat(asset.filename).st_mtime_ns}\0".encode())
+            packages[name] = _index_package(h.hexdigest(), package_entries)
+        sha = hashlib.sha1("".join(f"{name}\0{packages[name].sha}\0" for name in sorted(packages)).encode())
+        listing = Listing(time.monotonic(), sha.hexdigest(), {name: package.sha for name, package in packages.items()})
+        with self._lock:
+            self._listings[branch] = listing
+            self._packages[branch] = packages
+        return listing
+
+    def package(self, branch, name):
+        """
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param name: package name, ex. 'endpoint'
+        :return: :py:class:`Package` of :py:class:`assets.LocalAsset` or None if not found
+        """
+
+        self.listing(branch)
+        with self._lock:
+            return self._packages.get(branch, {}).get(name)
+
+    def sha(self, branch, entry):
+        if packed.is_packed(get_branch_dir(branch)):
+            return entry.filename.parent.name + entry.filename.name
+        st = os.stat(entry.filename)
+        with self._lock:
+            cached = self._shas.get(entry.filename)
+        if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+            return cached[1]
+        sha = file_blob_sha(entry.filename)
+        with self._lock:
+            self._shas[entry.filename] = ((st.st_mtime_ns, st.st_size), sha)
+        return sha
+
+    def read(self, branch, entry):
+        return entry.read()
+
+
+class UpstreamBackend:
+    """
+    Assets of a GitHub repository, fetched as they are requested.
+
+    The packages of a branch are found in its top tree, the entries of each
+    package are listed only when requested, with one recursive request of the
+    package tree. Recursive listings of whole branches are truncated by GitHub
+    and not used, package trees too large for one request are listed with the
+    contents API.
+
+    :param repo: repository object of the assets
+    :param cache: optional :py:class:`.cache.BlobCache`, filled with the fetched assets
+    :param ttl: seconds the listing of a branch is reused before asking the upstream again
+    :param retries: retries of each download on transient failures
+    """
+
+    def __init__(self, repo, cache=None, ttl=300, retries=3):
+        self.repo = repo
+        self.cache = cache
+        self.ttl = ttl
+        self.retries = retries
+        self._listings = {}
+        self._packages = {}
+        self._lock = threading.Lock()
+        self._session = _make_session(16)
+
+    def _get_tree(self, sha, recursive=False):
+        from github import GithubException
+
+        try:
+            return self.repo.get_git_tree(sha, recursive=recursive)
+        except GithubException:
+            return None
+
+    def listing(self, branch):
+        """
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :return: :py:class:`Listing` of the packages of the branch
+        """
+
+        with self._lock:
+            listing = self._listings.get(branch)
+        if listing is not None and time.monotonic() - listing.generation < self.ttl:
+            return listing
+
+        tree = self._get_tree(branch)
+        packages = {}
+        for element in tree.tree if tree is not None else []:
+            if element.type == "tree" and not element.path.startswith("."):
+                packages[element.path] = element.sha
+        listing = Listing(time.monotonic(), tree.sha if tree is not None else None, packages)
+        with self._lock:
+            self._listings[branch] = listing
+        return listing
+
+    def package(self, branch, name):
+        """
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param name: package name, ex. 'endpoint'
+        :return: :py:class:`Package` of :py:class:`assets.RemoteEntry` or None if not found
+        """
+
+        sha = self.listing(branch).packages.get(name)
+        if sha is None:
+            return None
+        with self._lock:
+            package = self._packages.get((branch, name))
+        if package is not None and package.sha == sha:
+            return package
+
+        subtree = self._get_tree(sha, recursive=True)
+        if subtree is None:
+            return None
+        entries = {entry.path: entry for entry in _get_subtree_assets(name, self.repo, branch, subtree)}
+        package = _index_package(sha, entries)
+        with self._lock:
+            self._packages[(branch, name)] = package
+        return package
+
+    def sha(self, branch, entry):
+        return entry.sha
+
+    def read(self, branch, entry):
+        if self.cache is not None:
+            content = self.cache.read(entry.sha)
+            if content is not None:
+                return content
+        content = _fetch(self._session, entry.download_url, lambda res: res.content, self.retries, 0.5)
+        if self.cache is not None:
+            self.cache.put_data(entry.sha, content)
+        return content
+
+
+class _ChunkedWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "package-assets"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = parse_qs(url.query)
+        try:
+            response = self.server.route(parts, query, self.base_url)
+        except Exception as e:
+            self.send_error(502, explain=str(e))
+            return
+        if response is None:
+            self.send_json_error(404, "Not Found")
+        elif callable(response):
+            self.send_stream(response)
+        elif isinstance(response, tuple):
+            self.send_response(response[0])
+            self.send_header("Location", response[1])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send(response)
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host') or '%s:%d' % self.server.server_address[:2]}"
+
+    def send(self, response):
+        etag = f'"{response.etag}"'
+        if etag in (self.headers.get("If-None-Match") or ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = response.body
+        gzipped = response.gzip_body is not None and "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if gzipped:
+            body = response.gzip_body
+        self.send_response(200)
+        self.send_header("Content-Type", response.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, write):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        writer = _ChunkedWriter(self.wfile)
+        try:
+            write(writer)
+            writer.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client read what it needed, ex. the members of a single package
+            self.close_connection = True
+
+    def send_json_error(self, status, message):
+        body = json.dumps({"message": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AssetServer(ThreadingHTTPServer):
+    """
+    HTTP server of the assets, responses are kept in an in-memory LRU cache.
+
+    The GitHub API endpoints used to list the assets and the raw file endpoint
+    are emulated, clients set their GitHub API base URL to `<server>/api` and
+    the raw base URL to `<server>/raw`:
+
+    - `/api/repos/<repo>`
+    - `/api/repos/<repo>/git/trees/<branch>?recursive=1`, also `<branch>:<path>` for a subtree
+    - `/api/repos/<repo>/contents/<path>?ref=<branch>`
+    - `/api/repos/<repo>/tarball/<branch>`, redirect to `/archive/<branch>.tar.gz`
+    - `/raw/<repo>/<branch>/<path>`
+
+    Archives of whole versions are at `/archive/<branch>/<package>/<version>.tar.gz`,
+    their members are in a single top directory as in the GitHub tarballs.
+
+    :param address: (host, port) to listen on
+    :param backend: :py:class:`LocalBackend` or :py:class:`UpstreamBackend`
+    :param memory: size of the in-memory cache, in bytes
+    :param repo: full name of the emulated repository
+    :param verbose: log each request to stderr
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, backend, memory=256 << 20, repo="elastic/package-assets", verbose=False):
+        super().__init__(address, Handler)
+        self.backend = backend
+        self.cache = LRUCache(memory)
+        self.repo = repo
+        self.verbose = verbose
+
+    def cached(self, key, make):
+        response = self.cache.get(key)
+        if response is None:
+            response = make()
+            if response is not None:
+                self.cache.put(key, response)
+        return response
+
+    def route(self, parts, query, base_url):
+        repo = self.repo.split("/")
+        if parts[:1] == ["raw"] and parts[1:3] == repo and len(parts) > 4:
+            return self.raw(parts[3], "/".join(parts[4:]))
+
+        if parts[:2] == ["api", "repos"] and parts[2:4] == repo:
+            rest = parts[4:]
+            if not rest:
+                return self.cached(("repo", base_url), lambda: self.repository(base_url))
+            if rest[:2] == ["git", "trees"] and len(rest) == 3:
+                return self.tree(rest[2], base_url)
+            if rest[:1] == ["contents"]:
+                ref = (query.get("ref") or ["production"])[0]
+                return self.contents(ref, "/".join(rest[1:]).strip("/"), base_url)
+            if rest[:1] == ["tarball"] and len(rest) == 2:
+                return 302, f"{base_url}/archive/{quote(rest[1])}.tar.gz"
+
+        if parts[:1] == ["archive"] and parts[-1].endswith(".tar.gz"):
+            parts[-1] = parts[-1][:-len(".tar.gz")]
+            if len(parts) == 2:
+                return self.archive(parts[1])
+            if len(parts) == 4:
+                return self.version_archive(*parts[1:])
+
+    def _package_sha(self, branch, path):
+        return self.backend.listing(branch).packages.get(path.split("/", 1)[0])
+
+    def _entries(self, branch, listing):
+        # all the entries of a branch in git tree order, the packages are listed as they are reached
+        for name in _git_order(listing.packages):
+            package = self.backend.package(branch, name)
+            if package is not None:
+                yield from package.entries.items()
+
+    def raw(self, branch, path):
+        sha = self._package_sha(branch, path)
+        if sha is None:
+            return None
+
+        def make():
+            package = self.backend.package(branch, path.split("/", 1)[0])
+            entry = package.entries.get(path) if package else None
+            if entry is not None:
+                content = self.backend.read(branch, entry)
+                return Response(content, "text/plain; charset=utf-8", blob_sha(content))
+
+        # contents are read again once their package changes
+        return self.cached(("raw", branch, path, sha), make)
+
+    def _json(self, doc):
+        return Response(json.dumps(doc).encode(), "application/json; charset=utf-8")
+
+    def repository(self, base_url):
+        owner, name = self.repo.split("/")
+        return self._json({
+            "name": name,
+            "full_name": self.repo,
+            "owner": {"login": owner},
+            "url": f"{base_url}/api/repos/{self.repo}",
+            "default_branch": "main",
+        })
+
+    def _item(self, kind, branch, path, base_url, entry=None):
+        sha = self.backend.sha(branch, entry) if entry else None
+        return {
+            "type": kind,
+            "name": path.rsplit("/", 1)[-1],
+            "path": path,
+            "sha": sha,
+            "size": entry.size if entry else 0,
+            "url": f"{base_url}/api/repos/{self.repo}/contents/{quote(path)}?ref={quote(branch)}",
+            "download_url": f"{base_url}/raw/{self.repo}/{quote(branch)}/{quote(path, safe='/@')}" if entry else None,
+        }
+
+    def tree(self, ref, base_url):
+        # `<branch>:<path>` lists only the subtree, with paths relative to it
+        branch, _, subtree = ref.partition(":")
+        prefix = f"{subtree.strip('/')}/" if subtree.strip("/") else ""
+        listing = self.backend.listing(branch)
+        sha = self._package_sha(branch, prefix) if prefix else listing.sha
+        if sha is None:
+            return None
+
+        def make():
+            if prefix:
+                package = self.backend.package(branch, prefix.split("/", 1)[0])
+                entries = [(path, entry) for path, entry in (package.entries.items() if package else [])
+                           if path.startswith(prefix)]
+            else:
+                entries = list(self._entries(branch, listing))
+            if not entries:
+                return None
+
+            tree = []
+            for path, entry in entries:
+                item = self._item("blob", branch, path, base_url, entry)
+                tree.append(dict(item, path=path[len(prefix):], mode="100644",
+                                 url=f"{base_url}/api/repos/{self.repo}/git/blobs/{item['sha']}"))
+            return self._json({"sha": ref, "url": f"{base_url}/api/repos/{self.repo}/git/trees/{quote(ref, safe='')}",
+                               "tree": tree, "truncated": False})
+
+        return self.cached(("tree", ref, base_url, sha), make)
+
+    def contents(self, branch, path, base_url):
+        listing = self.backend.listing(branch)
+        if not path:
+            def make():
+                items = [self._item("dir", branch, name, base_url) for name in sorted(listing.packages)]
+                return self._json(items) if items else None
+
+            return self.cached(("contents", branch, path, base_url, listing.sha), make)
+
+        sha = self._package_sha(branch, path)
+        if sha is None:
+            return None
+
+        def make():
+            package = self.backend.package(branch, path.split("/", 1)[0])
+            entries = package.entries if package else {}
+            if path in entries:
+                return self._json(self._item("file", branch, path, base_url, entries[path]))
+
+            prefix = f"{path}/"
+            items = {}
+            for entry_path, entry in entries.items():
+                if entry_path.startswith(prefix):
+                    name = entry_path[len(prefix):].split("/", 1)[0]
+                    if prefix + name == entry_path:
+                        items[name] = self._item("file", branch, entry_path, base_url, entry)
+                    elif name not in items:
+                        items[name] = self._item("dir", branch, prefix + name, base_url)
+            if items:
+                return self._json([items[name] for name in sorted(items)])
+
+        return self.cached(("contents", branch, path, base_url, sha), make)
+
+    def _write_tar(self, f, branch, contents):
+        import io
+        import tarfile
+
+        with tarfile.open(fileobj=f, mode="w|gz") as tar:
+            for path, content in contents:
+                info = tarfile.TarInfo(f"package-assets-{branch}/{path}")
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+
+    def _read_ahead(self, branch, entries, workers=8):
+        # read a few entries ahead of the one being written, in order
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            for path, entry in entries:
+                pending.append((path, executor.submit(self.backend.read, branch, entry)))
+                if len(pending) > 2 * workers:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def version_archive(self, branch, package, version):
+        import io
+
+        sha = self._package_sha(branch, package)
+        if sha is None:
+            return None
+
+        def make():
+            listed = self.backend.package(branch, package)
+            entries = listed.versions.get(version) if listed else None
+            if not entries:
+                return None
+            f = io.BytesIO()
+            self._write_tar(f, branch, ((path, self.raw(branch, path).body) for path, _ in entries))
+            return Response(f.getvalue(), "application/gzip", compress=False)
+
+        return self.cached(("archive", branch, package, version, sha), make)
+
+    def archive(self, branch):
+        listing = self.backend.listing(branch)
+        if not listing.packages:
+            return None
+        # whole branches are streamed, members are in git tree order as in the GitHub tarballs; their
+        # contents are read from the backend, not through the cache of the responses
+        return lambda f: self._write_tar(f, branch, self._read_ahead(branch, self._entries(branch, listing)))
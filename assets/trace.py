@@ -0,0 +1,138 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# active tracer, spans are not recorded if None
+tracer = None
+
+
+def span(name, **args):
+    """
+    Time a stage with the active tracer, if any.
+
+    :param name: name of the stage, spans of the same name are summarized together
+    :param args: attributes of the span, numeric ones are summed in the summary
+    :return: context manager yielding the `args` dictionary, counters can be added to it
+    """
+
+    if tracer is None:
+        return nullcontext(args)
+    return tracer.span(name, **args)
+
+
+class Tracer:
+    """
+    Record the wall time and the counters of the stages of a run.
+
+    With `format="jsonl"` each span is written to `path` as a JSON line as soon
+    as it completes, with `format="chrome"` all the spans are written at close
+    in the Trace Event Format loaded by `chrome://tracing` and Perfetto.
+
+    :param path: optional file the trace is written to
+    :param format: one among 'jsonl', 'chrome'
+    """
+
+    formats = ("jsonl", "chrome")
+
+    def __init__(self, path=None, format="jsonl"):
+        if format not in self.formats:
+            raise ValueError(f"Unknown trace format: {format}")
+        self.path = path
+        self.format = format
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._file = open(path, "w") if path and format == "jsonl" else None
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            args["error"] = str(e) or repr(e)
+            raise
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "start": round(start - self._origin, 6),
+                "duration": round(end - start, 6),
+                "thread": threading.current_thread().name,
+                "tid": threading.get_ident(),
+                "args": {k: v if isinstance(v, (int, float, str, bool)) or v is None else str(v)
+                         for k, v in args.items()},
+            }
+            with self._lock:
+                self.events.append(event)
+                if self._file is not None:
+                    self._file.write(json.dumps(event) + "\n")
+                    self._file.flush()
+
+    def summary(self):
+        """
+        Summarize the spans by name.
+
+        :return: list of (name, count, seconds, counters) in order of first completion
+        """
+
+        stages = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            count, seconds, counters = stages.get(event["name"], (0, 0.0, {}))
+            for k, v in event["args"].items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    counters[k] = counters.get(k, 0) + v
+            stages[event["name"]] = (count + 1, seconds + event["duration"], counters)
+        return [(name, *stage) for name, stage in stages.items()]
+
+    def format_summary(self):
+        """
+        Format the summary as a table.
+
+        :return: list of lines
+        """
+
+        summary = self.summary()
+        width = max([len("stage")] + [len(name) for name, *_ in summary])
+        lines = [f"{'stage':<{width}} {'count':>7} {'seconds':>10}  counters"]
+        for name, count, seconds, counters in summary:
+            counters = ", ".join(f"{k}={v:g}" if isinstance(v, float) else f"{k}={v}" for k, v in counters.items())
+            lines.append(f"{name:<{width}} {count:>7} {seconds:>10.3f}  {counters}".rstrip())
+        return lines
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif self.path and self.format == "chrome":
+            pid = os.getpid()
+            events = [{
+                "name": event["name"],
+                "ph": "X",
+                "ts": int(event["start"] * 1e6),
+                "dur": int(event["duration"] * 1e6),
+                "pid": pid,
+                "tid": event["tid"],
+                "args": event["args"],
+            } for event in self.events]
+            threads = {event["tid"]: event["thread"] for event in self.events}
+            events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                       for tid, name in threads.items()]
+            with open(self.path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,201 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from . import trace, iter_local_assets, get_branch_dir
+
+# checksums of all the other files of a version, in `sha256sum` format
+checksums_file = "checksums.sha256"
+
+
+def file_sha256(filename, chunk_size=64 * 1024):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_checksums(asset_dir):
+    """
+    Write the checksum manifest of an asset directory.
+
+    :param asset_dir: path of the asset directory, ex. 'assets/production/endpoint/8.3.0'
+    """
+
+    asset_dir = Path(asset_dir)
+    paths = []
+    for root, _, files in os.walk(asset_dir):
+        for file in files:
+            paths.append((Path(root) / file).relative_to(asset_dir).as_posix())
+    with open(asset_dir / checksums_file, "w") as f:
+        for path in sorted(paths):
+            if path != checksums_file:
+                f.write(f"{file_sha256(asset_dir / path)}  {path}\n")
+
+
+def parse_checksums(content):
+    """
+    :param content: content of a checksum manifest
+    :return: dictionary of file path to SHA-256 hex digest
+    """
+
+    checksums = {}
+    for line in content.decode().splitlines():
+        if line:
+            sha, path = line.split("  ", 1)
+            checksums[path] = sha
+    return checksums
+
+
+def check_file(filename, is_json):
+    """
+    Hash a file and, if it's JSON, validate its content.
+
+    :param filename: path of the file
+    :param is_json: parse the file as JSON
+    :return: (sha256, error) where error is None if the file is valid
+    """
+
+    with open(filename, "rb") as f:
+        content = f.read()
+    error = None
+    if is_json:
+        try:
+            json.loads(content)
+        except ValueError as e:
+            error = f"invalid JSON: {e}"
+    return hashlib.sha256(content).hexdigest(), error
+
+
+def _check_files(files):
+    return [check_file(filename, is_json) for filename, is_json in files]
+
+
+class Verifier:
+    """
+    Verify the local assets against their checksum manifests and validate their JSON files.
+
+    Files are hashed and parsed in a pool of processes. With an index, the
+    results are remembered by path, modification time and size: at the next
+    verification only the changed files are hashed again.
+
+    :param index: optional :py:class:`.index.Index` object
+    :param workers: number of processes, all the available cores if None
+    """
+
+    def __init__(self, index=None, workers=None):
+        self.index = index
+        self.workers = workers or os.cpu_count()
+        self.hashed = 0
+        if index is not None:
+            index.extend_schema("""
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    error TEXT
+                );
+            """)
+
+    def _lookup(self, filename, st):
+        rows = self.index.execute("SELECT sha256, error FROM checksums WHERE path = ? AND mtime_ns = ? AND size = ?",
+                                  (str(filename), st.st_mtime_ns, st.st_size))
+        return rows[0] if rows else None
+
+    def _store(self, files, results):
+        self.index.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+                               ((str(filename), st.st_mtime_ns, st.st_size, sha, error)
+                                for (filename, st), (sha, error) in zip(files, results)))
+
+    def prune(self):
+        """
+        Forget the checksums of the files that no longer exist.
+
+        :return: number of forgotten files
+        """
+
+        paths = [path for path, in self.index.execute("SELECT path FROM checksums")]
+        removed = [(path,) for path in paths if not os.path.exists(path)]
+        self.index.executemany("DELETE FROM checksums WHERE path = ?", removed)
+        return len(removed)
+
+    def _prepare(self, branch, package, version):
+        # look up the files in the index, the others need to be checked
+        package = f"{package}/{version}"
+        files = {}
+        known = {}
+        todo = []
+        for asset in iter_local_assets(package, get_branch_dir(branch)):
+            path = asset.path[len(package) + 1:]
+            files[path] = filename = os.path.abspath(asset.filename)
+            st = os.stat(filename)
+            row = self._lookup(filename, st) if self.index is not None else None
+            if row:
+                known[path] = row
+            else:
+                todo.append((path, filename, st))
+        return files, known, todo
+
+    def verify(self, versions):
+        """
+        Verify some asset versions.
+
+        :param versions: iterable of (branch, package, version)
+        :return: generator yielding (branch, package, version, problems) in
+                 the same order, `problems` lists all the problems found
+        """
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        versions = list(versions)
+        prepared = [self._prepare(*version) for version in versions]
+        batches = [[(filename, path.endswith(".json")) for path, filename, _ in todo] for _, _, todo in prepared]
+
+        # no processes are started if all the files are known
+        executor = ProcessPoolExecutor(self.workers) if any(batches) else None
+        futures = [executor.submit(_check_files, batch) for batch in batches] if executor else []
+        try:
+            all_results = (future.result() for future in futures) if executor else map(_check_files, batches)
+            for (branch, package, version), (files, known, todo), results in zip(versions, prepared, all_results):
+                with trace.span("verify", package=package, branch=branch, version=version) as span:
+                    span["files"] = len(files)
+                    span["hashed"] = len(todo)
+                    self.hashed += len(todo)
+                    if self.index is not None and todo:
+                        self._store([(filename, st) for _, filename, st in todo], results)
+                    checked = {**known, **{path: result for (path, _, _), result in zip(todo, results)}}
+                    problems = _problems(f"assets/{branch}/{package}/{version}/", files, checked)
+                yield branch, package, version, problems
+        finally:
+            for future in futures:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown()
+
+
+def _problems(prefix, files, checked):
+    problems = [f"Invalid file: {prefix}{path}: {error}" for path, (_, error) in sorted(checked.items()) if error]
+    if checksums_file not in files:
+        return problems
+
+    with open(files[checksums_file], "rb") as f:
+        try:
+            checksums = parse_checksums(f.read())
+        except ValueError as e:
+            return problems + [f"Invalid file: {prefix}{checksums_file}: {e}"]
+    for path, expected in sorted(checksums.items()):
+        if path not in checked:
+            problems.append(f"Missing file: {prefix}{path}")
+        elif checked[path][0] != expected:
+            problems.append(f"Checksum mismatch: {prefix}{path}")
+    for path in sorted(checked):
+        if path != checksums_file and path not in checksums:
+            problems.append(f"Unexpected file: {prefix}{path}")
+    return problems
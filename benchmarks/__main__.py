@@ -0,0 +1,256 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import time
+import yaml
+import click
+import platform
+import threading
+from pathlib import Path
+from functools import partial
+from types import SimpleNamespace
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import assets
+import packages
+import bot.__main__ as bot
+from .trees import make_trees, make_package, get_package
+
+baseline_file = Path(__file__).parent / "baseline.json"
+# differences below this many seconds are considered noise
+noise = 0.05
+cases = {}
+
+
+def case(fn):
+    cases[fn.__name__] = fn
+    return fn
+
+
+@case
+def walk(env):
+    for _ in assets.walk():
+        pass
+
+
+@case
+def get_meta(env):
+    for branch, package, version in assets.walk():
+        assets.get_meta(branch, package, version)
+
+
+@case
+def get_meta_index(env):
+    for branch, package, version in assets.walk():
+        assets.get_meta(branch, package, version, index=env.index)
+
+
+@case
+def get_manifest(env):
+    for branch, package, version in packages.walk():
+        packages.get_manifest(branch, package, version)
+
+
+@case
+def make_plan(env):
+    for _ in bot.make_plan(None, packages.CheckoutSource()):
+        pass
+
+
+@case
+def bot_meta(env):
+    from click.testing import CliRunner
+
+    result = CliRunner().invoke(bot.cli, ["--config", str(env.config_file), "--index", "", "meta"])
+    if result.exit_code:
+        raise RuntimeError(result.output)
+
+
+@case
+def get_local_assets(env):
+    for _ in assets.get_local_assets(env.package, env.package_root):
+        pass
+
+
+@case
+def read_local_assets(env):
+    for _ in assets.read_local_assets(env.package, env.package_root):
+        pass
+
+
+@case
+def download_assets(env):
+    for _ in assets.download_assets(env.entries, workers=8):
+        pass
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def setup(work_dir, packages_count, versions, files, file_size):
+    from assets.index import Index
+    from bot.config import load
+
+    env = SimpleNamespace()
+    assets.assets_dir, packages.packages_dir = make_trees(work_dir, packages_count, versions)
+    env.package_root, env.package = make_package(work_dir, files, file_size)
+
+    env.config_file = Path(work_dir) / "config.yaml"
+    tracked = [{get_package(p): {"minimum-version": "1.1.0"}} for p in range(packages_count)]
+    env.config_file.write_text(yaml.dump({"tracked-packages": tracked}))
+    bot.config = load(env.config_file)
+    bot.index = None
+
+    # warm the index, only the lookups are timed
+    env.index = Index(Path(work_dir) / "index.sqlite")
+    for branch, package, version in assets.walk():
+        assets.get_meta(branch, package, version, index=env.index)
+
+    env.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(env.package_root)))
+    threading.Thread(target=env.server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{env.server.server_port}"
+    env.entries = [assets.RemoteEntry(asset.path, None, asset.size, f"{url}/{asset.path}")
+                   for asset in assets.iter_local_assets(env.package, env.package_root)]
+    return env
+
+
+def teardown(env):
+    env.server.shutdown()
+    env.server.server_close()
+    env.index.close()
+
+
+def calibrate(repeat=3):
+    """
+    Time a fixed amount of pure Python work, the results are compared in units of it.
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sum(i * i for i in range(1000000))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_cases(env, names, repeat):
+    results = {}
+    for name in names:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cases[name](env)
+            times.append(time.perf_counter() - start)
+        results[name] = min(times)
+    return results
+
+
+def compare(results, calibration, baseline, tolerance):
+    """
+    Compare the results with the baseline ones, scaled by the ratio of the calibrations.
+
+    :return: generator yielding (name, seconds, expected seconds or None, regression flag)
+    """
+
+    scale = calibration / baseline["calibration"] if baseline else 1
+    for name, seconds in results.items():
+        expected = baseline["results"].get(name) if baseline else None
+        if expected is None:
+            yield name, seconds, None, False
+        else:
+            expected *= scale
+            yield name, seconds, expected, seconds > expected * (1 + tolerance) and seconds - expected > noise
+
+
+@click.command()
+@click.pass_context
+@click.option("--packages", "packages_count", default=20, show_default=True, help="Packages in each branch.")
+@click.option("--versions", default=50, show_default=True, help="Versions of each package.")
+@click.option("--files", default=200, show_default=True, help="Assets of the single package read and downloaded.")
+@click.option("--file-size", default=16, show_default=True, help="Size of each asset, in KiB.")
+@click.option("--repeat", default=3, show_default=True, help="Runs of each case, the fastest counts.")
+@click.option("-k", "selected", multiple=True, help="Run only the given cases, can be repeated.")
+@click.option("--work-dir", default=".bench", show_default=True,
+              help="Directory of the generated trees, reused across runs at the same scale.")
+@click.option("--baseline", "baseline_path", default=str(baseline_file), show_default=True,
+              help="File of the baseline results.")
+@click.option("--update-baseline", is_flag=True, help="Save the results as the new baseline.")
+@click.option("--tolerance", default=0.5, show_default=True,
+              help="Fail if a case is slower than its baseline by more than this fraction.")
+@click.option("--history", help="File the results are appended to, one JSON line per run.")
+def main(ctx, packages_count, versions, files, file_size, repeat, selected, work_dir, baseline_path,
+         update_baseline, tolerance, history):
+    """ Time the assets and packages operations on synthetic trees """
+
+    names = list(selected or cases)
+    unknown = set(names) - set(cases)
+    if unknown:
+        click.echo(f"Unknown cases: {', '.join(sorted(unknown))}", err=True)
+        ctx.exit(2)
+
+    scale = {"packages": packages_count, "versions": versions, "files": files, "file_size": file_size}
+    click.echo(f"Generating trees in {work_dir}...", err=True)
+    env = setup(work_dir, packages_count, versions, files, file_size << 10)
+    try:
+        calibration = calibrate()
+        results = run_cases(env, names, repeat)
+    finally:
+        teardown(env)
+
+    baseline = None
+    if Path(baseline_path).exists():
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != scale:
+            click.echo(f"Baseline scale differs, not comparing: {baseline.get('scale')}", err=True)
+            baseline = None
+
+    # only the regressions of the gated cases fail the run, all of them if the baseline does not tell
+    gated = baseline.get("gated", list(cases)) if baseline else list(cases)
+    regressions = []
+    click.echo(f"{'case':<20} {'seconds':>10} {'baseline':>10} {'ratio':>7}")
+    for name, seconds, expected, regression in compare(results, calibration, baseline, tolerance):
+        if expected is None:
+            click.echo(f"{name:<20} {seconds:>10.4f} {'-':>10} {'-':>7}")
+            continue
+        flag = ("  REGRESSION" if name in gated else "  regression, not gated") if regression else ""
+        click.echo(f"{name:<20} {seconds:>10.4f} {expected:>10.4f} {seconds / expected:>7.2f}{flag}")
+        if regression and name in gated:
+            regressions.append(name)
+
+    run = {"scale": scale, "calibration": calibration, "results": results}
+    if history:
+        record = dict(run, time=time.time(), python=platform.python_version(), revision=git_revision())
+        with open(history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    if update_baseline:
+        previous = {}
+        if Path(baseline_path).exists():
+            with open(baseline_path) as f:
+                previous = json.load(f)
+        if "gated" in previous:
+            run["gated"] = previous["gated"]
+        with open(baseline_path, "w") as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+            f.write("\n")
+        click.echo(f"Baseline saved to {baseline_path}", err=True)
+    elif regressions:
+        click.echo(f"Slower than the baseline by more than {tolerance:.0%}: {', '.join(regressions)}", err=True)
+        ctx.exit(1)
+
+
+def git_revision():
+    import subprocess
+
+    p = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL)
+    return p.stdout.decode().strip() or None
+
+
+if __name__ == "__main__":
+    main(prog_name="benchmarks")
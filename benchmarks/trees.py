@@ -0,0 +1,103 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import yaml
+import shutil
+from pathlib import Path
+
+import assets
+
+
+def get_version(i):
+    return f"{i // 100 + 1}.{i // 10 % 10}.{i % 10}"
+
+
+def get_package(i):
+    return f"package{i:03d}"
+
+
+def make_trees(root, packages=100, versions=200, missing=0.1):
+    """
+    Generate synthetic assets and packages trees, as found in `assets/` and `packages/`.
+
+    Each branch has `packages` packages of `versions` versions each. The assets of the
+    last `missing` fraction of the versions, at least one, are left out, as if they needed
+    an update.
+    Trees already generated at the same scale are reused.
+
+    :param root: directory where the trees are generated
+    :return: (assets_dir, packages_dir)
+    """
+
+    root = Path(root)
+    scale = {"packages": packages, "versions": versions, "missing": missing}
+    marker = root / "trees.json"
+    if marker.exists() and json.loads(marker.read_text()) == scale:
+        return root / "assets", root / "packages"
+
+    dumped = versions - max(1, round(versions * missing))
+    shutil.rmtree(root / "assets", ignore_errors=True)
+    shutil.rmtree(root / "packages", ignore_errors=True)
+    for branch in assets.branches:
+        for p in range(packages):
+            package = get_package(p)
+            for v in range(versions):
+                version = get_version(v)
+                manifest = yaml.dump({
+                    "format_version": "1.0.0",
+                    "name": package,
+                    "title": f"Package {p}",
+                    "version": version,
+                    "type": "integration",
+                    "conditions": {"kibana.version": "^8.0.0"},
+                    "policy_templates": [{"name": package, "title": f"Package {p} logs", "inputs": [
+                        {"type": "logfile", "title": "Collect logs", "description": "Collect the logs"},
+                    ]}],
+                })
+                package_dir = root / "packages" / branch / "packages" / package / version
+                package_dir.mkdir(parents=True)
+                (package_dir / "manifest.yml").write_text(manifest)
+
+                if v >= dumped:
+                    continue
+                meta = yaml.dump({
+                    "stack": {"version": "8.4.0"},
+                    "package": {"fingerprint": f"sha256:{p:032x}{v:032x}"},
+                })
+                asset_dir = root / "assets" / branch / package / version
+                asset_dir.mkdir(parents=True)
+                (asset_dir / "meta.yml").write_text(meta)
+                (asset_dir / "manifest.yml").write_text(manifest)
+
+    marker.write_text(json.dumps(scale))
+    return root / "assets", root / "packages"
+
+
+def make_package(root, files=200, size=16 << 10):
+    """
+    Generate the assets of a single package version.
+
+    :param root: directory where the package is generated
+    :param files: number of assets
+    :param size: size of each asset, in bytes
+    :return: (path, package) as accepted by :py:func:`assets.get_local_assets`
+    """
+
+    root = Path(root) / "package"
+    package = f"{get_package(0)}/{get_version(0)}"
+    scale = {"files": files, "size": size}
+    marker = root / "package.json"
+    if marker.exists() and json.loads(marker.read_text()) == scale:
+        return root, package
+
+    shutil.rmtree(root, ignore_errors=True)
+    for i in range(files):
+        filename = root / package / ("index_templates" if i % 2 else "ingest_pipelines") / f"asset-{i}.json"
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps({"asset": i, "field": f"field-{i}"}).encode() + b"\n"
+        filename.write_bytes((line * (size // len(line) + 1))[:size])
+
+    marker.write_text(json.dumps(scale))
+    return root, package
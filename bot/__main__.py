@@ -4,23 +4,28 @@
 
 import os
 import json
+import hashlib
 import yaml
 import click
 import semver
 import subprocess
 import requests
 from pathlib import Path
+from collections import namedtuple
 
 import assets
 import packages
+from assets import trace, packed, verify
 
 config = {}
+cache_dir = "~/.cache/package-assets"
+index = None
 
 
-def get_stack_version():
-    es_url = os.getenv("ELASTIC_PACKAGE_ELASTICSEARCH_HOST")
-    es_user = os.getenv("ELASTIC_PACKAGE_ELASTICSEARCH_USERNAME")
-    es_pass = os.getenv("ELASTIC_PACKAGE_ELASTICSEARCH_PASSWORD")
+def get_stack_version(env=os.environ):
+    es_url = env.get("ELASTIC_PACKAGE_ELASTICSEARCH_HOST")
+    es_user = env.get("ELASTIC_PACKAGE_ELASTICSEARCH_USERNAME")
+    es_pass = env.get("ELASTIC_PACKAGE_ELASTICSEARCH_PASSWORD")
 
     if not es_url or not es_user or not es_pass:
         return None
@@ -30,45 +35,422 @@ def get_stack_version():
     return res.json()["version"]["number"]
 
 
-def make_plan(branches):
+Stack = namedtuple("Stack", ["env", "version"])
+Result = namedtuple("Result", ["package", "branch", "version", "stack_version", "log", "error"])
+
+
+class StepError(Exception):
+    pass
+
+
+def get_stacks(jobs):
+    stacks = config.get("stacks")
+    if not stacks:
+        stacks = [{}] * jobs
+    envs = [{**os.environ, **stack} for stack in stacks]
+    return [Stack(env, get_stack_version(env)) for env in envs]
+
+
+def run_step(log, args, **kwargs):
+    with trace.span(" ".join(str(arg) for arg in args[:2])) as span:
+        p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        span["output_bytes"] = len(p.stdout)
+        log.append(p.stdout)
+        if p.returncode:
+            raise StepError(f"Subprocess returned {p.returncode}")
+
+
+def find_dump(source, package, branch, version, fingerprint, stack_version):
+    for other in assets.branches:
+        if other == branch:
+            continue
+        meta = assets.get_meta(other, package, version, index=index)
+        if not meta or meta.get("stack", {}).get("version") != stack_version:
+            continue
+        other_fingerprint = (meta.get("package") or {}).get("fingerprint")
+        if other_fingerprint is None and source.get_manifest(other, package, version) is not None:
+            with source.package_dir(other, package, version) as package_dir:
+                other_fingerprint = packages.fingerprint(package_dir)
+        if other_fingerprint == fingerprint:
+            return assets.assets_dir / other / package / version
+
+
+def install_version(source, package, branch, version, stack, log, reuse=True):
+    with trace.span("install version", package=package, branch=branch, version=version) as span:
+        _install_version(source, package, branch, version, stack, log, reuse)
+        if packed.is_packed(assets.assets_dir / branch):
+            log.append("pack assets")
+            with trace.span("pack"):
+                packed.pack_version(assets.assets_dir / branch, f"{package}/{version}")
+        sizes = [asset.size for asset in assets.iter_local_assets(f"{package}/{version}", assets.assets_dir / branch)]
+        span.update(files=len(sizes), bytes=sum(sizes))
+
+
+def _install_version(source, package, branch, version, stack, log, reuse):
+    import shutil
+
+    asset_dir = assets.assets_dir / branch / package / version
+
+    with source.package_dir(branch, package, version) as package_dir:
+        with trace.span("fingerprint"):
+            fingerprint = packages.fingerprint(package_dir)
+        with trace.span("find dump"):
+            dump_dir = reuse and find_dump(source, package, branch, version, fingerprint, stack.version)
+
+        if dump_dir:
+            log.append(f"reuse assets of {dump_dir}")
+            with trace.span("reuse dump"):
+                if packed.is_packed(dump_dir.parent.parent):
+                    packed.unpack_version(dump_dir.parent.parent, f"{package}/{version}", asset_dir, ["meta.yml"])
+                else:
+                    shutil.copytree(dump_dir, asset_dir, ignore=shutil.ignore_patterns("meta.yml"),
+                                    dirs_exist_ok=True)
+        else:
+            log.append(f"install package from {package_dir}")
+            args = ["elastic-package", "install", package]
+            run_step(log, args, cwd=package_dir, env=stack.env)
+
+            log.append(f"export assets to {asset_dir}")
+            args = ["elastic-package", "dump", "installed-objects", "--package", package, "--output", asset_dir]
+            run_step(log, args, cwd=assets.assets_dir, env=stack.env)
+
+        log.append("copy manifest")
+        args = ["cp", "-v", package_dir / "manifest.yml", asset_dir]
+        run_step(log, args, cwd=asset_dir)
+
+    log.append("write meta")
+    meta = {
+        "stack": {
+            "version": stack.version,
+        },
+        "package": {
+            "fingerprint": fingerprint,
+        },
+    }
+    with open(asset_dir / "meta.yml", "w+") as f:
+        yaml.dump(meta, f)
+
+    log.append("write checksums")
+    verify.write_checksums(asset_dir)
+
+
+def commit_version(result, committers=None):
+    asset_dir = assets.assets_dir / result.branch / result.package / result.version
+    message = f"Add assets: {result.package} {result.version} ({result.branch}, {result.stack_version})"
+
+    if packed.is_packed(assets.assets_dir / result.branch):
+        # the new blobs and the tree file, the branch is never committed with plumbing
+        tree = packed.tree_filename(assets.assets_dir / result.branch, f"{result.package}/{result.version}")
+        result.log.append(f"git: add {tree}...")
+        args = ["git", "add", "--", packed.objects_dir, tree.relative_to(assets.assets_dir / result.branch)]
+        run_step(result.log, args, cwd=assets.assets_dir / result.branch)
+
+        result.log.append(f"git: commit {tree}...")
+        args = ["git", "commit", "-n", "-m", message]
+        run_step(result.log, args, cwd=assets.assets_dir / result.branch)
+        return
+
+    if committers is not None:
+        from .commit import Committer, CommitError
+
+        result.log.append(f"git: commit {asset_dir}...")
+        try:
+            if result.branch not in committers:
+                committers[result.branch] = Committer(assets.assets_dir / result.branch)
+            commit = committers[result.branch].commit(asset_dir, message)
+        except CommitError as e:
+            raise StepError(f"Commit failed: {e}")
+        result.log.append(f"[{commit[:7]}] {message}")
+        return
+
+    result.log.append(f"git: add {asset_dir}...")
+    args = ["git", "add", "*"]
+    run_step(result.log, args, cwd=asset_dir)
+
+    result.log.append(f"git: commit {asset_dir}...")
+    args = ["git", "commit", "-n", "-m", message]
+    run_step(result.log, args, cwd=asset_dir)
+
+
+def install_chains(source, chains, stacks, reuse=True):
+    """
+    Install and dump the package versions, each chain of versions on the first available stack.
+
+    Chains are processed concurrently, one per stack, the versions of a chain one after
+    the other. A failure affects only its own version. If `reuse` is set, a version whose
+    package content was already dumped in another branch with the same stack version is
+    not installed, the assets of the other branch are copied instead.
+
+    :return: generator yielding each version :py:class:`Result` as soon as it's ready
+    """
+
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    available = queue.Queue()
+    for stack in stacks:
+        available.put(stack)
+    results = queue.Queue()
+
+    def install_chain(chain):
+        stack = available.get()
+        try:
+            for package, branch, version in chain:
+                log = []
+                try:
+                    install_version(source, package, branch, version, stack, log, reuse)
+                    error = None
+                except Exception as e:
+                    error = str(e) or repr(e)
+                results.put(Result(package, branch, version, stack.version, log, error))
+        finally:
+            available.put(stack)
+
+    chains = [chain for chain in chains if chain]
+    with ThreadPoolExecutor(max_workers=len(stacks)) as executor:
+        futures = [executor.submit(install_chain, chain) for chain in chains]
+        pending = sum(len(chain) for chain in chains)
+        while pending:
+            try:
+                result = results.get(timeout=0.1)
+            except queue.Empty:
+                # a chain failed outside of its versions, its results will never come
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            pending -= 1
+            yield result
+
+
+def get_source(ctx, source, git_dir):
+    if source == "git":
+        return ctx.with_resource(packages.GitSource(git_dir))
+    if source == "epr":
+        from .epr import EprSource
+        from assets.httpcache import HttpCache
+
+        http_cache = HttpCache(Path(os.getenv("PACKAGE_ASSETS_CACHE", cache_dir)).expanduser() / "http")
+        return ctx.with_resource(EprSource(config.get("epr"), http_cache))
+    return ctx.with_resource(packages.CheckoutSource())
+
+
+def load_state(state_file):
+    if Path(state_file).exists():
+        with open(state_file) as f:
+            return yaml.safe_load(f) or {}
+    return {}
+
+
+def save_state(state_file, revisions):
+    state = load_state(state_file)
+    for branch, revs in revisions.items():
+        state.setdefault(branch, {}).update(revs)
+    with open(state_file, "w") as f:
+        yaml.dump(state, f)
+
+
+def get_config_hash(branch):
+    # tracked packages of the branch and their settings, a change requires a full plan of the branch
+    tracked = {name: {k: str(v) for k, v in package.items() if k != "branches"}
+               for name, package in config.get("tracked-packages", {}).items() if branch in package["branches"]}
+    return hashlib.sha1(json.dumps(tracked, sort_keys=True).encode()).hexdigest()
+
+
+def get_revisions(branches, source):
+    revisions = {}
+    for branch in branches or assets.branches:
+        revs = {"packages": source.get_revision(branch), "assets": assets.get_revision(branch)}
+        revisions[branch] = {k: v for k, v in revs.items() if v}
+        revisions[branch]["config"] = get_config_hash(branch)
+    return revisions
+
+
+def get_since(since, incremental, state_file, branches=None):
+    revisions = {}
+    if incremental:
+        # branches whose tracked packages changed are planned in full
+        revisions = {branch: revs for branch, revs in load_state(state_file).items()
+                     if revs.get("config") == get_config_hash(branch)}
+    if since:
+        if not branches or len(branches) != 1:
+            raise click.UsageError("--since needs exactly one branch in --branches, "
+                                   "the revisions of the branches are unrelated.")
+        revisions.setdefault(branches[0], {})["packages"] = since
+    return revisions or None
+
+
+def get_changed_packages(source, since):
+    changed = {}
+    for branch, revs in (since or {}).items():
+        if not revs.get("packages"):
+            continue
+        packages_changed = source.get_changed_packages(branch, revs["packages"])
+        if packages_changed is None:
+            continue
+        if revs.get("assets"):
+            assets_changed = assets.get_changed_packages(branch, revs["assets"])
+            if assets_changed is None:
+                continue
+            packages_changed |= assets_changed
+        changed[branch] = packages_changed
+    return changed
+
+
+def make_plan(branches, source=None, since=None):
     tracked_packages = config.get("tracked-packages", {})
+    if source is None:
+        source = packages.CheckoutSource()
+
+    with trace.span("plan changes"):
+        changed = get_changed_packages(source, since)
+
+    def skip(branch, package):
+        return branch in changed and package not in changed[branch]
 
     local_assets = {}
-    for branch, package, version in assets.walk():
-        meta = assets.get_meta(branch, package, version)
-        if meta is not None:
-            local_assets.setdefault(package, {}).setdefault(branch, {}).setdefault(version, meta)
-
-    remote_assets = {}
-    for package in tracked_packages:
-        for branch in tracked_packages[package]["branches"]:
-            package_dir = packages.packages_dir / branch / "packages" / package
-            if package_dir.exists():
-                for version in os.listdir(package_dir):
-                    meta = packages.get_manifest(branch, package, version)
+    with trace.span("plan local versions", versions=0) as span:
+        for branch, package, version in assets.walk():
+            if skip(branch, package):
+                continue
+            meta = assets.get_meta(branch, package, version, index=index)
+            if meta is not None:
+                local_assets.setdefault(package, {}).setdefault(branch, {}).setdefault(version, meta)
+                span["versions"] += 1
+
+    # each package is compared as soon as its remote versions are known
+    with trace.span("plan remote versions", versions=0) as span:
+        for package in tracked_packages:
+            for branch in tracked_packages[package]["branches"]:
+                if branches and branch not in branches or skip(branch, package):
+                    continue
+                remote_versions = set()
+                for version in source.get_versions(branch, package):
+                    meta = source.get_manifest(branch, package, version, index=index)
                     if meta is not None:
-                        remote_assets.setdefault(package, {}).setdefault(branch, {}).setdefault(version, meta)
+                        remote_versions.add(version)
+                        span["versions"] += 1
+                if not remote_versions:
+                    continue
+
+                local_versions = set(local_assets.get(package, {}).get(branch, {}))
+                min_version = tracked_packages[package].get("minimum-version", 0)
+                if min_version:
+                    remote_versions = {v for v in remote_versions if v >= min_version or v in local_versions}
+
+                all_versions = local_versions | remote_versions
+                only_local = local_versions - remote_versions
+                only_remote = remote_versions - local_versions
+
+                yield (package, branch, all_versions, only_local, only_remote)
+
+
+def iter_plan_records(plan):
+    """
+    Flatten an update plan to one record per version.
+
+    Only the packages with changes are included. The action of each version is 'install'
+    if it's only in the packages source, 'orphan' if it's only in the assets and 'keep' if it's in both.
+
+    :param plan: update plan as generated by :py:func:`make_plan`
+    :return: generator yielding dictionaries with keys package, branch, version and action
+    """
+
+    for (package, branch, all_versions, only_local, only_remote) in plan:
+        if not (only_local or only_remote):
+            continue
+        for version in sorted(all_versions, key=semver.VersionInfo.parse):
+            action = "install" if version in only_remote else "orphan" if version in only_local else "keep"
+            yield {"package": package, "branch": branch, "version": version, "action": action}
+
+
+def read_plan_records(f):
+    """
+    Read the records of a plan file, as written by `plan --format json` or `plan --format jsonl`.
+
+    :param f: file object
+    :return: list of the plan records
+    :raise ValueError: if the file is not a valid plan
+    """
+
+    content = f.read()
+    if content.lstrip().startswith("["):
+        records = json.loads(content)
+    else:
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    keys = {"package", "branch", "version", "action"}
+    for record in records:
+        if not isinstance(record, dict) or not keys <= record.keys():
+            raise ValueError(f"not a plan record: {record}")
+    return records
+
+
+class Resources:
+    """
+    Resources shared by the commands, opened only by the commands using them.
+
+    :param ctx: context of the group, the resources are closed when it exits
+    :param index_file: path of the index, empty to disable it
+    :param rebuild_index: drop the indexed content once the index is opened
+    """
 
-    for package in remote_assets:
-        for branch in remote_assets[package]:
-            local_versions = set(local_assets.get(package, {}).get(branch, {}))
-            remote_versions = set(remote_assets[package][branch])
+    def __init__(self, ctx, index_file, rebuild_index):
+        self.ctx = ctx
+        self.index_file = index_file
+        self.rebuild_index = rebuild_index
+        self._index = None
 
-            min_version = tracked_packages[package].get("minimum-version", 0)
-            if min_version:
-                remote_versions = {v for v in remote_versions if v >= min_version or v in local_versions}
+    @property
+    def index(self):
+        if self._index is None and self.index_file:
+            from assets.index import Index
 
-            all_versions = local_versions | remote_versions
-            only_local = local_versions - remote_versions
-            only_remote = remote_versions - local_versions
+            self._index = self.ctx.with_resource(Index(self.index_file))
+            if self.rebuild_index:
+                self._index.rebuild()
+            else:
+                self._index.prune()
+        return self._index
 
-            yield (package, branch, all_versions, only_local, only_remote)
+
+def use_index(ctx):
+    """ Open the index for the running command and its helpers, None if it's disabled """
+    global index
+    index = ctx.obj.index
+    return index
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        i, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("expected i/N, ex. 1/4")
+    if not 1 <= i <= n:
+        raise click.BadParameter(f"shard {i} is not in 1..{n}")
+    return i, n
+
+
+def in_shard(package, shard):
+    import zlib
+
+    # stable across processes and machines, unlike hash()
+    i, n = shard
+    return zlib.crc32(package.encode()) % n == i - 1
 
 
 @click.group()
 @click.pass_context
 @click.option("--config", "conf_file", default="config.yaml", show_default=True, help="Path to the configuration file.")
-def cli(ctx, conf_file):
+@click.option("--index", "index_file", default=".index.sqlite", show_default=True,
+              help="Path to the index of the parsed meta and manifest files, empty to disable it.")
+@click.option("--rebuild-index", is_flag=True, help="Parse again all the meta and manifest files.")
+@click.option("--trace", "trace_file", help="Record the timing of each stage to this file, print a summary at the end.")
+@click.option("--trace-format", type=click.Choice(trace.Tracer.formats), default="jsonl", show_default=True,
+              help="Format of the trace file, JSON lines or the Chrome trace format.")
+def cli(ctx, conf_file, index_file, rebuild_index, trace_file, trace_format):
     from .config import load
 
     try:
@@ -79,33 +461,102 @@ def cli(ctx, conf_file):
         click.echo(f"Configuration error: {e}", err=True)
         ctx.exit(1)
 
+    global index
+    index = None
+    ctx.obj = Resources(ctx, index_file, rebuild_index)
+
+    if trace_file:
+        trace.tracer = trace.Tracer(trace_file, trace_format)
+
+        def finish():
+            click.echo("\n".join(trace.tracer.format_summary()), err=True)
+            trace.tracer.close()
+            trace.tracer = None
+
+        ctx.call_on_close(finish)
+
 
 @cli.command()
 @click.pass_context
-@click.option("--pedantic", is_flag=True, help="Fail if something is wrong with local assets")
-def meta(ctx, pedantic):
+@click.option("--pedantic", is_flag=True, help="Fail if something is wrong with local assets: missing meta, "
+              "invalid JSON files, files not matching the checksum manifest.")
+@click.option("--jobs", type=click.IntRange(1),
+              help="Number of processes verifying the assets, all the cores if not given.")
+def meta(ctx, pedantic, jobs):
     """ Print the meta info of all the stored assets """
-    for branch, package, version in assets.walk():
-        meta = assets.get_meta(branch, package, version)
+    use_index(ctx)
+    if pedantic:
+        verifier = verify.Verifier(index, jobs)
+        if index is not None:
+            verifier.prune()
+        results = verifier.verify(assets.walk())
+    else:
+        results = ((branch, package, version, []) for branch, package, version in assets.walk())
+
+    failures = 0
+    for branch, package, version, problems in results:
+        meta = assets.get_meta(branch, package, version, index=index)
+        if meta is None and pedantic:
+            problems.insert(0, f"Missing or empty meta: assets/{branch}/{package}/{version}/meta.yml")
+        for problem in problems:
+            click.echo(problem, err=True)
+        failures += bool(problems)
         if meta is None:
-            if pedantic:
-                click.echo(f"Missing or empty meta: assets/{branch}/{package}/{version}/meta.yml", err=True)
-                ctx.exit(1)
             continue
         asset = dict(branch=branch, package=package, version=version, meta=meta)
         click.echo(json.dumps(asset))
 
+    if failures:
+        click.echo(f"{failures} assets failed the verification", err=True)
+        ctx.exit(1)
+
 
 @cli.command()
+@click.pass_context
 @click.option("--branches", help="Comma separated list of branches - es: staging,snapshot")
-def plan(branches):
+@click.option("--source", type=click.Choice(["checkout", "git", "epr"]), default="checkout", show_default=True,
+              help="Read the packages from the packages/<branch> checkouts, from the --git-dir object database "
+              "or from the package registries.")
+@click.option("--git-dir", default="packages/package-storage.git", show_default=True,
+              help="Git directory of a package-storage clone, also bare and blobless.")
+@click.option("--since", help="Only re-evaluate the packages changed since this package-storage revision, "
+              "of the single branch given with --branches.")
+@click.option("--incremental", is_flag=True, help="Only re-evaluate the packages changed since the last processed "
+              "package-storage and assets revisions, as remembered in the --state file.")
+@click.option("--state", "state_file", default=".bot-state.yml", show_default=True,
+              help="File remembering the last processed revisions.")
+@click.option("--format", "format_", type=click.Choice(["text", "json", "jsonl"]), default="text", show_default=True,
+              help="Diff-like text or one (package, branch, version, action) record per version, "
+              "as a JSON array or JSON lines. Records are printed as the plan is computed.")
+def plan(ctx, branches, source, git_dir, since, incremental, state_file, format_):
     """ Print the update plan in a diff-like format """
 
+    use_index(ctx)
     if branches:
         branches = [b.strip() for b in branches.split(",")]
 
-    for (package, branch, all_versions, only_local, only_remote) in make_plan(branches):
+    source = get_source(ctx, source, git_dir)
+    revisions = get_revisions(branches, source)
+    since = get_since(since, incremental, state_file, branches)
+
+    changes = False
+    if format_ != "text":
+        separator = "[\n" if format_ == "json" else ""
+        for record in iter_plan_records(make_plan(branches, source, since)):
+            changes = True
+            click.echo(separator + json.dumps(record), nl=format_ == "jsonl")
+            if format_ == "json":
+                separator = ",\n"
+        if format_ == "json":
+            click.echo("\n]" if changes else "[]")
+
+        if incremental and not changes:
+            save_state(state_file, revisions)
+        return
+
+    for (package, branch, all_versions, only_local, only_remote) in make_plan(branches, source, since):
         if only_local or only_remote:
+            changes = True
             click.echo(f"--- local/{package}/{branch}")
             click.echo(f"+++ remote/{package}/{branch}")
             click.echo(f"@@ -1,{len(only_remote)} +1,{len(only_local)} @@")
@@ -116,112 +567,417 @@ def plan(branches):
                 else:
                     click.echo(f" {version}")
 
+    if incremental and not changes:
+        save_state(state_file, revisions)
+
 
 @cli.command()
 @click.pass_context
 @click.option("--branches", help="Comma separated list of branches - es: staging,snapshot")
-def update(ctx, branches):
-    """ Perform the assets updates """
+@click.option("--source", type=click.Choice(["checkout", "git", "epr"]), default="checkout", show_default=True,
+              help="Read the packages from the packages/<branch> checkouts, from the --git-dir object database "
+              "or from the package registries.")
+@click.option("--git-dir", default="packages/package-storage.git", show_default=True,
+              help="Git directory of a package-storage clone, also bare and blobless.")
+@click.option("--since", help="Only re-evaluate the packages changed since this package-storage revision, "
+              "of the single branch given with --branches.")
+@click.option("--incremental", is_flag=True, help="Only re-evaluate the packages changed since the last processed "
+              "package-storage and assets revisions, as remembered in the --state file.")
+@click.option("--state", "state_file", default=".bot-state.yml", show_default=True,
+              help="File remembering the last processed revisions.")
+@click.option("--jobs", type=click.IntRange(1), default=1, show_default=True,
+              help="Number of concurrent installs, ignored if the configuration lists the stacks to use.")
+@click.option("--no-reuse", is_flag=True, help="Install also the packages already dumped in other branches.")
+@click.option("--batch-commit", is_flag=True,
+              help="Commit with git plumbing, without scanning the index nor the working tree.")
+@click.option("--plan-file", type=click.File("r"), help="Install the versions of this plan, as written by "
+              "`plan --format json` or `plan --format jsonl`, instead of computing the plan. '-' for stdin.")
+@click.option("--shard", callback=parse_shard, help="Install only the packages of the i-th of N disjoint slices of the "
+              "plan, ex. 1/4. All the versions of a package are in the same slice.")
+def update(ctx, branches, source, git_dir, since, incremental, state_file, jobs, no_reuse, batch_commit, plan_file,
+           shard):
+    """ Perform the assets updates
+
+    With --plan-file or --shard the state file is not updated, the plan
+    may not cover all the changes since the last processed revisions.
+    """
 
-    stack_version = get_stack_version()
-    if not stack_version:
+    use_index(ctx)
+    stacks = get_stacks(jobs)
+    if not all(stack.version for stack in stacks):
         click.echo("Forgot to 'eval \"$(elastic-package stack shellinit)\"' in your shell?", err=True)
         ctx.exit(1)
 
-    meta = {
-        "stack": {
-            "version": stack_version,
-        },
-    }
+    if plan_file is not None and (since or incremental):
+        raise click.UsageError("--since and --incremental are not used with --plan-file.")
 
     if branches:
         branches = [b.strip() for b in branches.split(",")]
 
-    for (package, branch, all_versions, only_local, only_remote) in make_plan(branches):
-        for version in sorted(only_remote, key=semver.VersionInfo.parse):
-            package_dir = packages.packages_dir / branch / "packages" / package / version
-            click.echo(f"install package from {package_dir}")
-            args = ["elastic-package", "install", package]
-            p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=package_dir)
-            if p.returncode:
-                click.echo(p.stdout, err=True)
-                click.echo(f"Subprocess returned {p.returncode}", err=True)
-                continue
-            click.echo(p.stdout)
+    source = get_source(ctx, source, git_dir)
+    partial = plan_file is not None or shard is not None
+    revisions = None if partial else get_revisions(branches, source)
+
+    if plan_file is not None:
+        try:
+            records = read_plan_records(plan_file)
+        except ValueError as e:
+            click.echo(f"Invalid plan file: {e}", err=True)
+            ctx.exit(1)
+        records = (r for r in records if r["action"] == "install" and (not branches or r["branch"] in branches))
+        # the versions already installed are skipped, a plan file can be run again
+        installs = ((r["package"], r["branch"], r["version"]) for r in records
+                    if assets.get_meta(r["branch"], r["package"], r["version"], index=index) is None)
+    else:
+        since = get_since(since, incremental, state_file, branches)
+        installs = ((r["package"], r["branch"], r["version"])
+                    for r in iter_plan_records(make_plan(branches, source, since)) if r["action"] == "install")
+
+    # versions of the same package are installed one after the other
+    chains = {}
+    for package, branch, version in installs:
+        if shard is None or in_shard(package, shard):
+            chains.setdefault(package, []).append((package, branch, version))
+
+    import time
+
+    summary = []
+    commit_time = 0
+    committers = {} if batch_commit else None
+    objects = None
+    if index is not None:
+        from assets.objects import ObjectIndex
+        objects = ObjectIndex(index)
 
-            asset_dir = assets.assets_dir / branch / package / version
-            click.echo(f"export assets to {asset_dir}")
-            args = ["elastic-package", "dump", "installed-objects", "--package", package, "--output", asset_dir]
-            p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=assets.assets_dir)
-            if p.returncode:
-                click.echo(p.stdout, err=True)
-                click.echo(f"Subprocess returned {p.returncode}", err=True)
-                continue
-            click.echo(p.stdout)
-
-            click.echo("copy manifest")
-            args = ["cp", "-v", package_dir / "manifest.yml", asset_dir]
-            p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=asset_dir)
-            if p.returncode:
-                click.echo(p.stdout, err=True)
-                click.echo(f"Subprocess returned {p.returncode}", err=True)
-                continue
-            click.echo(p.stdout)
-
-            click.echo("write meta")
-            with open(asset_dir / "meta.yml", "w+") as f:
-                yaml.dump(meta, f)
-
-            click.echo(f"git: add {asset_dir}...")
-            args = ["git", "add", "*"]
-            p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=asset_dir)
-            if p.returncode:
-                click.echo(p.stdout, err=True)
-                click.echo(f"Subprocess returned {p.returncode}", err=True)
-                continue
-            click.echo(p.stdout)
-
-            click.echo(f"git: commit {asset_dir}...")
-            args = ["git", "commit", "-n", "-m", f"Add assets: {package} {version} ({branch}, {stack_version})"]
-            p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=asset_dir)
-            if p.returncode:
-                click.echo(p.stdout, err=True)
-                click.echo(f"Subprocess returned {p.returncode}", err=True)
-                continue
-            click.echo(p.stdout)
+    try:
+        for result in install_chains(source, chains.values(), stacks, reuse=not no_reuse):
+            if not result.error:
+                start = time.monotonic()
+                try:
+                    with trace.span("commit", package=result.package, branch=result.branch, version=result.version):
+                        commit_version(result, committers)
+                except StepError as e:
+                    result = result._replace(error=str(e))
+                elapsed = time.monotonic() - start
+                result.log.append(f"git: commit took {elapsed:.3f}s")
+                commit_time += elapsed
+
+            if objects is not None and not result.error:
+                with trace.span("index objects", package=result.package, branch=result.branch):
+                    objects.update_version(result.branch, result.package, result.version)
+
+            for line in result.log:
+                click.echo(line, err=bool(result.error))
+            if result.error:
+                click.echo(result.error, err=True)
+            summary.append(result)
+    finally:
+        for committer in (committers or {}).values():
+            committer.close()
+
+    failures = [result for result in summary if result.error]
+    if summary:
+        click.echo("Summary:")
+        for result in summary:
+            status = f"failed: {result.error}" if result.error else "ok"
+            click.echo(f"  {result.package} {result.version} ({result.branch}, {result.stack_version}): {status}")
+        click.echo(f"{len(summary) - len(failures)} updated, {len(failures)} failed, {commit_time:.3f}s in git commits")
+
+    if not failures and revisions is not None:
+        for branch, revs in revisions.items():
+            revs.update({k: v for k, v in {"assets": assets.get_revision(branch)}.items() if v})
+        save_state(state_file, revisions)
 
 
 @cli.command()
 @click.pass_context
-@click.argument("PACKAGE")
-@click.argument("OUTPUT_DIR")
-def download(ctx, package, output_dir):
-    """ Download the assets of a given package
+@click.option("--type", "type_", help="Type of the objects, ex. index_templates, ingest_pipelines.")
+@click.option("--name", help="Name of the objects, shell-style wildcards allowed.")
+@click.option("--field", help="Mapped field path, shell-style wildcards allowed - es: process.pid")
+@click.option("--branch", type=click.Choice(assets.branches), help="Only the objects of this branch.")
+@click.option("--package", help="Only the objects of this package.")
+@click.option("--no-refresh", is_flag=True, help="Do not index the assets changed since the last update.")
+def query(ctx, type_, name, field, branch, package, no_refresh):
+    """ Find the package versions whose objects match """
+    from assets.objects import ObjectIndex
+
+    if use_index(ctx) is None:
+        click.echo("The query needs the index, do not disable it with --index \"\"", err=True)
+        ctx.exit(1)
 
-    PACKAGE whose assets are to be downloaded - es: endpoint/8.2.3
-    OUTPUT_DIR directory where the assets are downloaded to
+    objects = ObjectIndex(index)
+    if not no_refresh:
+        with trace.span("index objects") as span:
+            span["updated"], span["removed"] = objects.update()
+    with trace.span("query"):
+        for obj in objects.query(type=type_, name=name, field=field, branch=branch, package=package):
+            click.echo(json.dumps(obj._asdict()))
+
+
+@cli.command()
+@click.pass_context
+@click.option("--to", "format_", type=click.Choice(["packed", "unpacked"]), required=True,
+              help="Storage format of the converted branches.")
+@click.option("--branches", help="Comma separated list of branches - es: staging,snapshot")
+def convert(ctx, format_, branches):
+    """ Convert the assets branches to or from the packed storage format
+
+    The assets of packed branches cannot be downloaded from GitHub, only
+    through a `bot serve` server.
     """
 
-    from github import Github
+    branches = [b.strip() for b in branches.split(",")] if branches else assets.branches
+    for branch in branches:
+        branch_dir = assets.assets_dir / branch
+        if not branch_dir.exists():
+            continue
+        if format_ == "packed":
+            count = packed.pack_branch(branch_dir)
+            pruned = packed.prune(branch_dir)
+            click.echo(f"{branch}: {count} versions packed, {pruned} unused blobs removed")
+        elif packed.is_packed(branch_dir):
+            count = packed.unpack_branch(branch_dir)
+            click.echo(f"{branch}: {count} versions unpacked")
 
-    github = Github(os.getenv("GITHUB_TOKEN_ASSETS") or None)
-    repo = github.get_repo("elastic/package-assets")
-    entries = assets.get_remote_assets(package, repo)
 
-    count = 0
-    for path, content in assets.download_assets(entries):
-        filename = path.replace(package, output_dir)
+@cli.command()
+@click.pass_context
+@click.argument("PACKAGES", nargs=-1, required=True)
+@click.option("--branch", type=click.Choice(assets.branches), default="production", show_default=True,
+              help="Branch of the assets.")
+@click.option("--jobs", type=click.IntRange(1), default=8, show_default=True,
+              help="Maximum number of files compared concurrently.")
+def diff(ctx, packages, branch, jobs):
+    """ Print the structural differences between consecutive asset versions - es: endpoint/8.3.0 endpoint/8.4.0 """
+    from assets.diff import Documents, diff_versions, format_path
+
+    if len(packages) < 2:
+        click.echo("At least two versions are needed, ex. endpoint/8.3.0 endpoint/8.4.0", err=True)
+        ctx.exit(2)
+
+    def dumps(value):
+        return json.dumps(value, sort_keys=True)
+
+    symbols = {"added": "+", "removed": "-", "changed": "~"}
+    documents = Documents()
+    for old, new in zip(packages, packages[1:]):
+        with trace.span("diff", old=old, new=new) as span:
+            try:
+                diffs = diff_versions(old, new, assets.assets_dir / branch, jobs, documents)
+            except ValueError as e:
+                click.echo(e, err=True)
+                ctx.exit(1)
+            span["files"] = len(diffs)
+
+        click.echo(f"--- {branch}/{old}")
+        click.echo(f"+++ {branch}/{new}")
+        for file_diff in diffs:
+            click.echo(f"{symbols[file_diff.op]} {file_diff.path}")
+            for change in file_diff.changes or []:
+                path = format_path(change.path) or "."
+                if change.op == "added":
+                    click.echo(f"    + {path}: {dumps(change.new)}")
+                elif change.op == "removed":
+                    click.echo(f"    - {path}: {dumps(change.old)}")
+                else:
+                    click.echo(f"    ~ {path}: {dumps(change.old)} -> {dumps(change.new)}")
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on.")
+@click.option("--port", default=8000, show_default=True, help="Port to listen on.")
+@click.option("--memory", default=256, show_default=True, help="Size of the in-memory cache, in MiB.")
+@click.option("--ttl", default=30, show_default=True, help="Seconds a branch listing is reused before listing again.")
+@click.option("--upstream", is_flag=True, help="Serve the assets of the GitHub repository instead of the local "
+              "branches, fetching them as they are requested.")
+@click.option("--cache-dir", default=cache_dir, show_default=True, envvar="PACKAGE_ASSETS_CACHE",
+              help="Directory of the on-disk cache filled from the upstream.")
+@click.option("--cache-size", default=1024, show_default=True, help="Maximum size of the on-disk cache, in MiB.")
+@click.option("--verbose", is_flag=True, help="Log each request.")
+def serve(host, port, memory, ttl, upstream, cache_dir, cache_size, verbose):
+    """ Serve the assets over HTTP, with GitHub compatible listings """
+    from assets.server import AssetServer, LocalBackend, UpstreamBackend
+
+    if upstream:
+        from github import Github
+        from assets.cache import BlobCache
+
+        repo = Github(os.getenv("GITHUB_TOKEN_ASSETS") or None).get_repo("elastic/package-assets")
+        backend = UpstreamBackend(repo, BlobCache(Path(cache_dir).expanduser(), cache_size << 20), ttl)
+    else:
+        backend = LocalBackend(ttl)
+
+    server = AssetServer((host, port), backend, memory << 20, verbose=verbose)
+    url = f"http://{host}:{server.server_address[1]}"
+    click.echo(f"Serving the assets at {url}, use `bot download --server {url}`", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _read_packages(f):
+    # one package per line, blank lines and comments are skipped
+    for line in f:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            yield line
 
-        Path(filename).parent.mkdir(parents=True, exist_ok=True)
-        with open(filename, "wb") as f:
-            f.write(content)
 
-        count += 1
+@cli.command()
+@click.pass_context
+@click.argument("PACKAGES", nargs=-1)
+@click.argument("OUTPUT_DIR")
+@click.option("--from", "from_file", type=click.File("r"),
+              help="File listing the packages to download, one per line, '-' for stdin.")
+@click.option("--include", multiple=True,
+              help="Download only the assets matching this pattern, ex. 'index_templates/*'. Can be repeated.")
+@click.option("--exclude", multiple=True, help="Do not download the assets matching this pattern. Can be repeated.")
+@click.option("--jobs", type=click.IntRange(1), default=8, show_default=True,
+              help="Maximum number of concurrent downloads, in total.")
+@click.option("--retries", default=3, show_default=True, help="Retries of each download on transient failures.")
+@click.option("--cache-dir", default=cache_dir, show_default=True, envvar="PACKAGE_ASSETS_CACHE",
+              help="Directory of the assets cache, cached assets are hard-linked read-only into OUTPUT_DIR.")
+@click.option("--cache-size", default=1024, show_default=True, help="Maximum size of the assets cache, in MiB.")
+@click.option("--http-cache-size", default=256, show_default=True,
+              help="Maximum size of the cache of the GitHub responses, in MiB.")
+@click.option("--no-cache", is_flag=True, help="Do not use the assets cache nor the cache of the GitHub responses.")
+@click.option("--archive", is_flag=True, help="Extract the assets from the streamed tarball of the branch.")
+@click.option("--server", envvar="PACKAGE_ASSETS_SERVER", help="URL of a `bot serve` server to use instead of GitHub.")
+def download(ctx, packages, output_dir, from_file, include, exclude, jobs, retries, cache_dir, cache_size,
+             http_cache_size, no_cache, archive, server):
+    """ Download the assets of the given packages
+
+    PACKAGES whose assets are to be downloaded - es: endpoint/8.2.3
+    OUTPUT_DIR directory where the assets are downloaded to
 
-    if count:
-        click.echo(f"Saved {count} assets")
+    With more than one package, or with --from, the assets of each package
+    are downloaded to OUTPUT_DIR/<package>/<version>.
+    """
+
+    from github import Github
+
+    nested = from_file is not None or len(packages) != 1
+    if from_file is not None:
+        packages += tuple(_read_packages(from_file))
+    packages = list(dict.fromkeys(packages))
+    if not packages:
+        raise click.UsageError("No packages to download.")
+
+    def package_dir(package):
+        return Path(output_dir) / package if nested else Path(output_dir)
+
+    cache = None
+    http_cache = None
+    if not no_cache:
+        from assets.cache import BlobCache
+        from assets.httpcache import HttpCache, install_github_cache
+
+        cache_dir = Path(cache_dir).expanduser()
+        cache = BlobCache(cache_dir, cache_size << 20)
+        http_cache = HttpCache(cache_dir / "http", http_cache_size << 20)
+        install_github_cache(http_cache)
+
+    raw_url = None
+    if server:
+        server = server.rstrip("/")
+        raw_url = f"{server}/raw"
+        # the token is for GitHub only, it's not sent to other hosts
+        github = Github(base_url=f"{server}/api")
     else:
+        github = Github(os.getenv("GITHUB_TOKEN_ASSETS") or None)
+    repo = github.get_repo("elastic/package-assets")
+
+    def saved():
+        # yield (package, path, filename) as the assets get saved, then (package, None, None) once
+        # all the assets of the package are saved
+        if archive:
+            for package in packages:
+                with trace.span("list", package=package):
+                    try:
+                        url = assets.get_archive_url(package, repo)
+                    except assets.PackedBranchError:
+                        raise
+                    except ValueError:
+                        missing.append(package)
+                        continue
+                yield from ((package, path, filename) for path, filename in
+                            assets.save_archive_assets(package, url, package_dir(package), include=include,
+                                                       exclude=exclude))
+                yield package, None, None
+            return
+
+        # assets of each package in flight, packages still being listed, packages done
+        pending = {}
+        listing = set()
+        finished = []
+
+        def stream(package, entries, span):
+            for entry in assets.select_assets(entries, package, include, exclude):
+                pending[package] += 1
+                span["files"] += 1
+                yield entry
+            listing.discard(package)
+            if not pending[package]:
+                finished.append(package)
+
+        def listed():
+            # the downloads start as soon as the first assets are listed
+            with trace.span("list", packages=len(packages), files=0) as span:
+                resolved = assets.resolve_remote_assets(packages, repo, workers=jobs, raw_url=raw_url)
+                for package, entries in resolved:
+                    if entries is None:
+                        missing.append(package)
+                        continue
+                    pending[package] = 0
+                    listing.add(package)
+                    yield package, stream(package, entries, span), package_dir(package)
+
+        # the assets are cached by SHA, the HTTP cache only serves the GitHub API
+        for package, path, filename in assets.save_packages_assets(listed(), workers=jobs, retries=retries,
+                                                                   cache=cache):
+            yield package, path, filename
+            pending[package] -= 1
+            if not pending[package] and package not in listing:
+                finished.append(package)
+            while finished:
+                yield finished.pop(0), None, None
+        while finished:
+            yield finished.pop(0), None, None
+
+    count = 0
+    counts = {}
+    missing = []
+    with trace.span("download", packages=0, files=0, bytes=0) as span:
+        try:
+            for package, path, filename in saved():
+                if path is None:
+                    span["packages"] += 1
+                    if nested:
+                        click.echo(f"{package}: {counts.get(package, 0)} assets", err=True)
+                    continue
+                count += 1
+                counts[package] = counts.get(package, 0) + 1
+                span["files"] += 1
+                span["bytes"] += os.stat(filename).st_size
+        except assets.PackedBranchError as e:
+            raise click.ClickException(f"{e}, packed branches are read only through a `bot serve` server.")
+
+    if http_cache is not None:
+        click.echo(f"HTTP cache: {http_cache.hits} revalidated, {http_cache.misses} fetched", err=True)
+
+    # found packages with no assets left by --include and --exclude
+    unmatched = [package for package in packages if package not in missing and not counts.get(package)]
+
+    if count or not (missing or unmatched):
+        click.echo(f"Saved {count} assets" + (f" ({cache.hits} from cache)" if cache is not None else ""))
+    for package in missing:
         click.echo(f"Not found: {package}", err=True)
+    for package in unmatched:
+        click.echo(f"No assets matched: {package}", err=True)
+    if missing or unmatched:
         ctx.exit(1)
 
 
@@ -0,0 +1,153 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import subprocess
+from pathlib import Path
+
+
+class CommitError(Exception):
+    pass
+
+
+class Committer:
+    """
+    Commit directories of a repository with git plumbing commands.
+
+    The tree of each commit is made by replacing the tree of the committed directory
+    in the tree of HEAD, only the trees along its path are written. Neither the
+    index nor the working tree are scanned, the cost of a commit does not grow with
+    the number of files in the repository. After each commit the index entries of
+    the committed directory are updated, the index never lags behind HEAD by more
+    than the commit in progress. Hooks are not run, as with `git commit -n`.
+    """
+
+    def __init__(self, repo_dir):
+        # paths in the trees are relative to the top-level directory
+        self.toplevel = Path(self._git("rev-parse", "--show-toplevel", cwd=repo_dir).strip())
+        self._mktree = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _git(self, *args, input=None, cwd=None):
+        p = subprocess.run(["git", *args], cwd=cwd or self.toplevel, input=input, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+        if p.returncode:
+            raise CommitError(p.stderr.decode().strip() or f"git {args[0]} returned {p.returncode}")
+        return p.stdout.decode()
+
+    def _head(self):
+        try:
+            return self._git("rev-parse", "--verify", "-q", "HEAD").strip()
+        except CommitError:
+            return None
+
+    def _make_tree(self, entries):
+        if self._mktree is None:
+            self._mktree = subprocess.Popen(["git", "mktree", "-z", "--batch"], cwd=self.toplevel,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        for name, (mode, kind, sha) in entries.items():
+            self._mktree.stdin.write(f"{mode} {kind} {sha}\t{name}\0".encode())
+        self._mktree.stdin.write(b"\0")
+        self._mktree.stdin.flush()
+        sha = self._mktree.stdout.readline().decode().strip()
+        if not sha:
+            raise CommitError("git mktree failed")
+        return sha
+
+    def _list_tree(self, treeish):
+        entries = {}
+        try:
+            output = self._git("ls-tree", "-z", treeish)
+        except CommitError:
+            return entries
+        for line in output.split("\0"):
+            if line:
+                info, name = line.split("\t", 1)
+                mode, kind, sha = info.split()
+                entries[name] = (mode, kind, sha)
+        return entries
+
+    def _write_dir(self, path):
+        files = []
+        for root, _, names in os.walk(path):
+            files += [Path(root) / name for name in names]
+        if not files:
+            return None
+
+        stdin = "".join(f"{file}\n" for file in files).encode()
+        shas = self._git("hash-object", "-w", "--no-filters", "--stdin-paths", input=stdin).split()
+
+        tree = {}
+        for file, sha in zip(files, shas):
+            node = tree
+            parts = file.relative_to(path).parts
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            mode = "100755" if os.access(file, os.X_OK) else "100644"
+            node[parts[-1]] = (mode, "blob", sha)
+
+        def make(node):
+            entries = {}
+            for name, child in node.items():
+                entries[name] = ("040000", "tree", make(child)) if isinstance(child, dict) else child
+            return self._make_tree(entries)
+
+        return make(tree)
+
+    def commit(self, path, message):
+        """
+        Commit the content of a directory, as found on disk.
+
+        :param path: directory to commit
+        :param message: commit message
+        :return: id of the new commit
+        """
+
+        parts = Path(os.path.relpath(path, self.toplevel)).parts
+        parent = self._head()
+
+        # replace the directory tree, then its ancestors up to the root
+        sha = self._write_dir(path)
+        for depth in reversed(range(len(parts))):
+            prefix = "/".join(parts[:depth])
+            entries = self._list_tree(f"{parent}:{prefix}") if parent else {}
+            if sha:
+                entries[parts[depth]] = ("040000", "tree", sha)
+            else:
+                entries.pop(parts[depth], None)
+            sha = self._make_tree(entries) if entries or not depth else None
+        tree = sha
+
+        if parent and tree == self._git("rev-parse", f"{parent}^{{tree}}").strip():
+            raise CommitError("nothing to commit")
+
+        args = ["commit-tree", tree, "-m", message]
+        if parent:
+            args += ["-p", parent]
+        commit = self._git(*args).strip()
+        self._git("update-ref", "-m", f"commit: {message}", "HEAD", commit, parent or "")
+        self._update_index("/".join(parts))
+        return commit
+
+    def _update_index(self, path):
+        # entries of the files removed from the directory and of the ones on disk
+        files = set(self._git("ls-files", "-z", "--", path).split("\0"))
+        for root, _, names in os.walk(self.toplevel / path):
+            for name in names:
+                files.add(Path(os.path.relpath(Path(root) / name, self.toplevel)).as_posix())
+        files.discard("")
+
+        stdin = "".join(f"{file}\0" for file in sorted(files)).encode()
+        self._git("update-index", "--add", "--remove", "-z", "--stdin", input=stdin)
+
+    def close(self):
+        if self._mktree is not None:
+            self._mktree.stdin.close()
+            self._mktree.wait()
+            self._mktree = None
@@ -38,6 +38,16 @@ def validate(config):
             v = (str(minimum_version).split(".") + [0, 0, 0])[:3]
             package["minimum-version"] = semver.VersionInfo(*v)
 
+    stacks = config.get("stacks", None) or []
+    if type(stacks) is not list or not all(type(stack) is dict for stack in stacks):
+        raise ValueError("stacks must be a list of environment mappings")
+    config["stacks"] = [{str(k): str(v) for k, v in stack.items()} for stack in stacks]
+
+    registries = config.get("epr", None) or {}
+    if type(registries) is not dict or not all(branch in assets.branches for branch in registries):
+        raise ValueError(f"epr must be a mapping of branch to registry URL, branches: {', '.join(assets.branches)}")
+    config["epr"] = {branch: str(url) for branch, url in registries.items()}
+
     return config
 
 
@@ -4,26 +4,195 @@
 
 import requests
 import functools
+import threading
+from pathlib import Path
+from contextlib import contextmanager
 
+from assets import trace
 
-@functools.lru_cache
-def get_epr():
+# package registry serving the packages of each branch
+registries = {
+    "production": "https://epr.elastic.co",
+    "staging": "https://epr-staging.elastic.co",
+    "snapshot": "https://epr-snapshot.elastic.co",
+}
+
+
+class Epr:
+    """
+    Client of the Elastic Package Registry.
+
+    :param url: base URL of the registry
+    :param http_cache: optional :py:class:`assets.httpcache.HttpCache`, unchanged responses are revalidated
+    """
+
+    url = registries["production"]
 
-    class Epr:
-        url = "https://epr.elastic.co"
+    def __init__(self, url=None, http_cache=None):
+        if url:
+            self.url = url.rstrip("/")
+        self.session = requests.Session()
+        if http_cache is not None:
+            from assets.httpcache import mount
+            mount(self.session, http_cache)
 
-        def __init__(self):
-            self.session = requests.Session()
+    def close(self):
+        self.session.close()
 
-        def close(self):
-            self.session.close()
+    def search(self, package=None, all=False):
+        url = f"{self.url}/search?all={int(all)}"
+        if package:
+            url += f"&package={package}"
+        res = self.session.get(url)
+        res.raise_for_status()
+        return res.json()
 
-        def search(self, package=None, all=False):
-            url = f"{self.url}/search?all={int(all)}"
-            if package:
-                url += f"&package={package}"
-            res = self.session.get(url)
+    def download(self, path, f):
+        """
+        Download a file of the registry.
+
+        :param path: path of the file, ex. the `download` field of a search result
+        :param f: binary file object the content is written to
+        """
+
+        with self.session.get(f"{self.url}{path}", stream=True) as res:
             res.raise_for_status()
-            return res.json()
+            for chunk in res.iter_content(64 * 1024):
+                f.write(chunk)
+
+
+@functools.lru_cache
+def get_epr(url=None, http_cache=None):
+    """
+    Get a shared Elastic Package Registry client.
+
+    :param url: base URL of the registry, the production one if not given
+    :param http_cache: optional :py:class:`assets.httpcache.HttpCache`, unchanged responses are revalidated
+    """
+
+    return Epr(url, http_cache)
+
+
+def _extract_zip(f, dest, strip=1):
+    import shutil
+    import zipfile
+
+    dest = Path(dest).resolve()
+    with zipfile.ZipFile(f) as zf:
+        for info in zf.infolist():
+            parts = info.filename.split("/")[strip:]
+            if info.is_dir() or not parts or not parts[-1]:
+                continue
+            filename = dest.joinpath(*parts).resolve()
+            if dest not in filename.parents:
+                raise ValueError(f"Invalid path in package archive: {info.filename}")
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as src, open(filename, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+
+class EprSource:
+    """
+    Packages read from the search index of the package registries, one registry per branch.
+
+    The versions of all the packages of a branch come from a single `search?all=1`
+    response, packages are downloaded only when they need to be installed. The
+    revision of a branch is the hash of its search response: if that is unchanged
+    since the last run, nothing needs to be re-evaluated.
+
+    :param urls: mapping of branch to registry URL, overriding the default registries
+    :param http_cache: optional :py:class:`assets.httpcache.HttpCache`, unchanged responses are revalidated
+    """
+
+    def __init__(self, urls=None, http_cache=None):
+        self.urls = dict(registries, **(urls or {}))
+        self.http_cache = http_cache
+        self._eprs = {}
+        self._packages = {}
+        self._revisions = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            for epr in self._eprs.values():
+                epr.close()
+            self._eprs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_epr(self, branch):
+        with self._lock:
+            if branch not in self._eprs:
+                self._eprs[branch] = Epr(self.urls[branch], self.http_cache)
+            return self._eprs[branch]
+
+    def _get_packages(self, branch):
+        import json
+        import hashlib
+
+        if branch not in self.urls:
+            return {}
+        epr = self._get_epr(branch)
+        with self._lock:
+            if branch not in self._packages:
+                with trace.span("epr search", branch=branch, packages=0) as span:
+                    results = epr.search(all=True)
+                    span["packages"] = len(results)
+                packages = {}
+                for result in results:
+                    packages.setdefault(result["name"], {})[result["version"]] = result
+                data = json.dumps(results, sort_keys=True).encode()
+                self._revisions[branch] = f"sha256:{hashlib.sha256(data).hexdigest()}"
+                self._packages[branch] = packages
+            return self._packages[branch]
+
+    def walk(self):
+        for branch in self.urls:
+            for package, versions in self._get_packages(branch).items():
+                for version in versions:
+                    yield branch, package, version
+
+    def get_versions(self, branch, package):
+        return list(self._get_packages(branch).get(package, {}))
+
+    def get_manifest(self, branch, package, version, index=None):
+        return self._get_packages(branch).get(package, {}).get(version)
+
+    def get_revision(self, branch):
+        if branch in self.urls:
+            self._get_packages(branch)
+            return self._revisions[branch]
+
+    def get_changed_packages(self, branch, since):
+        """
+        Get the packages changed since a given revision.
+
+        The search response does not tell what changed, only if anything did.
+
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param since: revision of the branch
+        :return: empty set if nothing changed, None if the changes are unknown
+        """
+
+        if since == self.get_revision(branch):
+            return set()
+        return None
+
+    @contextmanager
+    def package_dir(self, branch, package, version):
+        import tempfile
 
-    return Epr()
+        result = self._get_packages(branch)[package][version]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            package_dir = Path(tmp_dir) / package / version
+            with trace.span("epr download", package=package, version=version, bytes=0) as span, \
+                    tempfile.TemporaryFile() as f:
+                self._get_epr(branch).download(result["download"], f)
+                span["bytes"] = f.tell()
+                f.seek(0)
+                _extract_zip(f, package_dir)
+            yield package_dir
@@ -3,9 +3,13 @@
 # you may not use this file except in compliance with the Elastic License.
 
 import os
+import threading
+import subprocess
 from pathlib import Path
+from contextlib import contextmanager
 
 import assets
+from assets import trace
 
 packages_dir = Path(__file__).parent
 
@@ -21,10 +25,231 @@ def walk():
             break
 
 
-def get_manifest(branch, package, version):
+def get_manifest(branch, package, version, index=None):
     import yaml
 
     meta_filename = packages_dir / branch / "packages" / package / version / "manifest.yml"
     if meta_filename.exists():
+        if index is not None:
+            return index.load_yaml(meta_filename)
         with open(meta_filename) as f:
             return yaml.safe_load(f)
+
+
+def fingerprint(package_dir):
+    """
+    Compute the fingerprint of a package, the hash of all its files path and content.
+
+    :param package_dir: path of the package version directory
+    :return: fingerprint string, ex. 'sha256:...'
+    """
+
+    import hashlib
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(package_dir):
+        dirs.sort()
+        for file in sorted(files):
+            filename = Path(root) / file
+            path = filename.relative_to(package_dir).as_posix()
+            h.update(f"{path}\0{filename.stat().st_size}\0".encode())
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    h.update(chunk)
+    return f"sha256:{h.hexdigest()}"
+
+
+def _changed_packages(p):
+    if p.returncode:
+        return None
+    changed = set()
+    for path in p.stdout.decode().split("\0"):
+        parts = path.split("/")
+        if len(parts) > 2 and parts[0] == "packages":
+            changed.add(parts[1])
+    return changed
+
+
+class CheckoutSource:
+    """
+    Packages checked out in `packages/<branch>`, one working tree per branch.
+    """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def walk(self):
+        return walk()
+
+    def get_versions(self, branch, package):
+        package_dir = packages_dir / branch / "packages" / package
+        if package_dir.exists():
+            return os.listdir(package_dir)
+        return []
+
+    def get_manifest(self, branch, package, version, index=None):
+        return get_manifest(branch, package, version, index=index)
+
+    @contextmanager
+    def package_dir(self, branch, package, version):
+        yield packages_dir / branch / "packages" / package / version
+
+    def _git(self, branch, *args):
+        return subprocess.run(["git", "-C", packages_dir / branch, *args], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+
+    def get_revision(self, branch):
+        if (packages_dir / branch).exists():
+            p = self._git(branch, "rev-parse", "HEAD")
+            if not p.returncode:
+                return p.stdout.decode().strip()
+
+    def get_changed_packages(self, branch, since):
+        """
+        Get the packages changed since a given revision.
+
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param since: revision of the branch
+        :return: set of package names or None if the changes are unknown
+        """
+
+        if not (packages_dir / branch).exists():
+            return None
+        return _changed_packages(self._git(branch, "diff", "--name-only", "-z", since, "HEAD", "--", "packages/"))
+
+
+class GitSource:
+    """
+    Packages read straight from the object database of a package-storage clone.
+
+    The clone can be bare and partial, ex. `git clone --bare --filter=blob:none`,
+    trees are listed without reading any blob and only the manifests are read.
+    Blobs missing from a partial clone are fetched on demand by git itself.
+
+    :param git_dir: path of the git directory
+    :param ref: ref of each branch, `{branch}` is replaced with the branch name
+    """
+
+    def __init__(self, git_dir, ref="{branch}"):
+        self.git_dir = str(git_dir)
+        self.ref = ref
+        self._trees = {}
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def close(self):
+        with self._lock:
+            if self._batch is not None:
+                self._batch.stdin.close()
+                self._batch.wait()
+                self._batch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _git(self, *args):
+        return subprocess.run(["git", "--git-dir", self.git_dir, *args], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+
+    def _read_blob(self, sha):
+        with self._lock:
+            if self._batch is None:
+                args = ["git", "--git-dir", self.git_dir, "cat-file", "--batch"]
+                self._batch = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._batch.stdin.write(sha.encode() + b"\n")
+            self._batch.stdin.flush()
+            header = self._batch.stdout.readline().split()
+            if len(header) != 3:
+                raise ValueError(f"Cannot read blob {sha}: {b' '.join(header).decode()}")
+            content = self._batch.stdout.read(int(header[2]))
+            self._batch.stdout.read(1)
+            return content
+
+    def _get_tree(self, branch, package):
+        key = (branch, package)
+        if key not in self._trees:
+            versions = {}
+            p = self._git("ls-tree", "-r", "-z", self.ref.format(branch=branch), "--", f"packages/{package}/")
+            if not p.returncode:
+                for line in p.stdout.split(b"\0"):
+                    if not line:
+                        continue
+                    info, path = line.decode().split("\t", 1)
+                    parts = path.split("/")
+                    if len(parts) < 4:
+                        continue
+                    versions.setdefault(parts[2], None)
+                    if len(parts) == 4 and parts[3] == "manifest.yml":
+                        versions[parts[2]] = info.split()[2]
+            self._trees[key] = versions
+        return self._trees[key]
+
+    def get_revision(self, branch):
+        p = self._git("rev-parse", "--verify", "-q", self.ref.format(branch=branch) + "^{commit}")
+        if not p.returncode:
+            return p.stdout.decode().strip()
+
+    def get_changed_packages(self, branch, since):
+        """
+        Get the packages changed since a given revision.
+
+        :param branch: one among 'production', 'staging', 'snapshot'
+        :param since: revision of the branch
+        :return: set of package names or None if the changes are unknown
+        """
+
+        ref = self.ref.format(branch=branch)
+        return _changed_packages(self._git("diff-tree", "-r", "--name-only", "-z", since, ref, "--", "packages/"))
+
+    def walk(self):
+        for branch in assets.branches:
+            p = self._git("ls-tree", "-r", "-d", "-z", "--name-only", self.ref.format(branch=branch), "--", "packages/")
+            if p.returncode:
+                continue
+            for path in p.stdout.decode().split("\0"):
+                parts = path.split("/")
+                if len(parts) == 3:
+                    yield branch, parts[1], parts[2]
+
+    def get_versions(self, branch, package):
+        return list(self._get_tree(branch, package))
+
+    def get_manifest(self, branch, package, version, index=None):
+        import yaml
+
+        sha = self._get_tree(branch, package).get(version)
+        if sha is None:
+            return None
+        if index is not None:
+            return index.load_yaml_blob(sha, lambda: self._read_blob(sha))
+        return yaml.safe_load(self._read_blob(sha))
+
+    @contextmanager
+    def package_dir(self, branch, package, version):
+        import tarfile
+        import tempfile
+
+        path = f"packages/{package}/{version}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with trace.span("git archive", package=package, version=version, files=0) as span:
+                args = ["git", "--git-dir", self.git_dir, "archive", "--format=tar", self.ref.format(branch=branch),
+                        path]
+                p = subprocess.Popen(args, stdout=subprocess.PIPE)
+                with tarfile.open(fileobj=p.stdout, mode="r|") as tar:
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(tmp_dir, filter="data")
+                    else:
+                        tar.extractall(tmp_dir)
+                if p.wait():
+                    raise subprocess.CalledProcessError(p.returncode, args)
+                span["files"] = sum(len(files) for _, _, files in os.walk(tmp_dir))
+            yield Path(tmp_dir) / path
@@ -0,0 +1,166 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import asyncio
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from assets.aio import AsyncClient  # noqa: E402
+from assets.cache import BlobCache, blob_sha  # noqa: E402
+
+repo = "elastic/package-assets"
+
+
+@pytest.fixture
+def package():
+    return "endpoint/8.3.0"
+
+
+@pytest.fixture
+def invalid_package():
+    return "invalid/a.b.c"
+
+
+@pytest.fixture
+def package_paths_list(package):
+    return sorted(f"{package}/{path}" for path in [
+        "index_templates/logs-endpoint.alerts.json",
+        "index_templates/metrics-endpoint.metadata.json",
+        "ingest_pipelines/logs-endpoint.alerts-8.3.0.json",
+        "ingest_pipelines/logs-endpoint.events.file-8.3.0.json",
+        "manifest.yml",
+        "meta.yml",
+    ])
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+@pytest.fixture
+def contents(package_paths_list):
+    return {path: path.encode() * 100 for path in package_paths_list}
+
+
+@pytest.fixture
+def served_repo(tmp_path, package, package_paths_list, contents):
+    """Stand-in of the GitHub API and raw content, the package is in the staging branch only."""
+
+    root = tmp_path / "remote"
+    for path, content in contents.items():
+        write(root / repo / "staging" / path, content)
+
+    def tree(paths, truncated=False):
+        items = [{"path": os.path.relpath(p, package), "type": "blob", "sha": blob_sha(contents.get(p, b"")),
+                  "size": 1} for p in paths]
+        return json.dumps({"tree": items, "truncated": truncated}).encode()
+
+    # subtree of the package, as requested with the `<branch>:<package>` tree-ish
+    write(root / "repos" / repo / "git" / "trees" / f"staging:{package}", tree(package_paths_list))
+
+    # directory listings of the contents API, served as index.html
+    listings = {}
+    for path in package_paths_list:
+        parent, _, _ = path.rpartition("/")
+        listings.setdefault(parent, []).append({"path": path, "type": "file", "sha": blob_sha(contents[path]),
+                                                "size": len(contents[path]), "download_url": None})
+        while parent != package:
+            parent, _, name = parent.rpartition("/")
+            item = {"path": f"{parent}/{name}", "type": "dir"}
+            if item not in listings.setdefault(parent, []):
+                listings[parent].append(item)
+    for path, items in listings.items():
+        write(root / "repos" / repo / "contents" / path / "index.html", json.dumps(items).encode())
+
+    return root
+
+
+def client(server, **kwargs):
+    return AsyncClient(api_url=server.url, raw_url=server.url, backoff=0.01, **kwargs)
+
+
+async def download(server, package, **kwargs):
+    async with client(server, **kwargs) as c:
+        return dict([item async for item in c.download_assets(c.get_remote_assets(package))])
+
+
+def test_download_assets(http_server, served_repo, package, contents):
+    server = http_server(served_repo)
+    downloaded = asyncio.run(download(server, package, limit=4))
+    assert sorted(downloaded.items()) == sorted(contents.items())
+
+
+def test_download_assets_retry(http_server, served_repo, package, contents):
+    server = http_server(served_repo, failures=1)
+    downloaded = asyncio.run(download(server, package, limit=4))
+    assert sorted(downloaded.items()) == sorted(contents.items())
+
+
+def test_get_remote_assets_truncated(http_server, served_repo, package, package_paths_list):
+    subtree = served_repo / "repos" / repo / "git" / "trees" / f"staging:{package}"
+    subtree.write_text(json.dumps(dict(json.loads(subtree.read_bytes()), truncated=True)))
+    server = http_server(served_repo)
+
+    async def get_remote_assets():
+        async with client(server) as c:
+            return [entry async for entry in c.get_remote_assets(package)]
+
+    entries = asyncio.run(get_remote_assets())
+    assert sorted(e.path for e in entries) == package_paths_list
+    assert {e.download_url for e in entries} == {f"{server.url}/{repo}/staging/{p}" for p in package_paths_list}
+    assert any("/contents/" in request for request in server.requests)
+
+
+def test_get_remote_assets_invalid(http_server, served_repo, invalid_package):
+    server = http_server(served_repo)
+    with pytest.raises(ValueError) as exc:
+        asyncio.run(download(server, invalid_package))
+    assert str(exc.value) == f"Package not found: {invalid_package}"
+
+
+def test_get_remote_assets_packed(http_server, served_repo, package):
+    from assets import PackedBranchError
+
+    # a packed version is a single tree file, served to all the branches
+    write(served_repo / "repos" / repo / "contents" / "invalid" / "1.0.0.tree",
+          json.dumps({"path": "invalid/1.0.0.tree", "type": "file"}).encode())
+    server = http_server(served_repo)
+    with pytest.raises(PackedBranchError) as exc:
+        asyncio.run(download(server, "invalid/1.0.0"))
+    assert exc.value.branch == "production"
+
+
+def test_download_assets_cache(http_server, served_repo, package, contents, tmp_path):
+    server = http_server(served_repo)
+    cache = BlobCache(tmp_path / "cache")
+
+    async def cached():
+        async with client(server) as c:
+            entries = [entry async for entry in c.get_remote_assets(package)]
+            first = dict([item async for item in c.download_assets(entries, cache=cache)])
+            requests = len(server.requests)
+            second = dict([item async for item in c.download_assets(entries, cache=cache)])
+            return first, second, len(server.requests) - requests
+
+    first, second, requests = asyncio.run(cached())
+    assert first == second == contents
+    assert requests == 0
+
+
+def test_download_assets_cancel(http_server, served_repo, package):
+    server = http_server(served_repo)
+
+    async def partial():
+        async with client(server, limit=2) as c:
+            downloads = c.download_assets(c.get_remote_assets(package))
+            async for _ in downloads:
+                break
+            await downloads.aclose()
+            return len(asyncio.all_tasks())
+
+    assert asyncio.run(partial()) == 1
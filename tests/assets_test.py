@@ -7,6 +7,7 @@ import pytest
 from pathlib import Path
 
 import assets
+from conftest import FakeRepo
 
 
 @pytest.fixture
@@ -130,3 +131,333 @@ def test_download_assets(entries, package_paths_list):
     contents = assets.download_assets(entries)
     paths = sorted(c[0] for c in contents)
     assert paths == package_paths_list
+
+
+@pytest.fixture
+def fake_trees(package, package_paths_list):
+    return {
+        "production": ["other/1.0.0/meta.yml"],
+        "staging": package_paths_list + ["other/1.0.0/meta.yml", f"{package}1/meta.yml"],
+    }
+
+
+def test_get_remote_assets_tree(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees)
+    entries = list(assets.get_remote_assets(package, repo, tree=True))
+    assert sorted(e.path for e in entries) == package_paths_list
+    assert {e.download_url for e in entries} == {f"{assets.raw_url}/{repo.full_name}/staging/{p}"
+                                                 for p in package_paths_list}
+    assert sorted(repo.calls) == [("tree", f"{b}:{package}") for b in sorted(assets.branches)]
+
+
+def test_get_remote_assets_tree_same_as_contents(package, fake_trees):
+    tree_entries = assets.get_remote_assets(package, FakeRepo(fake_trees), tree=True)
+    contents_entries = assets.get_remote_assets(package, FakeRepo(fake_trees))
+    assert sorted((e.path, e.download_url) for e in tree_entries) == \
+        sorted((e.path, e.download_url) for e in contents_entries)
+
+
+def test_resolve_remote_assets(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees)
+    resolved = list(assets.resolve_remote_assets([package, "other/1.0.0", "missing/1.0.0"], repo))
+    assert [p for p, _ in resolved] == [package, "other/1.0.0", "missing/1.0.0"]
+    assert sorted(e.path for e in resolved[0][1]) == package_paths_list
+    assert [(e.path, e.download_url) for e in resolved[1][1]] == \
+        [("other/1.0.0/meta.yml", f"{assets.raw_url}/{repo.full_name}/production/other/1.0.0/meta.yml")]
+    assert resolved[2][1] is None
+    # each branch is listed once
+    assert sorted(repo.calls) == [("tree", b) for b in sorted(assets.branches)]
+
+
+def test_resolve_remote_assets_single(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees)
+    resolved = dict(assets.resolve_remote_assets([package], repo))
+    assert sorted(e.path for e in resolved[package]) == package_paths_list
+    # the branches are not listed whole for a single package
+    assert sorted(repo.calls) == [("tree", f"{b}:{package}") for b in sorted(assets.branches)]
+
+
+def test_resolve_remote_assets_truncated(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees, truncated=True)
+    resolved = dict(assets.resolve_remote_assets([package, "missing/1.0.0"], repo))
+    assert sorted(e.path for e in resolved[package]) == package_paths_list
+    assert resolved["missing/1.0.0"] is None
+
+
+def test_resolve_remote_assets_branch_truncated(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees, truncated="branch")
+    resolved = dict(assets.resolve_remote_assets([package, "other/1.0.0", "missing/1.0.0"], repo))
+    assert sorted(e.path for e in resolved[package]) == package_paths_list
+    assert [(e.path, e.download_url) for e in resolved["other/1.0.0"]] == \
+        [("other/1.0.0/meta.yml", f"{assets.raw_url}/{repo.full_name}/production/other/1.0.0/meta.yml")]
+    assert resolved["missing/1.0.0"] is None
+    # the subtree of each package is probed on all the branches, the contents API only looks for packed versions
+    for name in (package, "other/1.0.0", "missing/1.0.0"):
+        assert {call[1] for call in repo.calls if call[0] == "tree" and call[1].endswith(f":{name}")} == \
+            {f"{b}:{name}" for b in assets.branches}
+    assert sorted(call for call in repo.calls if call[0] == "contents") == \
+        [("contents", b, "missing/1.0.0.tree") for b in sorted(assets.branches)]
+
+
+def test_select_assets(package, package_paths_list, fake_trees):
+    entries = list(assets.get_remote_assets(package, FakeRepo(fake_trees), tree=True))
+    selected = assets.select_assets(entries, package, include=["index_templates/*", "*.yml"], exclude=["meta.yml"])
+    paths = [os.path.relpath(p, package) for p in package_paths_list]
+    assert sorted(os.path.relpath(e.path, package) for e in selected) == \
+        sorted(p for p in paths if p.startswith("index_templates/") or p.endswith(".yml") and p != "meta.yml")
+    assert list(assets.select_assets(entries, package)) == entries
+
+
+def test_get_remote_assets_tree_truncated(package, package_paths_list, fake_trees):
+    repo = FakeRepo(fake_trees, truncated=True)
+    entries = assets.get_remote_assets(package, repo, tree=True)
+    assert sorted(e.path for e in entries) == package_paths_list
+
+
+def test_get_remote_assets_tree_invalid(invalid_package, fake_trees):
+    with pytest.raises(ValueError) as exc:
+        _ = list(assets.get_remote_assets(invalid_package, FakeRepo(fake_trees), tree=True))
+    assert str(exc.value) == f"Package not found: {invalid_package}"
+
+
+@pytest.fixture
+def packed_trees(package):
+    return {"production": [".objects/ab/cdef", f"{package}.tree"]}
+
+
+@pytest.mark.parametrize("tree", [False, True])
+def test_get_remote_assets_packed(package, packed_trees, tree):
+    with pytest.raises(assets.PackedBranchError) as exc:
+        _ = list(assets.get_remote_assets(package, FakeRepo(packed_trees), tree=tree))
+    assert exc.value.branch == "production"
+
+
+@pytest.mark.parametrize("packages", [["endpoint/8.3.0"], ["endpoint/8.3.0", "endpoint/8.4.0"]])
+def test_resolve_remote_assets_packed(packages, packed_trees):
+    with pytest.raises(assets.PackedBranchError):
+        _ = list(assets.resolve_remote_assets(packages, FakeRepo(packed_trees)))
+    # a package missing from a packed branch is just not found
+    assert list(assets.resolve_remote_assets(["missing/1.0.0"], FakeRepo(packed_trees))) == [("missing/1.0.0", None)]
+
+
+@pytest.fixture
+def served_assets(tmp_path, package, package_paths_list):
+    root = tmp_path / "remote"
+    for path in package_paths_list:
+        filename = root / path
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_bytes(path.encode() * 100)
+    return root
+
+
+def test_iter_local_assets(served_assets, package, package_paths_list):
+    handles = sorted(assets.iter_local_assets(package, served_assets))
+    assert [h.path for h in handles] == package_paths_list
+    for h in handles:
+        content = h.path.encode() * 100
+        assert h.size == len(content)
+        assert h.read() == content
+        assert b"".join(h.chunks(1000)) == content
+        with h.mmap() as m:
+            assert m[:] == content
+
+
+def test_iter_local_assets_empty(tmp_path):
+    (tmp_path / "pkg" / "1.0.0").mkdir(parents=True)
+    (tmp_path / "pkg" / "1.0.0" / "empty.json").touch()
+    [h] = assets.iter_local_assets("pkg/1.0.0", tmp_path)
+    assert h.size == 0
+    assert list(h.chunks()) == []
+    with h.mmap() as m:
+        assert m == b""
+
+
+def test_iter_local_assets_invalid(tmp_path, invalid_package):
+    with pytest.raises(ValueError) as exc:
+        _ = list(assets.iter_local_assets(invalid_package, tmp_path))
+    assert str(exc.value) == f"Package not found: {invalid_package}"
+
+
+def test_read_local_assets_threads(served_assets, package, package_paths_list, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cwd = os.getcwd()
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: dict(assets.read_local_assets(package, served_assets, workers=4)),
+                                    range(8)))
+    assert os.getcwd() == cwd
+    for contents in results:
+        assert sorted(contents) == package_paths_list
+        assert all(content == path.encode() * 100 for path, content in contents.items())
+    assert dict(assets.get_local_assets(package, served_assets)) == results[0]
+
+
+def make_entries(server, paths):
+    return [assets.RemoteEntry(p, f"sha-{p}", None, f"{server.url}/{p}") for p in paths]
+
+
+def test_download_assets_local(http_server, served_assets, package_paths_list):
+    server = http_server(served_assets)
+    contents = dict(assets.download_assets(make_entries(server, package_paths_list), workers=4))
+    assert sorted(contents) == package_paths_list
+    assert all(content == path.encode() * 100 for path, content in contents.items())
+
+
+def test_download_assets_retry(http_server, served_assets, package_paths_list):
+    server = http_server(served_assets, failures=2)
+    entries = make_entries(server, package_paths_list[:5])
+    contents = list(assets.download_assets(entries, retries=2, backoff=0))
+    assert len(contents) == 5
+    assert len(server.requests) == 15
+
+
+def test_download_assets_retry_exhausted(http_server, served_assets, package_paths_list):
+    import requests
+
+    server = http_server(served_assets, failures=2)
+    with pytest.raises(requests.HTTPError):
+        _ = list(assets.download_assets(make_entries(server, package_paths_list[:1]), retries=1, backoff=0))
+
+
+def test_download_assets_not_found(http_server, served_assets):
+    import requests
+
+    server = http_server(served_assets, failures=2)
+    with pytest.raises(requests.HTTPError):
+        _ = list(assets.download_assets(make_entries(server, ["missing.json"]), retries=3, backoff=0))
+    assert len(server.requests) == 3
+
+
+def test_save_assets(http_server, served_assets, tmp_path, package, package_paths_list):
+    server = http_server(served_assets)
+    output_dir = tmp_path / "output"
+    saved = list(assets.save_assets(make_entries(server, package_paths_list), package, output_dir, workers=2))
+    assert sorted(path for path, _ in saved) == package_paths_list
+    for path, filename in saved:
+        assert filename == output_dir / os.path.relpath(path, package)
+        assert filename.read_bytes() == path.encode() * 100
+
+
+def test_save_archive_assets_unsafe(http_server, served_assets, tmp_path, package):
+    import io
+    import tarfile
+
+    with tarfile.open(served_assets / "production.tar.gz", "w:gz") as tar:
+        for name, data in [("meta.yml", b"ok"), ("../../../escaped", b"x"), ("a/../../escaped", b"x")]:
+            info = tarfile.TarInfo(f"package-assets-0123abc/{package}/{name}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        link = tarfile.TarInfo(f"package-assets-0123abc/{package}/link")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "/etc/passwd"
+        tar.addfile(link)
+
+    server = http_server(served_assets)
+    output_dir = tmp_path / "out" / "put"
+    saved = list(assets.save_archive_assets(package, f"{server.url}/production.tar.gz", output_dir))
+    assert saved == [(f"{package}/meta.yml", output_dir / "meta.yml")]
+    assert not [p for p in tmp_path.rglob("*") if p.name in ("escaped", "link")]
+    assert not list(output_dir.rglob("*.part"))
+
+
+def make_blob_entries(server, paths, root):
+    from assets.cache import file_blob_sha
+
+    return [assets.RemoteEntry(p, file_blob_sha(root / p), None, f"{server.url}/{p}") for p in paths]
+
+
+def test_download_assets_cache(http_server, served_assets, tmp_path, package_paths_list):
+    from assets.cache import BlobCache
+
+    server = http_server(served_assets)
+    cache = BlobCache(tmp_path / "cache")
+    entries = make_blob_entries(server, package_paths_list, served_assets)
+
+    first = dict(assets.download_assets(entries, cache=cache))
+    assert len(server.requests) == len(package_paths_list)
+    second = dict(assets.download_assets(entries, cache=cache))
+    assert len(server.requests) == len(package_paths_list)
+    assert first == second
+
+
+def test_save_assets_cache(http_server, served_assets, tmp_path, package, package_paths_list):
+    import shutil
+    from assets.cache import BlobCache
+
+    server = http_server(served_assets)
+    cache = BlobCache(tmp_path / "cache")
+
+    # next version of the package, only the manifest changed
+    next_package = package.replace("8.3.0", "8.4.0")
+    shutil.copytree(served_assets / package, served_assets / next_package)
+    (served_assets / next_package / "manifest.yml").write_bytes(b"changed")
+    next_paths = [p.replace(package, next_package) for p in package_paths_list]
+
+    entries = make_blob_entries(server, package_paths_list, served_assets)
+    _ = list(assets.save_assets(entries, package, tmp_path / "v1", cache=cache))
+    assert len(server.requests) == len(package_paths_list)
+
+    entries = make_blob_entries(server, next_paths, served_assets)
+    saved = list(assets.save_assets(entries, next_package, tmp_path / "v2", cache=cache))
+    assert server.requests[len(package_paths_list):] == [f"/{next_package}/manifest.yml"]
+    assert len(saved) == len(next_paths)
+    assert (tmp_path / "v2" / "manifest.yml").read_bytes() == b"changed"
+    assert (tmp_path / "v2" / "meta.yml").read_bytes() == (tmp_path / "v1" / "meta.yml").read_bytes()
+
+
+@pytest.fixture
+def served_archive(served_assets, package):
+    import tarfile
+
+    (served_assets / "other" / "1.0.0").mkdir(parents=True)
+    (served_assets / "other" / "1.0.0" / "meta.yml").write_bytes(b"other")
+    with tarfile.open(served_assets / "production.tar.gz", "w:gz") as tar:
+        for name in ("endpoint", "other"):
+            tar.add(served_assets / name, f"package-assets-0123abc/{name}")
+    return served_assets
+
+
+def test_get_archive_url(package, fake_trees):
+    url = assets.get_archive_url(package, FakeRepo(fake_trees))
+    assert url == "https://codeload.github.com/elastic/package-assets/tar.gz/refs/heads/staging"
+
+
+def test_get_archive_url_invalid(invalid_package, fake_trees):
+    with pytest.raises(ValueError) as exc:
+        _ = assets.get_archive_url(invalid_package, FakeRepo(fake_trees))
+    assert str(exc.value) == f"Package not found: {invalid_package}"
+
+
+def test_get_archive_url_packed(package, packed_trees):
+    with pytest.raises(assets.PackedBranchError):
+        _ = assets.get_archive_url(package, FakeRepo(packed_trees))
+
+
+def test_download_archive_assets_packed(http_server, tmp_path, package):
+    import io
+    import tarfile
+
+    with tarfile.open(tmp_path / "production.tar.gz", "w:gz") as tar:
+        for name in (".objects/ab/cdef", f"{package}.tree"):
+            info = tarfile.TarInfo(f"package-assets-0123abc/{name}")
+            tar.addfile(info, io.BytesIO())
+    server = http_server(tmp_path)
+    with pytest.raises(assets.PackedBranchError):
+        _ = list(assets.download_archive_assets(package, f"{server.url}/production.tar.gz"))
+
+
+def test_download_archive_assets(http_server, served_archive, package, package_paths_list):
+    server = http_server(served_archive)
+    contents = dict(assets.download_archive_assets(package, f"{server.url}/production.tar.gz"))
+    assert sorted(contents) == package_paths_list
+    assert all(content == path.encode() * 100 for path, content in contents.items())
+
+
+def test_save_archive_assets(http_server, served_archive, tmp_path, package, package_paths_list):
+    server = http_server(served_archive)
+    output_dir = tmp_path / "output"
+    saved = list(assets.save_archive_assets(package, f"{server.url}/production.tar.gz", output_dir))
+    assert sorted(path for path, _ in saved) == package_paths_list
+    for path, filename in saved:
+        assert filename == output_dir / os.path.relpath(path, package)
+        assert filename.read_bytes() == path.encode() * 100
@@ -0,0 +1,60 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import pytest
+from click.testing import CliRunner
+
+import assets
+import packages
+import bot.__main__ as bot
+from benchmarks.__main__ import main, cases
+
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    # the benchmarks point the modules to the synthetic trees
+    for module, name in [(assets, "assets_dir"), (packages, "packages_dir"), (bot, "config"), (bot, "index")]:
+        monkeypatch.setattr(module, name, getattr(module, name))
+
+    def run(*args, exit_code=0):
+        args = ["--work-dir", tmp_path / "work", "--baseline", tmp_path / "baseline.json", "--packages", 3,
+                "--versions", 4, "--files", 5, "--file-size", 1, "--repeat", 1, *args]
+        result = CliRunner().invoke(main, [str(arg) for arg in args], catch_exceptions=False)
+        assert result.exit_code == exit_code, result.output
+        return result.output
+
+    return run
+
+
+def test_benchmarks(bench, tmp_path):
+    bench("--update-baseline", "--history", tmp_path / "history.jsonl")
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    assert sorted(baseline["results"]) == sorted(cases)
+    assert baseline["scale"] == {"packages": 3, "versions": 4, "files": 5, "file_size": 1}
+    assert len((tmp_path / "history.jsonl").read_text().splitlines()) == 1
+
+    # the trees are reused
+    assert (tmp_path / "work" / "assets" / "production" / "package002" / "1.0.2" / "meta.yml").exists()
+    assert not (tmp_path / "work" / "assets" / "production" / "package002" / "1.0.3").exists()
+    output = bench("--tolerance", 100, "-k", "walk", "-k", "make_plan")
+    assert "walk" in output and "make_plan" in output and "get_meta" not in output
+
+
+def test_benchmarks_regression(bench, tmp_path):
+    bench("--update-baseline", "-k", "get_manifest")
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    baseline["results"]["get_manifest"] /= 1000
+    baseline["results"]["get_manifest"] -= 1
+    (tmp_path / "baseline.json").write_text(json.dumps(baseline))
+    output = bench("-k", "get_manifest", exit_code=1)
+    assert "REGRESSION" in output
+
+    # the regressions of the cases not gated are only reported
+    baseline["gated"] = ["walk"]
+    (tmp_path / "baseline.json").write_text(json.dumps(baseline))
+    output = bench("-k", "get_manifest")
+    assert "regression, not gated" in output
+    bench("--update-baseline", "-k", "get_manifest")
+    assert json.loads((tmp_path / "baseline.json").read_text())["gated"] == ["walk"]
@@ -0,0 +1,423 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import yaml
+import shutil
+import pytest
+from click.testing import CliRunner
+
+import assets
+import bot.__main__ as bot
+from bot.__main__ import cli
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    filename = tmp_path / "config.yaml"
+    filename.write_text(yaml.dump({"tracked-packages": ["endpoint", "nginx", {"kafka": {"branches": "staging"}}]}))
+    return filename
+
+
+@pytest.fixture
+def local_assets(tmp_path, monkeypatch):
+    assets_dir = tmp_path / "assets"
+    meta_file = assets_dir / "production" / "endpoint" / "8.2.0" / "meta.yml"
+    meta_file.parent.mkdir(parents=True)
+    meta_file.write_text(yaml.dump({"stack": {"version": "8.4.0"}}))
+    monkeypatch.setattr(assets, "assets_dir", assets_dir)
+    return assets_dir
+
+
+def run(*args):
+    result = CliRunner().invoke(cli, [str(arg) for arg in args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_plan_git_source(config_file, local_assets, checkouts, git_dir, tmp_path):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    output = run(*options, "plan")
+    assert "+8.3.0" in output and " 8.2.0" in output
+    assert run(*options, "plan", "--source", "git", "--git-dir", git_dir) == output
+    assert run(*options, "plan", "--source", "git", "--git-dir", git_dir, "--branches", "staging") == \
+        run(*options, "plan", "--branches", "staging")
+
+
+def test_plan_formats(config_file, local_assets, checkouts, tmp_path):
+    import json
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    records = [json.loads(line) for line in run(*options, "plan", "--format", "jsonl").splitlines()]
+    assert json.loads(run(*options, "plan", "--format", "json")) == records
+    assert {"package": "endpoint", "branch": "production", "version": "8.2.0", "action": "keep"} in records
+    assert {"package": "endpoint", "branch": "production", "version": "8.3.0", "action": "install"} in records
+
+    # same versions as the text format
+    lines = [line for line in run(*options, "plan").splitlines() if not line.startswith(("---", "+++", "@@"))]
+    assert sorted(line[1:] for line in lines) == sorted(r["version"] for r in records)
+    assert sorted(line[1:] for line in lines if line[0] == "+") == \
+        sorted(r["version"] for r in records if r["action"] == "install")
+
+
+def add_meta(assets_dir, branch, package, version):
+    meta_file = assets_dir / branch / package / version / "meta.yml"
+    meta_file.parent.mkdir(parents=True, exist_ok=True)
+    meta_file.write_text(yaml.dump({"stack": {"version": "8.4.0"}}))
+
+
+def test_plan_incremental(config_file, local_assets, checkouts, storage, tmp_path):
+    from conftest import git
+
+    state_file = tmp_path / "state.yml"
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    plan = [*options, "plan", "--incremental", "--state", state_file]
+
+    assert run(*plan)
+    assert not state_file.exists()
+
+    for branch, package, version in [("production", "endpoint", "8.3.0"), ("production", "nginx", "1.2.0"),
+                                     ("staging", "endpoint", "8.3.0"), ("staging", "endpoint", "8.4.0"),
+                                     ("staging", "kafka", "0.5.0")]:
+        add_meta(local_assets, branch, package, version)
+    assert run(*plan) == ""
+    state = yaml.safe_load(state_file.read_text())
+    assert state["production"]["packages"] == git("rev-parse", "HEAD", cwd=checkouts / "production").strip()
+
+    # new nginx version in production, endpoint assets lost outside of git
+    git("checkout", "-q", "production", cwd=storage)
+    (storage / "packages" / "nginx" / "1.3.0").mkdir()
+    (storage / "packages" / "nginx" / "1.3.0" / "manifest.yml").write_text("name: nginx\n")
+    git("add", ".", cwd=storage)
+    git("commit", "-qm", "nginx 1.3.0", cwd=storage)
+    git("pull", "-q", cwd=checkouts / "production")
+    (local_assets / "production" / "endpoint" / "8.3.0" / "meta.yml").unlink()
+
+    output = run(*plan)
+    assert "+1.3.0" in output and "endpoint" not in output
+    assert "+8.3.0" in run(*options, "plan")
+
+    since = git("rev-parse", "HEAD~1", cwd=checkouts / "production").strip()
+    assert run(*options, "plan", "--branches", "production", "--since", since) == output
+    result = CliRunner().invoke(cli, [str(arg) for arg in [*options, "plan", "--since", since]])
+    assert result.exit_code == 2 and "--since needs exactly one branch" in result.output
+
+    # a change of the tracked packages of a branch needs its full plan
+    config_file.write_text(yaml.dump({"tracked-packages": [{"endpoint": {"minimum-version": "8.0"}}, "nginx",
+                                                           {"kafka": {"branches": "staging"}}]}))
+    output = run(*plan)
+    assert "+1.3.0" in output and "+8.3.0" in output
+
+
+@pytest.fixture
+def elastic_package(tmp_path, monkeypatch):
+    """Fake elastic-package, dumps an index template for each installed package."""
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "elastic-package"
+    script.write_text("""#!/bin/sh
+case "$1" in
+    install)
+        grep -q fail manifest.yml && echo "install failed" && exit 1
+        echo "$2 $(basename $PWD) $ELASTIC_PACKAGE_ELASTICSEARCH_HOST" >> "$FAKE_ELASTIC_PACKAGE_LOG"
+        ;;
+    dump)
+        mkdir -p "$6/index_templates"
+        echo "{\\"name\\": \\"$4\\"}" > "$6/index_templates/$4.json"
+        ;;
+esac
+""")
+    script.chmod(0o755)
+    log = tmp_path / "elastic-package.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_ELASTIC_PACKAGE_LOG", str(log))
+    monkeypatch.setattr(bot, "get_stack_version", lambda env=None: "8.4.0")
+    return log
+
+
+@pytest.fixture
+def assets_repos(local_assets, monkeypatch):
+    from conftest import git
+
+    for branch in ("production", "staging"):
+        (local_assets / branch).mkdir(exist_ok=True)
+        git("init", "-q", cwd=local_assets / branch)
+        git("commit", "-q", "--allow-empty", "-m", "init", cwd=local_assets / branch)
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "test")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "test@example.com")
+    return local_assets
+
+
+def git_log(repo):
+    from conftest import git
+
+    return git("log", "--format=%s", cwd=repo).splitlines()
+
+
+def test_update(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    output = run(*options, "update", "--jobs", "2", "--state", tmp_path / "state.yml")
+
+    assert sorted(git_log(assets_repos / "production")) == [
+        "Add assets: endpoint 8.3.0 (production, 8.4.0)",
+        "Add assets: nginx 1.2.0 (production, 8.4.0)",
+        "init",
+    ]
+    assert sorted(git_log(assets_repos / "staging")) == [
+        "Add assets: endpoint 8.3.0 (staging, 8.4.0)",
+        "Add assets: endpoint 8.4.0 (staging, 8.4.0)",
+        "Add assets: kafka 0.5.0 (staging, 8.4.0)",
+        "init",
+    ]
+    asset_dir = assets_repos / "staging" / "endpoint" / "8.4.0"
+    meta = yaml.safe_load((asset_dir / "meta.yml").read_text())
+    assert meta["stack"] == {"version": "8.4.0"}
+    assert meta["package"]["fingerprint"].startswith("sha256:")
+    assert (asset_dir / "index_templates" / "endpoint.json").exists()
+    assert (asset_dir / "manifest.yml").exists()
+    assert "  index_templates/endpoint.json\n" in (asset_dir / "checksums.sha256").read_text()
+
+    # endpoint versions are installed in order, 8.3.0 is the same in production and staging
+    installs = [line.split()[:2] for line in elastic_package.read_text().splitlines()]
+    assert [version for package, version in installs if package == "endpoint"] == ["8.3.0", "8.4.0"]
+    assert "reuse assets of " in output
+    for path in ("index_templates/endpoint.json", "manifest.yml"):
+        assert (assets_repos / "production" / "endpoint" / "8.3.0" / path).read_bytes() == \
+            (assets_repos / "staging" / "endpoint" / "8.3.0" / path).read_bytes()
+
+    assert "5 updated, 0 failed" in output
+    assert (tmp_path / "state.yml").exists()
+    assert run(*options, "plan") == ""
+
+
+def test_update_failure(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    manifest = checkouts / "staging" / "packages" / "endpoint" / "8.3.0" / "manifest.yml"
+    manifest.write_text("name: endpoint\ndescription: fail\n")
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    output = run(*options, "update", "--state", tmp_path / "state.yml")
+
+    assert "endpoint 8.3.0 (staging, 8.4.0): failed: Subprocess returned 1" in output
+    assert "4 updated, 1 failed" in output
+    assert "Add assets: endpoint 8.4.0 (staging, 8.4.0)" in git_log(assets_repos / "staging")
+    assert not (tmp_path / "state.yml").exists()
+    assert [line for line in run(*options, "plan").splitlines() if line[:2] == "+8"] == ["+8.3.0"]
+
+
+def test_update_stacks(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    config = yaml.safe_load(config_file.read_text())
+    config["stacks"] = [{"ELASTIC_PACKAGE_ELASTICSEARCH_HOST": f"https://es{i}:9200"} for i in range(3)]
+    config_file.write_text(yaml.dump(config))
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    assert "5 updated, 0 failed" in run(*options, "update")
+    hosts = {line.split()[2] for line in elastic_package.read_text().splitlines()}
+    assert hosts <= {"https://es0:9200", "https://es1:9200", "https://es2:9200"}
+
+
+def test_update_reuse(config_file, assets_repos, checkouts, elastic_package, tmp_path, monkeypatch):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    run(*options, "update", "--branches", "production")
+    dump = assets_repos / "production" / "endpoint" / "8.3.0" / "meta.yml"
+    # dumped before the fingerprints were recorded
+    dump.write_text(yaml.dump({"stack": {"version": "8.4.0"}}))
+
+    elastic_package.write_text("")
+    run(*options, "update", "--branches", "staging")
+    installs = [line.split()[:2] for line in elastic_package.read_text().splitlines()]
+    assert sorted(installs) == [["endpoint", "8.4.0"], ["kafka", "0.5.0"]]
+
+    # a different stack version needs a new install
+    shutil.rmtree(assets_repos / "staging" / "endpoint" / "8.3.0")
+    monkeypatch.setattr(bot, "get_stack_version", lambda env=None: "8.5.0")
+    elastic_package.write_text("")
+    run(*options, "update", "--branches", "staging")
+    installs = [line.split()[:2] for line in elastic_package.read_text().splitlines()]
+    assert installs == [["endpoint", "8.3.0"]]
+
+
+def test_install_chains_error(monkeypatch):
+    def fail(*args):
+        raise RuntimeError("broken result")
+
+    monkeypatch.setattr(bot, "install_version", lambda *args: None)
+    monkeypatch.setattr(bot, "Result", fail)
+    chains = [[("endpoint", "staging", "8.3.0"), ("endpoint", "staging", "8.4.0")]]
+    with pytest.raises(RuntimeError, match="broken result"):
+        list(bot.install_chains(None, chains, [bot.Stack({}, "8.4.0")]))
+
+
+def test_update_jobs(config_file, tmp_path):
+    result = CliRunner().invoke(cli, ["--config", str(config_file), "--index", "", "update", "--jobs", "0"])
+    assert result.exit_code == 2 and "--jobs" in result.output
+
+
+def test_update_batch_commit(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    from conftest import git
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    output = run(*options, "update", "--batch-commit")
+    assert "5 updated, 0 failed" in output
+    assert sorted(git_log(assets_repos / "staging")) == [
+        "Add assets: endpoint 8.3.0 (staging, 8.4.0)",
+        "Add assets: endpoint 8.4.0 (staging, 8.4.0)",
+        "Add assets: kafka 0.5.0 (staging, 8.4.0)",
+        "init",
+    ]
+    assert git("status", "--porcelain", cwd=assets_repos / "staging") == ""
+    assert git("status", "--porcelain", cwd=assets_repos / "production") == "?? endpoint/8.2.0/\n"
+
+
+@pytest.fixture
+def epr_servers(storage, config_file, http_server, tmp_path, monkeypatch):
+    """Package registries serving the packages of the package-storage branches."""
+
+    import json
+    from conftest import git
+
+    servers = {}
+    for branch in ("production", "staging", "snapshot"):
+        root = tmp_path / "epr" / branch
+        root.mkdir(parents=True)
+        results = []
+        if branch != "snapshot":
+            for path in git("ls-tree", "-r", "--name-only", branch, "--", "packages/", cwd=storage).splitlines():
+                _, package, version, name = path.split("/", 3)
+                if name != "manifest.yml":
+                    continue
+                download = f"/epr/{package}/{package}-{version}.zip"
+                (root / "epr" / package).mkdir(parents=True, exist_ok=True)
+                git("archive", "--format=zip", f"--prefix={package}-{version}/", "-o", root / download[1:],
+                    f"{branch}:packages/{package}/{version}", cwd=storage)
+                results.append({"name": package, "version": version, "download": download})
+        (root / "search").write_text(json.dumps(results))
+        servers[branch] = http_server(root)
+
+    config = yaml.safe_load(config_file.read_text())
+    config["epr"] = {branch: server.url for branch, server in servers.items()}
+    config_file.write_text(yaml.dump(config))
+    monkeypatch.setenv("PACKAGE_ASSETS_CACHE", str(tmp_path / "cache"))
+    return servers
+
+
+def test_update_plan_file_shards(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    plan_file = tmp_path / "plan.jsonl"
+    plan_file.write_text(run(*options, "plan", "--format", "jsonl"))
+    state_file = tmp_path / "state.yml"
+
+    # each shard installs a disjoint slice, all the versions of a package in the same one
+    outputs = [run(*options, "update", "--plan-file", plan_file, "--shard", f"{i}/3", "--state", state_file)
+               for i in (1, 2, 3)]
+    assert sum(int(line.split()[0]) for output in outputs for line in output.splitlines()
+               if "updated, 0 failed" in line) == 5
+    installs = [line.split()[:2] for line in elastic_package.read_text().splitlines()]
+    assert sorted(installs) == [["endpoint", "8.3.0"], ["endpoint", "8.4.0"], ["kafka", "0.5.0"], ["nginx", "1.2.0"]]
+    assert not state_file.exists()
+    assert run(*options, "plan") == ""
+
+    # running the plan again installs nothing
+    assert run(*options, "update", "--plan-file", plan_file) == ""
+    assert len(elastic_package.read_text().splitlines()) == len(installs)
+
+    result = CliRunner().invoke(cli, [str(arg) for arg in [*options, "update", "--shard", "4/3"]])
+    assert result.exit_code == 2 and "shard 4 is not in 1..3" in result.output
+    result = CliRunner().invoke(cli, [str(arg) for arg in [*options, "update", "--plan-file", "-"]], input="[1]")
+    assert result.exit_code == 1 and "Invalid plan file" in result.output
+
+
+def test_plan_epr_source(config_file, local_assets, checkouts, epr_servers, tmp_path):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    output = run(*options, "plan")
+    assert "+8.3.0" in output
+    assert run(*options, "plan", "--source", "epr") == output
+    assert not any(".zip" in request for server in epr_servers.values() for request in server.requests)
+
+
+def test_update_epr_source(config_file, assets_repos, epr_servers, elastic_package, tmp_path):
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    state = ["--state", tmp_path / "state.yml"]
+    output = run(*options, "update", "--source", "epr", "--incremental", *state)
+
+    assert "5 updated, 0 failed" in output
+    assert sorted(git_log(assets_repos / "staging")) == [
+        "Add assets: endpoint 8.3.0 (staging, 8.4.0)",
+        "Add assets: endpoint 8.4.0 (staging, 8.4.0)",
+        "Add assets: kafka 0.5.0 (staging, 8.4.0)",
+        "init",
+    ]
+    manifest = assets_repos / "staging" / "endpoint" / "8.4.0" / "manifest.yml"
+    assert yaml.safe_load(manifest.read_text()) == {"name": "endpoint", "version": "8.4.0"}
+    # the versions already dumped are not downloaded
+    assert "/epr/endpoint/endpoint-8.2.0.zip" not in epr_servers["production"].requests
+
+    # unchanged registries, nothing to re-evaluate
+    for server in epr_servers.values():
+        server.requests.clear()
+    assert run(*options, "plan", "--source", "epr", "--incremental", *state) == ""
+    assert all(server.requests == ["/search?all=1"] for server in epr_servers.values())
+
+
+def test_update_trace(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    import json
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite", "--trace", tmp_path / "trace.jsonl"]
+    output = run(*options, "update", "--branches", "staging")
+
+    events = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    names = {event["name"] for event in events}
+    assert {"plan local versions", "plan remote versions", "install version", "elastic-package install",
+            "elastic-package dump", "git add", "git commit", "commit"} <= names
+    versions = [event["args"] for event in events if event["name"] == "install version"]
+    assert sorted(args["version"] for args in versions) == ["0.5.0", "8.3.0", "8.4.0"]
+    assert all(args["files"] == 4 for args in versions)
+
+    summary = output[output.index("stage "):].splitlines()
+    assert [line.split()[:3] for line in summary if line.startswith("elastic-package install")] == \
+        [["elastic-package", "install", "3"]]
+
+
+def test_update_query(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    import json
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    run(*options, "update", "--state", tmp_path / "state.yml")
+
+    output = run(*options, "query", "--no-refresh", "--name", "endpoint")
+    assert [(o["branch"], o["version"]) for o in map(json.loads, output.splitlines())] == \
+        [("production", "8.3.0"), ("staging", "8.3.0"), ("staging", "8.4.0")]
+    output = run(*options, "query", "--type", "index_templates", "--branch", "staging", "--name", "k*")
+    assert [json.loads(line)["package"] for line in output.splitlines()] == ["kafka"]
+
+
+def test_update_packed(config_file, assets_repos, checkouts, elastic_package, tmp_path):
+    from conftest import git
+
+    options = ["--config", config_file, "--index", tmp_path / "index.sqlite"]
+    assert run(*options, "convert", "--to", "packed", "--branches", "production") == \
+        "production: 1 versions packed, 0 unused blobs removed\n"
+    # only the commands using the index open it
+    assert not (tmp_path / "index.sqlite").exists()
+    output = run(*options, "update", "--batch-commit", "--state", tmp_path / "state.yml")
+    assert "5 updated, 0 failed" in output
+
+    production = assets_repos / "production"
+    assert sorted(git_log(production)) == [
+        "Add assets: endpoint 8.3.0 (production, 8.4.0)",
+        "Add assets: nginx 1.2.0 (production, 8.4.0)",
+        "init",
+    ]
+    files = git("ls-files", cwd=production).split()
+    assert {"endpoint/8.3.0.tree", "nginx/1.2.0.tree"} <= set(files)
+    assert not [file for file in files if not file.endswith(".tree") and not file.startswith(".objects/")]
+    assert not (production / "endpoint" / "8.3.0").exists()
+
+    # staging reuses the packed production assets
+    assert "reuse assets of " in output
+    assert dict(assets.get_local_assets("endpoint/8.3.0", production))["endpoint/8.3.0/index_templates/endpoint.json"] \
+        == (assets_repos / "staging" / "endpoint" / "8.3.0" / "index_templates" / "endpoint.json").read_bytes()
+    assert run(*options, "plan") == ""
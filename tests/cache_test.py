@@ -0,0 +1,79 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import pytest
+
+from assets.cache import BlobCache, blob_sha, file_blob_sha
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return BlobCache(tmp_path / "cache", max_size=100)
+
+
+def test_blob_sha(tmp_path):
+    # git hash-object of "hello\n"
+    assert blob_sha(b"hello\n") == "ce013625030ba8dba906f756967f9e9ca394464a"
+    filename = tmp_path / "hello"
+    filename.write_bytes(b"hello\n")
+    assert file_blob_sha(filename) == "ce013625030ba8dba906f756967f9e9ca394464a"
+
+
+def test_put_get(cache, tmp_path):
+    data = b"x" * 10
+    assert cache.get(blob_sha(data)) is None
+    assert cache.put_data(blob_sha(data), data)
+    assert cache.read(blob_sha(data)) == data
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    filename = tmp_path / "y"
+    filename.write_bytes(b"y" * 10)
+    assert cache.put(blob_sha(b"y" * 10), filename)
+    # stored as a copy, the original file stays writable
+    assert not os.path.samefile(cache.get(blob_sha(b"y" * 10)), filename)
+    assert os.access(filename, os.W_OK)
+    assert cache.size == 20
+
+
+def test_corrupted(cache, tmp_path):
+    data = b"x" * 10
+    cache.put_data(blob_sha(data), data)
+    blob = cache.filename(blob_sha(data))
+    os.chmod(blob, 0o644)
+    blob.write_bytes(b"z" * 10)
+    assert cache.get(blob_sha(data)) is None
+    assert not blob.exists() and cache.size == 0
+
+    cache.put_data(blob_sha(data), data)
+    os.chmod(blob, 0o644)
+    blob.write_bytes(b"z" * 10)
+    assert cache.read(blob_sha(data)) is None
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_put_mismatch(cache, tmp_path):
+    assert not cache.put_data(blob_sha(b"a"), b"b")
+    assert not cache.put_data(None, b"b")
+    filename = tmp_path / "a"
+    filename.write_bytes(b"a")
+    assert not cache.put(blob_sha(b"b"), filename)
+    assert cache.size == 0
+
+
+def test_eviction(cache):
+    blobs = [bytes([i]) * 30 for i in range(4)]
+    for i, data in enumerate(blobs[:3]):
+        cache.put_data(blob_sha(data), data)
+        os.utime(cache.filename(blob_sha(data)), ns=(i * 10**9, i * 10**9))
+    # touch the oldest one, the second one becomes the least recently used
+    assert cache.get(blob_sha(blobs[0])) is not None
+
+    cache.put_data(blob_sha(blobs[3]), blobs[3])
+    assert cache.size == 90
+    assert cache.get(blob_sha(blobs[1])) is None
+    assert all(cache.get(blob_sha(data)) for data in (blobs[0], blobs[2], blobs[3]))
+
+    # a new instance finds the same size on disk
+    assert BlobCache(cache.path).size == 90
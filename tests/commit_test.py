@@ -0,0 +1,70 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import pytest
+
+from conftest import git
+from bot.commit import Committer, CommitError
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "test")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "test@example.com")
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git("init", "-q", cwd=repo)
+    return repo
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_commit(repo):
+    committer = Committer(repo)
+    write(repo / "endpoint" / "8.3.0" / "meta.yml", "meta")
+    write(repo / "endpoint" / "8.3.0" / "index_templates" / "logs.json", "{}")
+    write(repo / "untracked.txt", "untracked")
+
+    first = committer.commit(repo / "endpoint" / "8.3.0", "Add assets: endpoint 8.3.0")
+    assert git("rev-parse", "HEAD", cwd=repo).strip() == first
+    assert git("log", "--format=%s", cwd=repo).splitlines() == ["Add assets: endpoint 8.3.0"]
+    assert git("ls-files", cwd=repo).splitlines() == ["endpoint/8.3.0/index_templates/logs.json",
+                                                      "endpoint/8.3.0/meta.yml"]
+
+    write(repo / "endpoint" / "8.4.0" / "meta.yml", "meta")
+    (repo / "endpoint" / "8.3.0" / "index_templates" / "logs.json").unlink()
+    write(repo / "endpoint" / "8.3.0" / "meta.yml", "changed")
+    committer.commit(repo / "endpoint" / "8.3.0", "Update assets: endpoint 8.3.0")
+    committer.commit(repo / "endpoint" / "8.4.0", "Add assets: endpoint 8.4.0")
+    assert git("ls-tree", "-r", "--name-only", "HEAD", cwd=repo).splitlines() == ["endpoint/8.3.0/meta.yml",
+                                                                                  "endpoint/8.4.0/meta.yml"]
+    # the index follows each commit, also if the committer is never closed
+    assert git("status", "--porcelain", cwd=repo).splitlines() == ["?? untracked.txt"]
+    committer.close()
+
+    assert git("rev-parse", "HEAD~2", cwd=repo).strip() == first
+    assert git("status", "--porcelain", cwd=repo).splitlines() == ["?? untracked.txt"]
+    assert git("show", "HEAD~1:endpoint/8.3.0/meta.yml", cwd=repo) == "changed"
+    assert git("ls-files", cwd=repo).splitlines() == ["endpoint/8.3.0/meta.yml", "endpoint/8.4.0/meta.yml"]
+
+
+def test_commit_subdir(repo):
+    write(repo / "assets" / "endpoint" / "meta.yml", "meta")
+    with Committer(repo / "assets") as committer:
+        committer.commit(repo / "assets" / "endpoint", "Add assets")
+    assert git("ls-files", cwd=repo).splitlines() == ["assets/endpoint/meta.yml"]
+
+
+def test_nothing_to_commit(repo):
+    committer = Committer(repo)
+    write(repo / "endpoint" / "meta.yml", "meta")
+    committer.commit(repo / "endpoint", "Add assets")
+    with pytest.raises(CommitError) as exc:
+        committer.commit(repo / "endpoint", "Add assets again")
+    assert str(exc.value) == "nothing to commit"
+    committer.close()
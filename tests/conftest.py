@@ -0,0 +1,165 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import yaml
+import pytest
+import threading
+import subprocess
+from functools import partial
+from types import SimpleNamespace
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import assets
+import packages
+
+
+class FlakyHandler(SimpleHTTPRequestHandler):
+    """Serve files from a directory, failing the first `failures` requests of each path."""
+
+    failures = 0
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            count = self.server.counts.get(self.path, 0)
+            self.server.counts[self.path] = count + 1
+        if count < self.failures:
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRepo:
+    """
+    GitHub repository of the given files by branch, trees are named `tree:<branch>:<path>`.
+
+    :param trees: lists of file paths by branch
+    :param truncated: True to truncate all the recursive trees, "branch" only those of whole branches
+    """
+
+    full_name = "elastic/package-assets"
+
+    def __init__(self, trees, truncated=False):
+        self.trees = trees
+        self.truncated = truncated
+        self.calls = []
+
+    def get_git_tree(self, ref, recursive=False):
+        from github import GithubException
+
+        self.calls.append(("tree", ref))
+        branch, _, path = ref[len("tree:"):].partition(":") if ref.startswith("tree:") else ref.partition(":")
+        prefix = f"{path}/" if path else ""
+        paths = [p[len(prefix):] for p in self.trees.get(branch, []) if p.startswith(prefix)]
+        if not paths:
+            raise GithubException(404, "Not Found", None)
+        if not recursive:
+            children = {p.split("/")[0]: "tree" if "/" in p else "blob" for p in paths}
+            shas = {c: f"tree:{branch}:{prefix}{c}" if t == "tree" else f"sha-{prefix}{c}" for c, t in children.items()}
+            tree = [SimpleNamespace(path=c, type=t, sha=shas[c]) for c, t in sorted(children.items())]
+            return SimpleNamespace(sha=f"tree:{ref}", tree=tree, truncated=False)
+        tree = [SimpleNamespace(path=p, type="blob", sha=f"sha-{prefix}{p}", size=len(prefix + p))
+                for p in sorted(paths)]
+        # with truncated="branch" only the listings of whole branches are truncated
+        truncated = self.truncated is True or self.truncated == "branch" and not path
+        return SimpleNamespace(sha=f"tree:{ref}", tree=tree[:1] if truncated else tree, truncated=truncated)
+
+    def get_archive_link(self, archive_format, ref):
+        return f"https://codeload.github.com/{self.full_name}/tar.gz/refs/heads/{ref}"
+
+    def get_contents(self, path, ref):
+        from github import GithubException
+
+        self.calls.append(("contents", ref, path))
+        if path in self.trees.get(ref, []):
+            return SimpleNamespace(path=path, type="file", sha=f"sha-{path}", size=len(path),
+                                   download_url=f"{assets.raw_url}/{self.full_name}/{ref}/{path}")
+        paths = {p for p in self.trees.get(ref, []) if p.startswith(path + "/")}
+        if not paths:
+            raise GithubException(404, "Not Found", None)
+        children = {}
+        for p in paths:
+            child = p[len(path) + 1:].split("/")[0]
+            children[child] = "dir" if "/" in p[len(path) + 1:] else "file"
+        download_url = f"{assets.raw_url}/{self.full_name}/{ref}/{path}"
+        return [SimpleNamespace(path=f"{path}/{c}", type=t, sha=f"sha-{path}/{c}", size=len(f"{path}/{c}"),
+                                download_url=f"{download_url}/{c}")
+                for c, t in sorted(children.items())]
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Yield a function starting a local HTTP server serving `root`, the server has the `url` attribute."""
+
+    servers = []
+
+    def serve(root=tmp_path, failures=0, handler=FlakyHandler):
+        handler = type(handler.__name__, (handler,), {"failures": failures})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(root)))
+        server.lock = threading.Lock()
+        server.requests = []
+        server.counts = {}
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        server.url = f"http://127.0.0.1:{server.server_port}"
+        return server
+
+    yield serve
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def git(*args, cwd=None):
+    args = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", "-c", "init.defaultBranch=main", *args]
+    return subprocess.run(args, cwd=cwd, check=True, stdout=subprocess.PIPE).stdout.decode()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """Package-storage repository with a few packages in the production and staging branches."""
+
+    repo = tmp_path / "package-storage"
+    repo.mkdir()
+    git("init", "-q", cwd=repo)
+    git("config", "uploadpack.allowFilter", "true", cwd=repo)
+    for branch, contents in {
+        "production": {"endpoint": ["8.2.0", "8.3.0"], "nginx": ["1.2.0"]},
+        "staging": {"endpoint": ["8.3.0", "8.4.0"], "kafka": ["0.5.0"]},
+    }.items():
+        git("checkout", "-q", "--orphan", branch, cwd=repo)
+        git("rm", "-rqf", "--ignore-unmatch", ".", cwd=repo)
+        for package, versions in contents.items():
+            for version in versions:
+                package_dir = repo / "packages" / package / version
+                package_dir.mkdir(parents=True)
+                (package_dir / "manifest.yml").write_text(yaml.dump({"name": package, "version": version}))
+                (package_dir / "docs").mkdir()
+                (package_dir / "docs" / "README.md").write_text(f"{package} {version}")
+        # a version without manifest
+        (repo / "packages" / "endpoint" / "0.0.1").mkdir()
+        (repo / "packages" / "endpoint" / "0.0.1" / "README.md").write_text("no manifest")
+        git("add", ".", cwd=repo)
+        git("commit", "-qm", f"{branch} packages", cwd=repo)
+    return repo
+
+
+@pytest.fixture
+def checkouts(storage, tmp_path, monkeypatch):
+    packages_dir = tmp_path / "packages"
+    for branch in ("production", "staging"):
+        git("clone", "-q", "-b", branch, str(storage), str(packages_dir / branch))
+    monkeypatch.setattr(packages, "packages_dir", packages_dir)
+    return packages_dir
+
+
+@pytest.fixture
+def git_dir(storage, tmp_path):
+    git_dir = tmp_path / "package-storage.git"
+    git("clone", "-q", "--bare", "--no-local", "--filter=blob:none", f"file://{storage}", str(git_dir))
+    return git_dir
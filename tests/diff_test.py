@@ -0,0 +1,85 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import pytest
+from click.testing import CliRunner
+
+import assets
+from assets.diff import Change, Documents, diff_documents, diff_versions, format_path
+from bot.__main__ import cli
+
+
+def write(path, doc):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(doc, indent=2))
+
+
+@pytest.fixture
+def versions(tmp_path, monkeypatch):
+    branch_dir = tmp_path / "assets" / "production"
+    for version, pid in (("8.3.0", "long"), ("8.4.0", "keyword"), ("8.5.0", "keyword")):
+        asset_dir = branch_dir / "endpoint" / version
+        mappings = {"properties": {"process": {"properties": {"pid": {"type": pid}}}}}
+        write(asset_dir / "index_templates" / "logs-endpoint.json", {"name": "logs-endpoint", "mappings": mappings})
+        write(asset_dir / "ingest_pipelines" / f"logs-endpoint-{version}.json", {"processors": [{"set": {}}]})
+        write(asset_dir / "ilm_policies" / "logs-endpoint.json", {"policy": {"phases": {}}})
+    write(branch_dir / "endpoint" / "8.4.0" / "ilm_policies" / "metrics-endpoint.json", {"policy": {}})
+    monkeypatch.setattr(assets, "assets_dir", tmp_path / "assets")
+    return branch_dir
+
+
+def test_diff_documents():
+    old = {"a": 1, "b": {"c": [1, 2]}, "d": [1], "e": "x"}
+    new = {"a": 1, "b": {"c": [1, 3]}, "d": [1, 2], "f": "x"}
+    assert list(diff_documents(old, new)) == [
+        Change("changed", ("b", "c", 1), 2, 3),
+        Change("changed", ("d",), [1], [1, 2]),
+        Change("removed", ("e",), "x", None),
+        Change("added", ("f",), None, "x"),
+    ]
+    assert list(diff_documents(old, old)) == []
+
+
+def test_format_path():
+    assert format_path(("processors", 2, "set")) == "processors[2].set"
+    assert format_path(()) == ""
+
+
+def test_diff_versions(versions):
+    documents = Documents()
+    diffs = diff_versions("endpoint/8.3.0", "endpoint/8.4.0", versions, documents=documents)
+    assert [(d.op, d.path) for d in diffs] == [
+        ("added", "ilm_policies/metrics-endpoint.json"),
+        ("changed", "index_templates/logs-endpoint.json"),
+    ]
+    assert diffs[1].changes == [Change("changed", ("mappings", "properties", "process", "properties", "pid",
+                                                   "type"), "long", "keyword")]
+    # identical files are not parsed
+    assert documents.parsed == 2
+
+    # the 8.4.0 documents are parsed only once across the chain
+    diffs = diff_versions("endpoint/8.4.0", "endpoint/8.5.0", versions, documents=documents)
+    assert [(d.op, d.path) for d in diffs] == [("removed", "ilm_policies/metrics-endpoint.json")]
+    assert documents.parsed == 2
+
+
+def test_diff_versions_missing(versions):
+    with pytest.raises(ValueError, match="Package not found: endpoint/9.0.0"):
+        diff_versions("endpoint/8.3.0", "endpoint/9.0.0", versions)
+
+
+def test_bot_diff(versions, tmp_path):
+    result = CliRunner().invoke(cli, ["--index", "", "diff", "endpoint/8.3.0", "endpoint/8.4.0", "endpoint/8.5.0"])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines() == [
+        "--- production/endpoint/8.3.0",
+        "+++ production/endpoint/8.4.0",
+        "+ ilm_policies/metrics-endpoint.json",
+        "~ index_templates/logs-endpoint.json",
+        '    ~ mappings.properties.process.properties.pid.type: "long" -> "keyword"',
+        "--- production/endpoint/8.4.0",
+        "+++ production/endpoint/8.5.0",
+        "- ilm_policies/metrics-endpoint.json",
+    ]
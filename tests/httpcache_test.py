@@ -0,0 +1,163 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import hashlib
+import pytest
+
+from conftest import FlakyHandler
+from assets.httpcache import HttpCache, install_github_cache
+import assets
+
+
+class ETagHandler(FlakyHandler):
+    """Serve files with an `ETag`, reply `304 Not Modified` to matching `If-None-Match`."""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        path = self.translate_path(self.path)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def served(tmp_path):
+    root = tmp_path / "remote"
+    for i in range(10):
+        filename = root / "endpoint" / f"{i}.json"
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text(json.dumps({"i": i}) * 100)
+    return root
+
+
+def entries(server, root):
+    paths = sorted(str(p.relative_to(root)) for p in root.rglob("*.json"))
+    return [assets.RemoteEntry(p, None, None, f"{server.url}/{p}") for p in paths]
+
+
+@pytest.mark.parametrize("handler", [ETagHandler, FlakyHandler])
+def test_download_assets(http_server, served, tmp_path, handler):
+    server = http_server(served, handler=handler)
+    cache = HttpCache(tmp_path / "cache")
+
+    first = dict(assets.download_assets(entries(server, served), workers=4, http_cache=cache))
+    assert (cache.hits, cache.misses) == (0, 10)
+
+    second = dict(assets.download_assets(entries(server, served), workers=4, http_cache=cache))
+    assert second == first
+    assert (cache.hits, cache.misses) == (10, 10)
+
+    # changed content is fetched again
+    changed = served / "endpoint" / "0.json"
+    changed.write_text("changed, with a different size")
+    # Last-Modified has one second resolution
+    os.utime(changed, (changed.stat().st_atime, changed.stat().st_mtime + 10))
+    third = dict(assets.download_assets(entries(server, served), workers=4, http_cache=cache))
+    assert third["endpoint/0.json"] == b"changed, with a different size"
+    assert (cache.hits, cache.misses) == (19, 11)
+
+
+def test_save_assets(http_server, served, tmp_path):
+    server = http_server(served, handler=ETagHandler)
+    cache = HttpCache(tmp_path / "cache")
+    for output_dir in ("first", "second"):
+        saved = dict(assets.save_assets(entries(server, served), "endpoint", tmp_path / output_dir, http_cache=cache))
+        assert all(filename.read_bytes() == (served / path).read_bytes() for path, filename in saved.items())
+    assert (cache.hits, cache.misses) == (10, 10)
+
+
+def test_streamed(http_server, served, tmp_path):
+    import requests
+    from assets.httpcache import mount
+
+    server = http_server(served, handler=ETagHandler)
+    cache = HttpCache(tmp_path / "cache")
+    url = f"{server.url}/endpoint/0.json"
+    expected = (served / "endpoint" / "0.json").read_bytes()
+    with mount(requests.Session(), cache) as session:
+        # a body not read till the end is not stored
+        with session.get(url, stream=True) as res:
+            assert next(res.iter_content(10)) == expected[:10]
+        assert cache.size == 0 and not list(cache.path.rglob("*.part"))
+
+        for _ in range(2):
+            with session.get(url, stream=True) as res:
+                assert b"".join(res.iter_content(100)) == expected
+                assert res.raw.tell() == len(expected)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.size > len(expected)
+
+
+def test_eviction(http_server, served, tmp_path):
+    server = http_server(served, handler=ETagHandler)
+    cache = HttpCache(tmp_path / "cache", max_size=5000)
+    _ = list(assets.download_assets(entries(server, served), http_cache=cache))
+    assert 0 < cache.size <= 5000
+    assert sum(1 for _ in cache.blobs._blobs()) < 10
+
+
+def test_not_blobs(tmp_path):
+    cache = HttpCache(tmp_path / "cache")
+    cache.store("key", {"ETag": '"1"'}, b"content")
+    # the entries are addressed by request, not by content
+    assert not hasattr(cache, "get") and not hasattr(cache, "put")
+    headers, body = cache.load("key")
+    try:
+        assert (headers, body.read()) == ({"ETag": '"1"'}, b"content")
+    finally:
+        body.close()
+    assert cache.size == cache.filename("key").stat().st_size
+
+
+def test_epr(http_server, tmp_path):
+    from bot.epr import get_epr
+
+    (tmp_path / "search").write_text(json.dumps([{"name": "endpoint", "version": "8.3.0"}]))
+    server = http_server(tmp_path, handler=ETagHandler)
+    cache = HttpCache(tmp_path / "cache")
+    epr = get_epr(server.url, cache)
+    try:
+        assert epr.search(all=True) == epr.search(all=True) == [{"name": "endpoint", "version": "8.3.0"}]
+    finally:
+        epr.close()
+        get_epr.cache_clear()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_github(http_server, tmp_path):
+    from github import Github
+    from github.Requester import Requester
+
+    repo = {"full_name": "elastic/package-assets", "url": "/repos/elastic/package-assets"}
+    (tmp_path / "repos" / "elastic").mkdir(parents=True)
+    (tmp_path / "repos" / "elastic" / "package-assets").write_text(json.dumps(repo))
+    server = http_server(tmp_path, handler=ETagHandler)
+    cache = HttpCache(tmp_path / "cache")
+
+    install_github_cache(cache)
+    try:
+        for _ in range(2):
+            github = Github(base_url=server.url)
+            assert github.get_repo("elastic/package-assets").full_name == "elastic/package-assets"
+    finally:
+        Requester.resetConnectionClasses()
+    assert (cache.hits, cache.misses) == (1, 1)
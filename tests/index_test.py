@@ -0,0 +1,130 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import json
+import yaml
+import pytest
+
+import assets
+import packages
+from assets.cache import file_blob_sha
+from assets.index import Index
+
+
+@pytest.fixture
+def index(tmp_path):
+    with Index(tmp_path / "index.sqlite") as index:
+        yield index
+
+
+@pytest.fixture
+def meta_file(tmp_path):
+    filename = tmp_path / "meta.yml"
+    filename.write_text("stack:\n  version: 8.4.0\n")
+    return filename
+
+
+def test_load_yaml(index, meta_file):
+    assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+    assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+    assert (index.hits, index.misses) == (1, 1)
+
+
+def test_load_yaml_changed(index, meta_file):
+    index.load_yaml(meta_file)
+
+    # same content, different mtime: found by content
+    os.utime(meta_file, ns=(0, 0))
+    assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+    assert (index.hits, index.misses) == (1, 1)
+
+    meta_file.write_text("stack:\n  version: 8.5.0\n")
+    assert index.load_yaml(meta_file) == {"stack": {"version": "8.5.0"}}
+    assert (index.hits, index.misses) == (1, 2)
+
+
+def test_load_yaml_same_content(index, meta_file, tmp_path):
+    index.load_yaml(meta_file)
+    other = tmp_path / "other.yml"
+    other.write_bytes(meta_file.read_bytes())
+    assert index.load_yaml(other) == {"stack": {"version": "8.4.0"}}
+    assert (index.hits, index.misses) == (1, 1)
+
+
+def test_persistence(tmp_path, meta_file):
+    with Index(tmp_path / "index.sqlite") as index:
+        index.load_yaml(meta_file)
+    with Index(tmp_path / "index.sqlite") as index:
+        assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+        assert (index.hits, index.misses) == (1, 0)
+        index.rebuild()
+        assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+        assert (index.hits, index.misses) == (1, 1)
+
+
+def test_json_documents(index, tmp_path):
+    filename = tmp_path / "manifest.yml"
+    filename.write_text("name: endpoint\nreleased: 2022-08-01\n")
+    # dates are strings, also the first time
+    assert index.load_yaml(filename) == {"name": "endpoint", "released": "2022-08-01"}
+    assert index.load_yaml(filename) == {"name": "endpoint", "released": "2022-08-01"}
+    data, = index.db.execute("SELECT data FROM documents").fetchone()
+    assert json.loads(data) == {"name": "endpoint", "released": "2022-08-01"}
+
+
+def test_old_format(tmp_path, meta_file):
+    import pickle
+    import sqlite3
+
+    db = sqlite3.connect(str(tmp_path / "index.sqlite"))
+    db.execute("CREATE TABLE documents (sha TEXT PRIMARY KEY, data BLOB NOT NULL)")
+    db.execute("INSERT INTO documents VALUES (?, ?)", (file_blob_sha(meta_file), pickle.dumps({"x": 1})))
+    db.commit()
+    db.close()
+    with Index(tmp_path / "index.sqlite") as index:
+        assert index.load_yaml(meta_file) == {"stack": {"version": "8.4.0"}}
+        assert (index.hits, index.misses) == (0, 1)
+
+
+def test_prune(index, meta_file, tmp_path):
+    other = tmp_path / "other.yml"
+    other.write_text("a: 1\n")
+    index.load_yaml(meta_file)
+    index.load_yaml(other)
+    other.unlink()
+    assert index.prune() == 1
+    assert [path for path, in index.db.execute("SELECT path FROM files")] == [str(meta_file)]
+
+
+def test_get_meta_manifest(index, tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, "assets_dir", tmp_path / "assets")
+    monkeypatch.setattr(packages, "packages_dir", tmp_path / "packages")
+
+    meta = {"stack": {"version": "8.4.0"}}
+    manifest = {"name": "endpoint", "version": "8.4.0", "conditions": {"kibana.version": "^8.4.0"}}
+    for filename, doc in ((tmp_path / "assets/production/endpoint/8.4.0/meta.yml", meta),
+                          (tmp_path / "packages/production/packages/endpoint/8.4.0/manifest.yml", manifest)):
+        filename.parent.mkdir(parents=True)
+        filename.write_text(yaml.dump(doc))
+
+    for _ in range(2):
+        assert assets.get_meta("production", "endpoint", "8.4.0", index=index) == meta
+        assert packages.get_manifest("production", "endpoint", "8.4.0", index=index) == manifest
+    assert assets.get_meta("production", "endpoint", "8.5.0", index=index) is None
+    assert (index.hits, index.misses) == (2, 2)
+
+
+def test_extension(index):
+    index.extend_schema("CREATE TABLE IF NOT EXISTS extra (key TEXT PRIMARY KEY, value INTEGER)")
+    index.executemany("INSERT INTO extra VALUES (?, ?)", [("a", 1), ("b", 2)])
+    with pytest.raises(ValueError):
+        with index.transaction() as db:
+            db.execute("DELETE FROM extra")
+            raise ValueError()
+    assert index.execute("SELECT * FROM extra ORDER BY key") == [("a", 1), ("b", 2)]
+
+    # the tables of the extensions are emptied too
+    index.rebuild()
+    assert index.execute("SELECT * FROM extra") == []
@@ -0,0 +1,88 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import shutil
+import pytest
+
+import assets
+from assets.index import Index
+from assets.objects import ObjectIndex, get_fields, get_objects
+
+
+def index_template(name, properties):
+    return {
+        "name": name,
+        "index_template": {
+            "index_patterns": [f"{name}-*"],
+            "template": {"mappings": {"properties": properties}},
+        },
+    }
+
+
+def write_object(asset_dir, type, filename, doc):
+    filename = asset_dir / type / filename
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    filename.write_text(json.dumps(doc))
+
+
+@pytest.fixture
+def objects_assets(tmp_path, monkeypatch):
+    assets_dir = tmp_path / "assets"
+    for version, fields in (("8.3.0", {"pid": {"type": "long"}}), ("8.4.0", {"name": {"type": "keyword"}})):
+        asset_dir = assets_dir / "production" / "endpoint" / version
+        process = {"properties": fields}
+        write_object(asset_dir, "index_templates", "logs-endpoint.events.process.json",
+                     index_template("logs-endpoint.events.process", {"process": process}))
+        write_object(asset_dir, "ingest_pipelines", f"logs-endpoint-{version}.json", {"processors": []})
+        (asset_dir / "meta.yml").write_text("stack:\n  version: 8.4.0\n")
+    monkeypatch.setattr(assets, "assets_dir", assets_dir)
+    return assets_dir
+
+
+@pytest.fixture
+def objects(tmp_path):
+    with Index(tmp_path / "index.sqlite") as index:
+        yield ObjectIndex(index)
+
+
+def test_get_fields():
+    mappings = {
+        "properties": {
+            "message": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+            "process": {"properties": {"pid": {"type": "long"}, "parent": {"properties": {"pid": {"type": "long"}}}}},
+        },
+    }
+    assert sorted(get_fields(mappings)) == ["message", "message.keyword", "process", "process.parent",
+                                            "process.parent.pid", "process.pid"]
+
+
+def test_get_objects(objects_assets):
+    assert list(get_objects("endpoint/8.3.0", objects_assets / "production")) == [
+        ("index_templates", "logs-endpoint.events.process", {"process", "process.pid"}),
+        ("ingest_pipelines", "logs-endpoint-8.3.0", set()),
+    ]
+
+
+def test_query(objects_assets, objects):
+    assert objects.update() == (2, 0)
+    assert [(o.version, o.name) for o in objects.query(field="process.pid")] == \
+        [("8.3.0", "logs-endpoint.events.process")]
+    assert [o.version for o in objects.query(type="index_templates", field="process.*")] == ["8.3.0", "8.4.0"]
+    assert [o.name for o in objects.query(type="ingest_pipelines", name="logs-endpoint-*")] == \
+        ["logs-endpoint-8.3.0", "logs-endpoint-8.4.0"]
+    assert objects.query(name="logs-endpoint.events.process", branch="staging") == []
+
+
+def test_update_incremental(objects_assets, objects):
+    objects.update()
+    assert objects.update() == (0, 0)
+
+    shutil.copytree(objects_assets / "production" / "endpoint" / "8.4.0",
+                    objects_assets / "staging" / "endpoint" / "8.4.0")
+    shutil.rmtree(objects_assets / "production" / "endpoint" / "8.3.0")
+    assert objects.update() == (1, 1)
+    assert [(o.branch, o.version) for o in objects.query(type="index_templates")] == \
+        [("production", "8.4.0"), ("staging", "8.4.0")]
+    assert objects.query(field="process.pid") == []
@@ -0,0 +1,62 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import yaml
+
+import assets
+import packages
+from assets.index import Index
+
+
+def test_git_source_versions(checkouts, git_dir):
+    checkout = packages.CheckoutSource()
+    with packages.GitSource(git_dir) as source:
+        assert sorted(source.walk()) == sorted(checkout.walk())
+        for branch in assets.branches:
+            for package in ("endpoint", "nginx", "kafka", "invalid"):
+                versions = source.get_versions(branch, package)
+                assert sorted(versions) == sorted(checkout.get_versions(branch, package))
+                for version in versions:
+                    assert source.get_manifest(branch, package, version) == \
+                        checkout.get_manifest(branch, package, version)
+        assert source.get_manifest("staging", "endpoint", "0.0.1") is None
+
+
+def test_git_source_index(git_dir, tmp_path):
+    with packages.GitSource(git_dir) as source, Index(tmp_path / "index.sqlite") as index:
+        manifest = source.get_manifest("production", "endpoint", "8.3.0", index=index)
+        assert manifest == {"name": "endpoint", "version": "8.3.0"}
+        # same blob in another branch
+        assert source.get_manifest("staging", "endpoint", "8.3.0", index=index) == manifest
+        assert (index.hits, index.misses) == (1, 1)
+
+
+def test_git_source_package_dir(git_dir):
+    with packages.GitSource(git_dir) as source:
+        with source.package_dir("staging", "endpoint", "8.4.0") as package_dir:
+            assert (package_dir / "docs" / "README.md").read_text() == "endpoint 8.4.0"
+            assert yaml.safe_load((package_dir / "manifest.yml").read_text())["version"] == "8.4.0"
+        assert not package_dir.exists()
+
+
+def test_changed_packages(storage, checkouts, git_dir):
+    from conftest import git
+
+    checkout = packages.CheckoutSource()
+    with packages.GitSource(git_dir) as source:
+        since = source.get_revision("staging")
+        assert since == checkout.get_revision("staging")
+        assert source.get_changed_packages("staging", since) == set()
+
+        git("checkout", "-q", "staging", cwd=storage)
+        (storage / "packages" / "kafka" / "0.5.0" / "manifest.yml").write_text("name: kafka\n")
+        git("rm", "-rq", "packages/endpoint/8.3.0", cwd=storage)
+        git("commit", "-qam", "update", cwd=storage)
+        git("--git-dir", str(git_dir), "fetch", "-q", "origin", "+refs/heads/*:refs/heads/*")
+        git("pull", "-q", cwd=checkouts / "staging")
+
+        assert source.get_changed_packages("staging", since) == {"kafka", "endpoint"}
+        assert checkout.get_changed_packages("staging", since) == {"kafka", "endpoint"}
+        assert source.get_changed_packages("staging", "0" * 40) is None
+        assert checkout.get_changed_packages("snapshot", since) is None
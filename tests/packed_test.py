@@ -0,0 +1,63 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import os
+import pytest
+
+import assets
+from assets import packed
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+@pytest.fixture
+def branch_dir(tmp_path, monkeypatch):
+    branch_dir = tmp_path / "assets" / "production"
+    for version in ("8.3.0", "8.4.0"):
+        asset_dir = branch_dir / "endpoint" / version
+        write(asset_dir / "meta.yml", "stack:\n  version: 8.4.0\n")
+        write(asset_dir / "manifest.yml", f"name: endpoint\nversion: {version}\n")
+        write(asset_dir / "component_templates" / "logs-endpoint@custom.json", '{"template": {}}')
+    monkeypatch.setattr(assets, "assets_dir", tmp_path / "assets")
+    return branch_dir
+
+
+def contents(package, path):
+    return sorted(assets.get_local_assets(package, path))
+
+
+def test_pack_branch(branch_dir):
+    unpacked = [contents(f"endpoint/{version}", branch_dir) for version in ("8.3.0", "8.4.0")]
+    walked = sorted(assets.walk())
+
+    assert packed.pack_branch(branch_dir) == 2
+    assert packed.is_packed(branch_dir)
+    assert sorted(os.listdir(branch_dir / "endpoint")) == ["8.3.0.tree", "8.4.0.tree"]
+    # meta.yml and the component template are shared by the two versions
+    assert sum(len(files) for _, _, files in os.walk(branch_dir / packed.objects_dir)) == 4
+
+    assert sorted(assets.walk()) == walked
+    assert assets.get_meta("production", "endpoint", "8.4.0") == {"stack": {"version": "8.4.0"}}
+    assert assets.get_meta("production", "endpoint", "9.0.0") is None
+    assert [contents(f"endpoint/{version}", branch_dir) for version in ("8.3.0", "8.4.0")] == unpacked
+    assert sorted(path for path, _ in assets.read_local_assets("endpoint/8.3.0", branch_dir)) == \
+        [path for path, _ in unpacked[0]]
+    with pytest.raises(ValueError, match="Package not found: endpoint/9.0.0"):
+        contents("endpoint/9.0.0", branch_dir)
+
+    assert packed.unpack_branch(branch_dir) == 2
+    assert not packed.is_packed(branch_dir)
+    assert sorted(assets.walk()) == walked
+    assert [contents(f"endpoint/{version}", branch_dir) for version in ("8.3.0", "8.4.0")] == unpacked
+
+
+def test_prune(branch_dir):
+    packed.pack_branch(branch_dir)
+    (branch_dir / "endpoint" / "8.3.0.tree").unlink()
+    assert packed.prune(branch_dir) == 1
+    manifest = ("endpoint/8.4.0/manifest.yml", b"name: endpoint\nversion: 8.4.0\n")
+    assert contents("endpoint/8.4.0", branch_dir)[1] == manifest
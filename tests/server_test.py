@@ -0,0 +1,280 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import threading
+import pytest
+import requests
+from click.testing import CliRunner
+
+import assets
+from assets import packed
+from assets.server import AssetServer, LocalBackend, UpstreamBackend, LRUCache, Response
+from conftest import FakeRepo
+
+
+@pytest.fixture
+def local_assets(tmp_path, monkeypatch):
+    asset_dir = tmp_path / "assets" / "production" / "endpoint" / "8.3.0"
+    (asset_dir / "index_templates").mkdir(parents=True)
+    (asset_dir / "index_templates" / "logs-endpoint.json").write_text('{"name": "logs-endpoint"}' + " " * 4096)
+    (asset_dir / "ingest_pipelines").mkdir()
+    (asset_dir / "ingest_pipelines" / "logs-endpoint-8.3.0.json").write_text('{"processors": []}')
+    (asset_dir / "meta.yml").write_text("stack:\n  version: 8.4.0\n")
+    other_dir = tmp_path / "assets" / "production" / "endpoint-other" / "1.0.0"
+    other_dir.mkdir(parents=True)
+    (other_dir / "meta.yml").write_text("stack:\n  version: 8.4.0\n")
+    monkeypatch.setattr(assets, "assets_dir", tmp_path / "assets")
+    return tmp_path / "assets"
+
+
+@pytest.fixture(params=["unpacked", "packed"])
+def server(request, local_assets, monkeypatch):
+    if request.param == "packed":
+        packed.pack_branch(local_assets / "production")
+    server = AssetServer(("127.0.0.1", 0), LocalBackend())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(assets, "raw_url", f"{url}/raw")
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def repo(server):
+    from github import Github
+
+    return Github(base_url=f"{server}/api").get_repo("elastic/package-assets")
+
+
+def expected(package):
+    return sorted(assets.get_local_assets(package, assets.assets_dir / "production"))
+
+
+@pytest.mark.parametrize("tree", [False, True])
+def test_get_remote_assets(repo, tree):
+    entries = list(assets.get_remote_assets("endpoint/8.3.0", repo, tree=tree))
+    assert sorted(entry.path for entry in entries) == [path for path, _ in expected("endpoint/8.3.0")]
+    assert sorted(assets.download_assets(entries)) == expected("endpoint/8.3.0")
+
+    with pytest.raises(ValueError, match="Package not found: endpoint/9.0.0"):
+        list(assets.get_remote_assets("endpoint/9.0.0", repo, tree=tree))
+
+
+def test_archive(server, repo):
+    url = f"{server}/archive/production/endpoint/8.3.0.tar.gz"
+    assert sorted(assets.download_archive_assets("endpoint/8.3.0", url)) == expected("endpoint/8.3.0")
+
+    # the branch tarball is streamed, the download stops past the package
+    url = assets.get_archive_url("endpoint/8.3.0", repo)
+    assert sorted(assets.download_archive_assets("endpoint/8.3.0", url)) == expected("endpoint/8.3.0")
+
+
+def test_archive_uncached(local_assets):
+    import io
+    import tarfile
+
+    server = AssetServer(("127.0.0.1", 0), LocalBackend())
+    try:
+        f = io.BytesIO()
+        server.archive("production")(f)
+        f.seek(0)
+        with tarfile.open(fileobj=f) as tar:
+            names = tar.getnames()
+    finally:
+        server.server_close()
+    prefix = "package-assets-production/"
+    assert names == [prefix + path for path, _ in expected("endpoint-other/1.0.0") + expected("endpoint/8.3.0")]
+    # the contents of a whole branch do not go through the cache of the responses
+    assert server.cache.size == 0
+
+
+@pytest.mark.parametrize("truncated", ["branch", True])
+def test_upstream_truncated(server, truncated):
+    packages = ["endpoint-other/1.0.0", "endpoint/8.3.0"]
+    paths = [path for package in packages for path, _ in expected(package)]
+    # the raw files of the fake upstream are served by the local server
+    repo = FakeRepo({"production": paths}, truncated=truncated)
+    upstream = AssetServer(("127.0.0.1", 0), UpstreamBackend(repo))
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{upstream.server_address[1]}"
+    api = f"{url}/api/repos/elastic/package-assets"
+    try:
+        with requests.Session() as session:
+            # whole branches are listed package by package, not with a truncated recursive tree
+            tree = session.get(f"{api}/git/trees/production?recursive=1").json()
+            assert [item["path"] for item in tree["tree"]] == paths and not tree["truncated"]
+            tree = session.get(f"{api}/git/trees/production%3Aendpoint%2F8.3.0?recursive=1").json()
+            assert [item["path"] for item in tree["tree"]] == [path[len("endpoint/8.3.0/"):]
+                                                               for path, _ in expected("endpoint/8.3.0")]
+            contents = session.get(f"{api}/contents/endpoint/8.3.0?ref=production").json()
+            assert [item["name"] for item in contents] == ["index_templates", "ingest_pipelines", "meta.yml"]
+            for path, content in expected("endpoint/8.3.0"):
+                assert session.get(f"{url}/raw/elastic/package-assets/production/{path}").content == content
+
+        archive = f"{url}/archive/production/endpoint/8.3.0.tar.gz"
+        assert sorted(assets.download_archive_assets("endpoint/8.3.0", archive)) == expected("endpoint/8.3.0")
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
+    assert ("tree", "production") in repo.calls
+    assert bool([call for call in repo.calls if call[0] == "contents"]) == (truncated is True)
+
+
+def test_cache_keys(local_assets):
+    server = AssetServer(("127.0.0.1", 0), LocalBackend(ttl=0))
+    try:
+        base_url = "http://127.0.0.1"
+        tree = server.tree("production", base_url)
+        # listed again but unchanged, the responses are still cached
+        assert server.tree("production", base_url) is tree
+        assert server.version_archive("production", "endpoint", "8.3.0") is \
+            server.version_archive("production", "endpoint", "8.3.0")
+        hits = server.cache.hits
+
+        meta = local_assets / "production" / "endpoint" / "8.3.0" / "meta.yml"
+        meta.write_text("stack:\n  version: 8.5.0\n")
+        assert server.tree("production", base_url) is not tree
+        assert server.raw("production", "endpoint/8.3.0/meta.yml").body == b"stack:\n  version: 8.5.0\n"
+        # the other packages keep their responses
+        assert server.raw("production", "endpoint-other/1.0.0/meta.yml") is \
+            server.raw("production", "endpoint-other/1.0.0/meta.yml")
+        assert server.cache.hits == hits + 1
+    finally:
+        server.server_close()
+
+
+def test_async_client(server):
+    import asyncio
+    from assets.aio import AsyncClient
+
+    async def download():
+        async with AsyncClient(api_url=f"{server}/api", raw_url=f"{server}/raw") as client:
+            return sorted([item async for item in client.download_assets(client.get_remote_assets("endpoint/8.3.0"))])
+
+    assert asyncio.run(download()) == expected("endpoint/8.3.0")
+
+
+def test_raw(server):
+    url = f"{server}/raw/elastic/package-assets/production/endpoint/8.3.0/index_templates/logs-endpoint.json"
+    with requests.Session() as session:
+        res = session.get(url)
+        assert res.status_code == 200
+        assert res.headers["Content-Encoding"] == "gzip"
+        assert res.content.startswith(b'{"name": "logs-endpoint"}')
+
+        res = session.get(url, headers={"If-None-Match": res.headers["ETag"]})
+        assert res.status_code == 304
+
+        res = session.get(url, headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in res.headers
+        assert int(res.headers["Content-Length"]) == len(res.content)
+
+        assert session.get(url.replace("8.3.0/index", "8.3.0/missing")).status_code == 404
+        assert session.get(f"{server}/raw/elastic/other/production/endpoint/8.3.0/meta.yml").status_code == 404
+
+
+def test_lru_cache():
+    cache = LRUCache(3000)
+    for key in "abc":
+        cache.put(key, Response(b"x" * 1000, "text/plain", compress=False))
+    assert cache.get("a")
+    cache.put("d", Response(b"x" * 1000, "text/plain", compress=False))
+    assert [key for key in "abcd" if cache.get(key)] == ["a", "c", "d"]
+    assert cache.size == 3000
+
+
+def test_bot_download(server, tmp_path, monkeypatch):
+    import github
+    from bot.__main__ import cli
+
+    # the GitHub token is not sent to the server
+    calls = []
+    init = github.Github.__init__
+
+    def record(self, *args, **kwargs):
+        calls.append((args, kwargs))
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(github.Github, "__init__", record)
+    monkeypatch.setenv("GITHUB_TOKEN_ASSETS", "secret")
+    # the server raw url is passed to the listings, the module default is left alone
+    monkeypatch.setattr(assets, "raw_url", "http://raw.invalid")
+
+    output_dir = tmp_path / "output"
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--server", server, "--no-cache",
+                                      "endpoint/8.3.0", str(output_dir)])
+    assert result.exit_code == 0, result.output
+    assert calls == [((), {"base_url": f"{server}/api"})]
+    assert "Saved 3 assets" in result.output
+    assert (output_dir / "meta.yml").read_text() == "stack:\n  version: 8.4.0\n"
+    assert assets.raw_url == "http://raw.invalid"
+
+
+def test_bot_download_many(server, tmp_path):
+    from bot.__main__ import cli
+
+    output_dir = tmp_path / "output"
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--server", server, "--no-cache", "--jobs", "2",
+                                      "--from", "-", "--include", "index_templates/*", "--include", "meta.yml",
+                                      "endpoint/8.3.0", str(output_dir)],
+                                input="# packages\nendpoint-other/1.0.0\n\nendpoint/8.3.0\nendpoint/0.0.0\n")
+    assert result.exit_code == 1, result.output
+    assert "Saved 3 assets" in result.output
+    assert "Not found: endpoint/0.0.0" in result.output
+    assert "endpoint/8.3.0: 2 assets" in result.output and "endpoint-other/1.0.0: 1 assets" in result.output
+    assert sorted(p.relative_to(output_dir).as_posix() for p in output_dir.rglob("*") if p.is_file()) == [
+        "endpoint-other/1.0.0/meta.yml",
+        "endpoint/8.3.0/index_templates/logs-endpoint.json",
+        "endpoint/8.3.0/meta.yml",
+    ]
+
+
+def test_bot_download_archive_exclude(server, tmp_path):
+    from bot.__main__ import cli
+
+    output_dir = tmp_path / "output"
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--server", server, "--no-cache", "--archive",
+                                      "--exclude", "*.json", "endpoint/8.3.0", "endpoint-other/1.0.0",
+                                      str(output_dir)])
+    assert result.exit_code == 0, result.output
+    assert "Saved 2 assets" in result.output
+    assert sorted(p.relative_to(output_dir).as_posix() for p in output_dir.rglob("*") if p.is_file()) == [
+        "endpoint-other/1.0.0/meta.yml",
+        "endpoint/8.3.0/meta.yml",
+    ]
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_bot_download_unmatched(server, tmp_path, archive):
+    from bot.__main__ import cli
+
+    output_dir = tmp_path / "output"
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--server", server, "--no-cache",
+                                      *(["--archive"] if archive else []), "--include", "*.json",
+                                      "endpoint/8.3.0", "endpoint-other/1.0.0", str(output_dir)])
+    assert result.exit_code == 1, result.output
+    assert "Saved 2 assets" in result.output
+    assert "No assets matched: endpoint-other/1.0.0" in result.output
+
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--server", server, "--no-cache",
+                                      *(["--archive"] if archive else []), "--include", "*.txt",
+                                      "endpoint/8.3.0", str(output_dir)])
+    assert result.exit_code == 1, result.output
+    assert "Saved" not in result.output
+    assert "No assets matched: endpoint/8.3.0" in result.output
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_bot_download_packed(tmp_path, monkeypatch, archive):
+    import github
+    from bot.__main__ import cli
+
+    # the packed branches are readable only through the server
+    repo = FakeRepo({"production": [".objects/ab/cdef", "endpoint/8.3.0.tree"]})
+    monkeypatch.setattr(github.Github, "get_repo", lambda self, name: repo)
+    result = CliRunner().invoke(cli, ["--index", "", "download", "--no-cache", *(["--archive"] if archive else []),
+                                      "endpoint/8.3.0", str(tmp_path / "output")])
+    assert result.exit_code == 1, result.output
+    assert "packed branch, not readable remotely: endpoint/8.3.0 (production)" in result.output
@@ -0,0 +1,75 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import json
+import pytest
+
+import assets
+from assets import trace
+
+
+@pytest.fixture
+def tracer(tmp_path, monkeypatch):
+    tracer = trace.Tracer(tmp_path / "trace.jsonl")
+    monkeypatch.setattr(trace, "tracer", tracer)
+    yield tracer
+    tracer.close()
+
+
+def test_span(tracer, tmp_path):
+    with trace.span("stage", files=1) as span:
+        span["bytes"] = 10
+    with trace.span("stage", files=2, bytes=5, label="second"):
+        pass
+    with pytest.raises(ValueError):
+        with trace.span("failed"):
+            raise ValueError("failure")
+
+    events = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    assert [event["name"] for event in events] == ["stage", "stage", "failed"]
+    assert events[0]["args"] == {"files": 1, "bytes": 10}
+    assert events[2]["args"] == {"error": "failure"}
+    assert all(event["duration"] >= 0 for event in events)
+
+    [(name, count, _, counters), failed] = tracer.summary()
+    assert (name, count, counters) == ("stage", 2, {"files": 3, "bytes": 15})
+    assert failed[:2] == ("failed", 1)
+    lines = tracer.format_summary()
+    assert lines[0].split() == ["stage", "count", "seconds", "counters"]
+    assert lines[1].startswith("stage ") and lines[1].endswith("files=3, bytes=15")
+
+
+def test_chrome(tmp_path):
+    with trace.Tracer(tmp_path / "trace.json", "chrome") as tracer:
+        with tracer.span("outer"):
+            with tracer.span("inner", files=1):
+                pass
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    spans = {event["name"]: event for event in events if event["ph"] == "X"}
+    assert sorted(spans) == ["inner", "outer"]
+    assert spans["outer"]["ts"] <= spans["inner"]["ts"]
+    assert spans["inner"]["ts"] + spans["inner"]["dur"] <= spans["outer"]["ts"] + spans["outer"]["dur"]
+    assert spans["inner"]["args"] == {"files": 1}
+    assert any(event["ph"] == "M" and event["name"] == "thread_name" for event in events)
+
+
+def test_no_tracer():
+    assert trace.tracer is None
+    with trace.span("stage", files=1) as span:
+        span["bytes"] = 1
+    assert span == {"files": 1, "bytes": 1}
+
+
+def test_download_assets(tracer, http_server, tmp_path):
+    root = tmp_path / "remote"
+    root.mkdir()
+    for i in range(4):
+        (root / f"{i}.json").write_bytes(b"x" * 1000)
+    server = http_server(root, failures=1)
+    entries = [assets.RemoteEntry(f"{i}.json", None, None, f"{server.url}/{i}.json") for i in range(4)]
+    assert len(list(assets.download_assets(entries, backoff=0.01))) == 4
+
+    [(name, count, _, counters)] = tracer.summary()
+    assert (name, count) == ("http get", 4)
+    assert counters == {"requests": 8, "retries": 4, "bytes": 4000}
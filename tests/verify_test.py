@@ -0,0 +1,89 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License;
+# you may not use this file except in compliance with the Elastic License.
+
+import pytest
+from click.testing import CliRunner
+
+import assets
+from assets import packed
+from assets.index import Index
+from assets.verify import Verifier, write_checksums
+from bot.__main__ import cli
+
+
+@pytest.fixture
+def asset_dirs(tmp_path, monkeypatch):
+    asset_dirs = []
+    for version in ("8.3.0", "8.4.0"):
+        asset_dir = tmp_path / "assets" / "production" / "endpoint" / version
+        (asset_dir / "index_templates").mkdir(parents=True)
+        (asset_dir / "index_templates" / "logs-endpoint.json").write_text('{"name": "logs-endpoint"}')
+        (asset_dir / "ilm_policies").mkdir()
+        (asset_dir / "ilm_policies" / "logs-endpoint.json").write_text('{"policy": {}}')
+        (asset_dir / "meta.yml").write_text("stack:\n  version: 8.4.0\n")
+        write_checksums(asset_dir)
+        asset_dirs.append(asset_dir)
+    monkeypatch.setattr(assets, "assets_dir", tmp_path / "assets")
+    return asset_dirs
+
+
+def verify(verifier):
+    return {version: problems for _, _, version, problems in verifier.verify(assets.walk())}
+
+
+def test_verify(asset_dirs, tmp_path):
+    with Index(tmp_path / "index.sqlite") as index:
+        verifier = Verifier(index, workers=2)
+        assert verify(verifier) == {"8.3.0": [], "8.4.0": []}
+        assert verifier.hashed == 8
+
+        asset_dir = asset_dirs[1]
+        (asset_dir / "index_templates" / "logs-endpoint.json").write_text('{"name": ')
+        (asset_dir / "ilm_policies" / "logs-endpoint.json").unlink()
+        (asset_dir / "meta.yml").write_text("stack:\n  version: 8.5.0\n")
+        (asset_dir / "extra.json").write_text("{}")
+
+        verifier = Verifier(index, workers=2)
+        prefix = "assets/production/endpoint/8.4.0"
+        assert verify(verifier) == {"8.3.0": [], "8.4.0": [
+            f"Invalid file: {prefix}/index_templates/logs-endpoint.json: invalid JSON: "
+            "Expecting value: line 1 column 10 (char 9)",
+            f"Missing file: {prefix}/ilm_policies/logs-endpoint.json",
+            f"Checksum mismatch: {prefix}/index_templates/logs-endpoint.json",
+            f"Checksum mismatch: {prefix}/meta.yml",
+            f"Unexpected file: {prefix}/extra.json",
+        ]}
+        # only the changed files are hashed again
+        assert verifier.hashed == 3
+
+        # the removed files are forgotten
+        (asset_dir / "extra.json").unlink()
+        assert verifier.prune() == 2
+        assert verifier.prune() == 0
+
+
+def test_verify_packed(asset_dirs):
+    packed.pack_branch(asset_dirs[0].parent.parent)
+    assert verify(Verifier()) == {"8.3.0": [], "8.4.0": []}
+
+
+def test_meta_pedantic(asset_dirs, tmp_path):
+    (asset_dirs[0] / "meta.yml").write_text("")
+    (asset_dirs[1] / "ilm_policies" / "logs-endpoint.json").write_text("{")
+
+    result = CliRunner().invoke(cli, ["--index", tmp_path / "index.sqlite", "meta", "--pedantic"])
+    assert result.exit_code == 1
+    lines = result.output.splitlines()
+    # walk order is not sorted, but the problems of each version come together and in order
+    assert [line for line in lines if "8.3.0" in line] == [
+        "Missing or empty meta: assets/production/endpoint/8.3.0/meta.yml",
+        "Checksum mismatch: assets/production/endpoint/8.3.0/meta.yml",
+    ]
+    assert [line for line in lines if "8.4.0/" in line or '"8.4.0"' in line] == [
+        "Invalid file: assets/production/endpoint/8.4.0/ilm_policies/logs-endpoint.json: invalid JSON: "
+        "Expecting property name enclosed in double quotes: line 1 column 2 (char 1)",
+        "Checksum mismatch: assets/production/endpoint/8.4.0/ilm_policies/logs-endpoint.json",
+        '{"branch": "production", "package": "endpoint", "version": "8.4.0", "meta": {"stack": {"version": "8.4.0"}}}',
+    ]
+    assert lines[-1] == "2 assets failed the verification" and len(lines) == 6